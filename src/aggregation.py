@@ -0,0 +1,395 @@
+# aggregation.py
+"""
+Activity totals at hour, day, week or month resolution over any range.
+
+Buckets are computed in the database, so only one row per non-empty bucket
+and action comes back. Day, week and month totals are read from the daily
+rollup, hours from ActivityLog. All buckets are in the user's time zone and
+labelled with the local start of the bucket. Series longer than a chart's
+pixel budget are downsampled with LTTB or by taking the maximum per bucket.
+
+Logs moved to the archive are bucketed with NumPy and merged into the
+hourly and property aggregates.
+
+Numeric fields of ActivityLog.properties can be summed, averaged, or their
+minimum or maximum taken the same way, read with json_extract on SQLite and
+the ->> operator on PostgreSQL. An expression index per property name, made
+with create_property_index, serves these queries from the index.
+"""
+import calendar
+import re
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import Float, cast, func, literal_column, select
+
+import archive
+import timezones
+import write_behind
+from database import db_session, engine
+from models import Action, ActivityLog, DailyRollup
+
+RESOLUTIONS = ("hour", "day", "week", "month")
+DOWNSAMPLE_METHODS = ("lttb", "max")
+DEFAULT_MAX_POINTS = 1000
+AGGREGATES = {"sum": func.sum, "avg": func.avg, "min": func.min, "max": func.max}
+PROPERTY_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]{0,62}")
+# Upper bound of buckets per series before downsampling
+MAX_BUCKETS = 100_000
+
+_RANGE_UNITS = {"h": "hours", "d": "days", "w": "weeks", "m": "months", "y": "years"}
+_STEPS = {
+    "hour": np.timedelta64(1, "h"),
+    "day": np.timedelta64(1, "D"),
+    "week": np.timedelta64(7, "D"),
+    "month": np.timedelta64(1, "M"),
+}
+
+
+def parse_range(value: str, now: datetime) -> datetime:
+    """Returns the start of a range like '48h', '90d', '12w', '6m' or '2y'."""
+    match = re.fullmatch(r"(\d+)([hdwmy])", value or "")
+    if not match or int(match[1]) == 0:
+        raise ValueError("range must look like 24h, 30d, 12w, 6m or 1y")
+    count, unit = int(match[1]), _RANGE_UNITS[match[2]]
+    if unit == "months":
+        return _add_months(now, -count)
+    if unit == "years":
+        return _add_months(now, -12 * count)
+    return now - timedelta(**{unit: count})
+
+
+def _add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    year, month = value.year + month // 12, month % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day)
+
+
+def bucket_labels(resolution: str, start: datetime, end: datetime) -> np.ndarray:
+    """Labels of every bucket from the one containing `start` up to `end`."""
+    if resolution == "hour":
+        first = np.datetime64(start.replace(tzinfo=None), "h")
+        last = np.datetime64(end.replace(tzinfo=None), "h")
+        return np.datetime_as_string(np.arange(first, last + 1), unit="m")
+    if resolution == "month":
+        first = np.datetime64(start.date(), "M")
+        last = np.datetime64(end.date(), "M")
+        months = np.datetime_as_string(np.arange(first, last + 1))
+        return np.char.add(months, "-01")
+
+    first = np.datetime64(start.date(), "D")
+    last = np.datetime64(end.date(), "D")
+    if resolution == "week":
+        # Weeks start on Monday, day 0 of datetime64 is a Thursday
+        first -= (first.astype(np.int64) + 3) % 7
+    days = np.arange(first, last + 1, _STEPS[resolution])
+    return np.datetime_as_string(days, unit="D")
+
+
+def _bucket_column(
+    resolution: str, tz: str, dialect: str, from_logs: bool, start=None, end=None
+):
+    """
+    SQL expression for the bucket label, matching bucket_labels, computed
+    from ActivityLog timestamps from `start` to `end` or from DailyRollup days.
+    """
+    if from_logs:
+        value = timezones.local_timestamp(
+            ActivityLog.timestamp, tz, dialect, start, end
+        )
+    else:
+        value = DailyRollup.day
+
+    if dialect == "postgresql":
+        if resolution == "hour":
+            return func.to_char(func.date_trunc("hour", value), 'YYYY-MM-DD"T"HH24:00')
+        return func.to_char(func.date_trunc(resolution, value), "YYYY-MM-DD")
+    if resolution == "hour":
+        return func.strftime("%Y-%m-%dT%H:00", value)
+    if resolution == "week":
+        return func.date(value, "-6 days", "weekday 1")
+    if resolution == "month":
+        return func.strftime("%Y-%m-01", value)
+    return func.date(value)
+
+
+def _check_property(name: str):
+    if not PROPERTY_NAME.fullmatch(name):
+        raise ValueError("property names may only use letters, digits and _")
+
+
+def property_value(name: str, dialect: str):
+    """
+    Returns (value, is_number) SQL expressions for a numeric property of
+    ActivityLog. The JSON path is inlined, not bound, so the expression is
+    the same as the one of its property index.
+    """
+    _check_property(name)
+    if dialect == "postgresql":
+        key = literal_column(f"'{name}'")
+        value = cast(ActivityLog.properties.op("->>")(key), Float)
+        is_number = func.json_typeof(ActivityLog.properties.op("->")(key)) == "number"
+        return value, is_number
+
+    path = literal_column(f"'$.{name}'")
+    value = func.json_extract(ActivityLog.properties, path)
+    # typeof() of the extracted value keeps the index covering, unlike json_type
+    is_number = func.typeof(value).in_(("integer", "real"))
+    return value, is_number
+
+
+def property_index_name(name: str) -> str:
+    return f"ix_activity_log_property_{name}"
+
+
+def create_property_index(name: str, bind=engine):
+    """
+    Creates an expression index on (action_id, timestamp, property). From
+    SQLite 3.41 it covers property aggregations, so the JSON of the rows is
+    never parsed; older versions only use it to find the rows.
+    """
+    _check_property(name)
+    if bind.dialect.name == "postgresql":
+        expression = f"(properties ->> '{name}')"
+    else:
+        expression = f"json_extract(properties, '$.{name}')"
+    with bind.begin() as conn:
+        conn.exec_driver_sql(
+            f"CREATE INDEX IF NOT EXISTS {property_index_name(name)} "
+            f"ON activity_log (action_id, timestamp, {expression})"
+        )
+
+
+def drop_property_index(name: str, bind=engine):
+    _check_property(name)
+    with bind.begin() as conn:
+        conn.exec_driver_sql(f"DROP INDEX IF EXISTS {property_index_name(name)}")
+
+
+def property_indexes(bind=engine) -> list[str]:
+    """Names of the properties that have an index."""
+    # Expression indexes are not reflected by SQLAlchemy, ask the catalog
+    if bind.dialect.name == "postgresql":
+        query = "SELECT indexname FROM pg_indexes WHERE tablename = 'activity_log'"
+    else:
+        query = (
+            "SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = 'activity_log'"
+        )
+    prefix = property_index_name("")
+    with bind.connect() as conn:
+        names = conn.exec_driver_sql(query).scalars()
+        return sorted(name[len(prefix) :] for name in names if name.startswith(prefix))
+
+
+def aggregate(
+    user_id: int,
+    resolution: str = "day",
+    start: datetime | None = None,
+    end: datetime | None = None,
+    action_ids=None,
+    prop: str | None = None,
+    agg: str = "sum",
+):
+    """
+    Returns (actions, labels, matrix) with the `agg` of the delta, or of the
+    numeric property `prop`, of every action per bucket. `matrix` has one row
+    per action and one column per label, empty buckets are 0 for sums and
+    NaN otherwise. `start` and `end` default to the last 30 days in the
+    user's time zone.
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    if agg not in AGGREGATES:
+        raise ValueError(f"agg must be one of {', '.join(AGGREGATES)}")
+
+    zone = timezones.user_timezone(user_id)
+    end = end.astimezone(zone) if end else datetime.now(zone)
+    start = start.astimezone(zone) if start else end - timedelta(days=30)
+    if start > end:
+        raise ValueError("start must be before end")
+    labels = bucket_labels(resolution, start, end)
+    if len(labels) > MAX_BUCKETS:
+        raise ValueError(f"More than {MAX_BUCKETS} buckets, use a coarser resolution")
+
+    query = db_session.query(Action).filter_by(user_id=user_id).order_by(Action.id)
+    if action_ids is not None:
+        query = query.filter(Action.id.in_(action_ids))
+    actions = query.all()
+    totals_only = prop is None and agg == "sum"
+    matrix = np.zeros(
+        (len(actions), len(labels)), dtype=np.int64 if totals_only else float
+    )
+    if agg != "sum":
+        matrix[:] = np.nan
+    if not actions:
+        return actions, labels, matrix
+
+    if write_behind.enabled():
+        write_behind.queue.flush()
+
+    # Delta sums per day and coarser come from the rollup, the rest from logs
+    dialect = db_session.get_bind().dialect.name
+    from_logs = resolution == "hour" or not totals_only
+    # The first bucket can begin before `start`, its rows are included
+    first = datetime.fromisoformat(labels[0]).replace(tzinfo=zone)
+    first = first.astimezone(timezone.utc).replace(tzinfo=None)
+    bucket = _bucket_column(
+        resolution, zone.key, dialect, from_logs, first, end
+    ).label("bucket")
+    conditions = []
+    if from_logs:
+        source, value = ActivityLog, ActivityLog.delta
+        if prop is not None:
+            value, is_number = property_value(prop, dialect)
+            conditions.append(is_number)
+        conditions.append(ActivityLog.timestamp >= first)
+    else:
+        source, value = DailyRollup, DailyRollup.sum_delta
+        conditions.append(DailyRollup.day >= np.datetime64(labels[0], "D").item())
+
+    row_index = {action.id: i for i, action in enumerate(actions)}
+    # Averages over logs are combined with the archive from sums and counts
+    averaged = from_logs and agg == "avg"
+    if averaged:
+        columns = [func.sum(value), func.count(value)]
+    else:
+        columns = [AGGREGATES[agg](value)]
+    rows = db_session.execute(
+        select(source.action_id, bucket, *columns)
+        .where(source.action_id.in_(row_index.keys()), *conditions)
+        .group_by(source.action_id, bucket)
+    ).all()
+    counts = np.zeros(matrix.shape)
+    if rows:
+        # Buckets outside the labels, e.g. in the future, are dropped
+        action_col, bucket_col, *results = zip(*rows)
+        buckets = np.array(bucket_col, dtype=labels.dtype)
+        cols = np.minimum(np.searchsorted(labels, buckets), len(labels) - 1)
+        found = labels[cols] == buckets
+        ids = np.array([row_index[action_id] for action_id in action_col])
+        matrix[ids[found], cols[found]] = np.array(results[0], dtype=float)[found]
+        if averaged:
+            counts[ids[found], cols[found]] = np.array(results[1])[found]
+
+    if from_logs:
+        archived = _archived(user_id, actions, labels, resolution, zone, prop)
+        _combine(matrix, counts, archived, agg)
+    if averaged:
+        with np.errstate(invalid="ignore"):
+            matrix = np.where(counts > 0, matrix / counts, np.nan)
+
+    return actions, labels, matrix
+
+
+def _bucket_starts(labels: np.ndarray, resolution: str, zone) -> list[datetime]:
+    """Local start of every bucket and the end of the last one."""
+    starts = [datetime.fromisoformat(label).replace(tzinfo=zone) for label in labels]
+    if resolution == "month":
+        starts.append(_add_months(starts[-1], 1))
+    else:
+        step = {"hour": "hours", "day": "days", "week": "weeks"}[resolution]
+        starts.append(starts[-1] + timedelta(**{step: 1}))
+    return starts
+
+
+def _archived(user_id, actions, labels, resolution, zone, prop):
+    """Yields (row, bucket indices, values) of the archived logs of `actions`."""
+    bounds = None
+    start = datetime.fromisoformat(labels[0]).replace(tzinfo=zone)
+    end = _bucket_starts(labels[-1:], resolution, zone)[-1]
+    for i, action in enumerate(actions):
+        timestamps, values = archive.values(user_id, action.id, start, end, prop)
+        if not len(timestamps):
+            continue
+        if bounds is None:
+            bounds = archive.bucket_bounds(_bucket_starts(labels, resolution, zone))
+        yield i, bounds.searchsorted(timestamps, side="right") - 1, values
+
+
+def _combine(matrix: np.ndarray, counts: np.ndarray, archived, agg: str):
+    """Merges archived values into the aggregates read from the table."""
+    columns = matrix.shape[1]
+    for i, cols, values in archived:
+        if agg in ("min", "max"):
+            combine = np.fmin if agg == "min" else np.fmax
+            extremes = np.full(columns, np.nan)
+            combine.at(extremes, cols, values)
+            matrix[i] = combine(matrix[i], extremes)
+            continue
+        found = np.bincount(cols, minlength=columns)
+        sums = np.bincount(cols, weights=values, minlength=columns)
+        filled = found > 0
+        matrix[i, filled] = np.nan_to_num(matrix[i, filled]) + sums[filled]
+        counts[i] += found
+
+
+def lttb_indices(values: np.ndarray, threshold: int) -> np.ndarray:
+    """
+    Picks `threshold` points of `values` with Largest-Triangle-Three-Buckets,
+    which keeps the visual shape of a line. Returns sorted indices.
+    """
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    y = np.asarray(values, dtype=float)
+    x = np.arange(n, dtype=float)
+    # threshold - 2 buckets over the points between the first and the last
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    previous = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[lo:hi] - y[previous])
+            - (x[previous] - x[lo:hi]) * (avg_y - y[previous])
+        )
+        previous = lo + int(areas.argmax())
+        selected[i + 1] = previous
+
+    return selected
+
+
+def max_downsample(labels: np.ndarray, matrix: np.ndarray, threshold: int):
+    """
+    Merges consecutive buckets so at most `threshold` remain, keeping the
+    maximum of each, ignoring NaN. Returns (labels, matrix), labels are the
+    first of each group.
+    """
+    n = len(labels)
+    if threshold >= n:
+        return labels, matrix
+    starts = np.linspace(0, n, threshold, endpoint=False).astype(int)
+    return labels[starts], np.fmax.reduceat(matrix, starts, axis=1)
+
+
+def series(actions, labels, matrix, max_points=DEFAULT_MAX_POINTS, method="lttb"):
+    """
+    JSON serializable series of every action with at most `max_points`
+    points each. LTTB picks points per series, so each has its own labels.
+    Empty buckets of averages, minimums and maximums are None.
+    """
+    if method == "max":
+        labels, matrix = max_downsample(labels, matrix, max_points)
+
+    result = []
+    for i, action in enumerate(actions):
+        keep = lttb_indices(np.nan_to_num(matrix[i]), max_points)
+        values = matrix[i, keep]
+        if values.dtype.kind == "f":
+            values = np.where(np.isnan(values), None, np.round(values, 4))
+        result.append(
+            {
+                "id": action.id,
+                "name": action.name,
+                "labels": labels[keep].tolist(),
+                "values": values.tolist(),
+            }
+        )
+    return result
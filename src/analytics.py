@@ -0,0 +1,170 @@
+# analytics.py
+"""
+Vectorized statistics over the dense daily activity matrix.
+
+Every function takes an array of shape (actions, days), one row per action
+with the oldest day first, and works on all rows at once without looping
+over days. A day counts as active when its total delta is non-zero.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from instrumentation import timed
+from model_helpers import get_activity_matrix
+
+ROLLING_WINDOWS = (7, 30)
+EWMA_SPAN = 7
+ANOMALY_THRESHOLD = 2.5
+# Days fetched before the displayed range so the longest rolling window is
+# complete on its first day
+HISTORY_DAYS = max(ROLLING_WINDOWS) - 1
+# Longest range analysed, in days
+MAX_ANALYTICS_DAYS = 365
+
+
+def rolling_mean(values: np.ndarray, window: int) -> np.ndarray:
+    """Mean of the last `window` days, over fewer days at the start of a row."""
+    values = np.atleast_2d(values).astype(float)
+    csum = np.cumsum(values, axis=1)
+    shifted = np.zeros_like(csum)
+    shifted[:, window:] = csum[:, :-window]
+    sizes = np.minimum(np.arange(1, values.shape[1] + 1), window)
+    return (csum - shifted) / sizes
+
+
+def ewma(values: np.ndarray, span: int = EWMA_SPAN) -> np.ndarray:
+    """
+    Exponentially weighted moving average with alpha = 2 / (span + 1),
+    computed as one product with a lower triangular weight matrix.
+    """
+    values = np.atleast_2d(values).astype(float)
+    n = values.shape[1]
+    alpha = 2 / (span + 1)
+    lags = np.arange(n)[:, None] - np.arange(n)[None, :]
+    weights = np.where(lags >= 0, (1 - alpha) ** np.maximum(lags, 0), 0.0)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return values @ weights.T
+
+
+def streaks(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the current and the longest run of active days of every row."""
+    active = np.atleast_2d(values) != 0
+    rows, n = active.shape
+
+    # Trailing active days end at the last inactive day from the right
+    inactive_from_end = ~active[:, ::-1]
+    current = np.where(
+        inactive_from_end.any(axis=1), inactive_from_end.argmax(axis=1), n
+    )
+
+    # Runs start where the padded row steps 0 -> 1 and end where it steps 1 -> 0
+    padded = np.zeros((rows, n + 2), dtype=np.int8)
+    padded[:, 1:-1] = active
+    steps = np.diff(padded, axis=1)
+    start_rows, start_cols = np.nonzero(steps == 1)
+    _, end_cols = np.nonzero(steps == -1)
+    longest = np.zeros(rows, dtype=np.int64)
+    np.maximum.at(longest, start_rows, end_cols - start_cols)
+
+    return current, longest
+
+
+def week_over_week(values: np.ndarray):
+    """
+    Totals of the last 7 days and the 7 days before, their difference and the
+    relative change in percent (NaN when the previous week is zero).
+    """
+    values = np.atleast_2d(values)
+    this_week = values[:, -7:].sum(axis=1)
+    last_week = values[:, -14:-7].sum(axis=1)
+    delta = this_week - last_week
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.where(last_week != 0, delta / np.abs(last_week) * 100, np.nan)
+    return this_week, last_week, delta, change
+
+
+def zscores(values: np.ndarray) -> np.ndarray:
+    """Standard score of every day against the mean and deviation of its row."""
+    values = np.atleast_2d(values).astype(float)
+    mean = values.mean(axis=1, keepdims=True)
+    std = values.std(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(std > 0, (values - mean) / std, 0.0)
+
+
+@dataclass
+class Analytics:
+    """Statistics of a set of actions, arrays have one row per action."""
+
+    rolling: dict[int, np.ndarray]
+    ewma: np.ndarray
+    zscores: np.ndarray
+    anomalies: np.ndarray
+    current_streak: np.ndarray
+    longest_streak: np.ndarray
+    this_week: np.ndarray
+    last_week: np.ndarray
+    week_delta: np.ndarray
+    week_change: np.ndarray
+
+    def row(self, i: int) -> dict:
+        """JSON serializable statistics of row `i`."""
+        change = self.week_change[i]
+        return {
+            **{
+                f"rolling_{window}": np.round(means[i], 2).tolist()
+                for window, means in self.rolling.items()
+            },
+            "ewma": np.round(self.ewma[i], 2).tolist(),
+            "zscores": np.round(self.zscores[i], 2).tolist(),
+            "anomalies": np.flatnonzero(self.anomalies[i]).tolist(),
+            "current_streak": int(self.current_streak[i]),
+            "longest_streak": int(self.longest_streak[i]),
+            "this_week": int(self.this_week[i]),
+            "last_week": int(self.last_week[i]),
+            "week_delta": int(self.week_delta[i]),
+            "week_change": None if np.isnan(change) else round(float(change), 1),
+        }
+
+
+def analyze(
+    values: np.ndarray, days: int | None = None, threshold=ANOMALY_THRESHOLD
+) -> Analytics:
+    """
+    Computes all statistics of `values`. With `days` the per day series are
+    cut to the last `days` columns, the earlier ones only serve as history.
+    """
+    values = np.atleast_2d(values)
+    keep = slice(-days, None) if days else slice(None)
+    scores = zscores(values)
+    current, longest = streaks(values)
+    this_week, last_week, delta, change = week_over_week(values)
+
+    return Analytics(
+        rolling={
+            window: rolling_mean(values, window)[:, keep]
+            for window in ROLLING_WINDOWS
+        },
+        ewma=ewma(values)[:, keep],
+        zscores=scores[:, keep],
+        anomalies=(np.abs(scores) > threshold)[:, keep],
+        current_streak=current,
+        longest_streak=longest,
+        this_week=this_week,
+        last_week=last_week,
+        week_delta=delta,
+        week_change=change,
+    )
+
+
+def user_analytics(user_id: int, days: int = 30):
+    """
+    Returns (actions, labels, matrix, analytics) for the last `days` days of a
+    user, the rolling windows are filled from the days before the range
+    """
+    actions, labels, matrix = get_activity_matrix(user_id, days=days + HISTORY_DAYS)
+    shown = days + 1
+    with timed("numpy"):
+        stats = analyze(matrix, shown)
+    return actions, labels[-shown:], matrix[:, -shown:], stats
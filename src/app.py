@@ -2,23 +2,51 @@ import os
 from pathlib import Path
 from flask import Flask, render_template
 from dotenv import load_dotenv
-import numpy as np
 
-from auth_helpers import current_user, login_required
-from model_helpers import get_activity_timeseries
+from auth_helpers import csrf_token, login_required
 from routes.auth import auth_bp
 from routes.actions import action_bp
 from routes.api import api_bp
 from routes.dashboard import dashboard_bp
-from models import Action
-from database import db_session
-from cli import create_test_data, collect_static
+from database import db_session, engine
+import broadcast
+import events
+import fragments
+import instrumentation
+import snapshots
+import write_behind
+from cli import (
+    archive_logs_command,
+    collect_static,
+    compact_logs_command,
+    create_test_data,
+    db_upgrade,
+    explain_queries,
+    export_logs,
+    generate_reports_command,
+    import_logs_command,
+    property_index,
+    rebuild_rollups_command,
+)
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 
 FLASK_ENV: str = os.getenv("FLASK_ENV", "development")
 _DEBUG: bool = True if FLASK_ENV == "development" else False
 
+# Request timing, SQL statistics and /metrics
+instrumentation.init_app(app, engine)
+instrumentation.metrics.add_gauge_source(
+    lambda: {f"write_behind_{k}": v for k, v in write_behind.queue.stats().items()}
+)
+instrumentation.metrics.add_gauge_source(events.broker.stats)
+instrumentation.metrics.add_gauge_source(snapshots.stats)
+
+# {% cache %} fragments in templates
+fragments.init_app(app)
+# Hidden field of forms that change state, checked with csrf_valid()
+app.jinja_env.globals["csrf_token"] = csrf_token
+
 # Blueprints
 app.register_blueprint(auth_bp)
 app.register_blueprint(action_bp)
@@ -28,73 +56,29 @@ app.register_blueprint(dashboard_bp)
 # Commands
 app.cli.add_command(create_test_data)
 app.cli.add_command(collect_static)
+app.cli.add_command(rebuild_rollups_command)
+app.cli.add_command(db_upgrade)
+app.cli.add_command(explain_queries)
+app.cli.add_command(export_logs)
+app.cli.add_command(import_logs_command)
+app.cli.add_command(property_index)
+app.cli.add_command(archive_logs_command)
+app.cli.add_command(compact_logs_command)
+app.cli.add_command(generate_reports_command)
 
 
 @app.route("/")
 @login_required
-def index():
-    user = current_user()
-    assert user is not None
-
-    actions = db_session.query(Action).filter_by(user_id=user.id).all()
-    activity_data = []
-    total_actions = 0
-
-    # Prepare summary for chart
-    summary_counts = {}
-
-    for action in actions:
-        timeseries = get_activity_timeseries(user.id, action.id, days=30)
-        labels = [entry["date"] for entry in timeseries]
-        values = [entry["delta"] for entry in timeseries]
-        total_actions += sum(values)
-
-        # trend line
-        x = np.arange(len(values))
-        y = np.array(values)
-        if len(values) > 1:
-            slope, intercept = np.polyfit(x, y, 1)
-            trend_line = (intercept + slope * x).tolist()
-        else:
-            trend_line = values
-
-        activity_data.append(
-            {
-                "name": action.name,
-                "values": values,
-                "trend_line": trend_line,
-                "labels": labels,
-            }
-        )
-
-        # accumulate for summary
-        summary_counts[action.name] = sum(values)
-
-    # compute simple trend change
-    if len(activity_data) > 0:
-        first_total = sum(sum(a["values"][:7]) for a in activity_data)
-        last_total = sum(sum(a["values"][-7:]) for a in activity_data)
-        trend_change = (
-            round(((last_total - first_total) / first_total * 100), 1)
-            if first_total
-            else 0
-        )
-    else:
-        trend_change = 0
-
-    # summary chart labels and values
-    summary_labels = list(summary_counts.keys())
-    summary_values = list(summary_counts.values())
-
-    return render_template(
-        "dashboard.j2",
-        activity_data=activity_data,
-        total_actions=total_actions,
-        period="last 30 days",
-        trend_change=trend_change,
-        labels=summary_labels,
-        values=summary_values,
-    )
+def index(user):
+    return render_template("dashboard.j2", **snapshots.dashboard(user.id))
+
+
+@app.before_request
+def keep_loaded_objects():
+    # The session only lives as long as the request, its objects keep their
+    # values after a commit so reading the logged-in user does not load it
+    # again. CLI commands and workers keep expiring them.
+    db_session().expire_on_commit = False
 
 
 @app.teardown_appcontext
@@ -114,6 +98,8 @@ def load_secret(path: Path = Path(".secret")):
 def init():
     load_dotenv()
     print(f"FLASK_ENV: {FLASK_ENV}, DEBUG: {_DEBUG}")
+    # Called in every gunicorn worker, they share invalidations and events
+    broadcast.start()
     app.secret_key = "!DEBUG!"
     if FLASK_ENV == "production":
         try:
@@ -0,0 +1,313 @@
+# archive.py
+"""
+Columnar archive of cold activity logs.
+
+archive_logs() moves logs older than a cutoff out of ActivityLog into one
+directory per action under ARCHIVE_DIR/<user_id>/<action_id>:
+    ids.npy            int64 log ids
+    timestamps.npy     datetime64[us], UTC
+    deltas.npy         int64
+    extras.ndjson.gz   [row, notes, properties] of the rows that have any
+Rows are sorted by timestamp and id, the arrays are memory-mapped on read so
+a range costs two binary searches and only the pages it covers.
+
+The daily rollup keeps counting archived logs, so charts read from it are
+unchanged, and rebuild_rollups adds the archived totals back. Hourly and
+property aggregates and the export read the archive next to the table.
+Archived logs are read only and no longer listed in an action's history.
+"""
+import gzip
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from sqlalchemy import delete, select
+
+import cache
+from database import db_session
+from models import Action, ActivityLog
+
+ARCHIVE_DIR: str = os.getenv("ARCHIVE_DIR", "archive")
+# Rows deleted from ActivityLog per statement once they are archived
+ARCHIVE_DELETE_BATCH = 500
+ARRAYS = ("ids", "timestamps", "deltas")
+EXTRAS_FILE = "extras.ndjson.gz"
+
+
+def to_datetime64(value: datetime) -> np.datetime64:
+    """`value` as a naive UTC datetime64, naive datetimes are UTC."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+
+@dataclass
+class ActionArchive:
+    path: Path
+    ids: np.ndarray
+    timestamps: np.ndarray
+    deltas: np.ndarray
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, start: datetime | None = None, end: datetime | None = None):
+        """Slice of the rows with `start` <= timestamp < `end`."""
+        lo, hi = 0, len(self)
+        if start is not None:
+            lo = int(self.timestamps.searchsorted(to_datetime64(start)))
+        if end is not None:
+            hi = max(lo, int(self.timestamps.searchsorted(to_datetime64(end))))
+        return slice(lo, hi)
+
+    def extras(self, rows: slice = slice(None)):
+        """Yields (row, notes, properties) of the rows in `rows` that have any."""
+        start, stop, _ = rows.indices(len(self))
+        path = self.path / EXTRAS_FILE
+        if start >= stop or not path.exists():
+            return
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                row, notes, properties = json.loads(line)
+                if row >= stop:
+                    return
+                if row >= start:
+                    yield row, notes, properties
+
+
+def _path(user_id: int, action_id: int) -> Path:
+    return Path(ARCHIVE_DIR) / str(user_id) / str(action_id)
+
+
+def load(user_id: int, action_id: int) -> ActionArchive | None:
+    """The archive of an action, None if nothing was archived."""
+    path = _path(user_id, action_id)
+    try:
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r") for name in ARRAYS
+        }
+    except FileNotFoundError:
+        return None
+    return ActionArchive(path, **arrays)
+
+
+def _write(path: Path, ids, timestamps, deltas, extras: dict[int, tuple]):
+    """
+    Writes the arrays and extras into a fresh directory and swaps it in.
+    Readers that mapped the old files keep reading them until they are done.
+    """
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name, values in zip(ARRAYS, (ids, timestamps, deltas)):
+        np.save(tmp / f"{name}.npy", values)
+    if extras:
+        with gzip.open(tmp / EXTRAS_FILE, "wt", encoding="utf-8") as f:
+            for row in sorted(extras):
+                f.write(json.dumps([row, *extras[row]]) + "\n")
+
+    old = path.with_name(f"{path.name}.{os.getpid()}.old")
+    if path.exists():
+        path.rename(old)
+    tmp.rename(path)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def _keys(ids: np.ndarray, timestamps: np.ndarray):
+    return zip(ids.tolist(), timestamps.tolist())
+
+
+def _archive_action(user_id: int, action_id: int, cutoff: datetime) -> int:
+    """Moves the action's logs older than `cutoff` to its archive."""
+    from model_helpers import touch_rollups
+
+    logs = db_session.execute(
+        select(
+            ActivityLog.id,
+            ActivityLog.timestamp,
+            ActivityLog.delta,
+            ActivityLog.notes,
+            ActivityLog.properties,
+        )
+        .where(ActivityLog.action_id == action_id, ActivityLog.timestamp < cutoff)
+        .order_by(ActivityLog.timestamp, ActivityLog.id)
+    ).all()
+    if not logs:
+        return 0
+
+    ids = np.array([log.id for log in logs], dtype=np.int64)
+    timestamps = np.array(
+        [to_datetime64(log.timestamp) for log in logs], dtype="datetime64[us]"
+    )
+    deltas = np.array([log.delta for log in logs], dtype=np.int64)
+    # Extras are keyed by id and timestamp, SQLite can hand out the id of
+    # an archived log again
+    extras = {
+        key: (log.notes or "", log.properties or {})
+        for key, log in zip(_keys(ids, timestamps), logs)
+        if log.notes or log.properties
+    }
+
+    archived = load(user_id, action_id)
+    if archived is not None:
+        # Logs archived by a run that stopped before deleting them come
+        # back from the table, the archived copy is dropped
+        fresh = set(_keys(ids, timestamps))
+        keep = np.array(
+            [key not in fresh for key in _keys(archived.ids, archived.timestamps)],
+            dtype=bool,
+        )
+        for row, notes, properties in archived.extras():
+            if keep[row]:
+                key = (int(archived.ids[row]), archived.timestamps[row].item())
+                extras[key] = (notes, properties)
+        ids = np.concatenate([archived.ids[keep], ids])
+        timestamps = np.concatenate([archived.timestamps[keep], timestamps])
+        deltas = np.concatenate([archived.deltas[keep], deltas])
+        order = np.lexsort((ids, timestamps))
+        ids, timestamps, deltas = ids[order], timestamps[order], deltas[order]
+
+    row_of = {key: row for row, key in enumerate(_keys(ids, timestamps))}
+    _write(
+        _path(user_id, action_id),
+        ids,
+        timestamps,
+        deltas,
+        {row_of[key]: extra for key, extra in extras.items()},
+    )
+
+    # The rows are only deleted once their archive is on disk
+    archived_ids = [log.id for log in logs]
+    for i in range(0, len(archived_ids), ARCHIVE_DELETE_BATCH):
+        batch = archived_ids[i : i + ARCHIVE_DELETE_BATCH]
+        db_session.execute(delete(ActivityLog).where(ActivityLog.id.in_(batch)))
+    # Totals are unchanged but the history lists fewer logs
+    touch_rollups([action_id])
+    db_session.commit()
+    return len(logs)
+
+
+def archive_logs(cutoff: datetime, progress=None) -> dict:
+    """
+    Moves every log older than `cutoff` to the archive, one action at a
+    time. Calls `progress(action, count)` after each action when given.
+    """
+    cutoff = to_datetime64(cutoff).item()
+    actions = db_session.scalars(
+        select(Action)
+        .where(
+            Action.id.in_(
+                select(ActivityLog.action_id).where(ActivityLog.timestamp < cutoff)
+            )
+        )
+        .order_by(Action.user_id, Action.id)
+    ).all()
+
+    result = {"actions": 0, "logs": 0}
+    for action in actions:
+        count = _archive_action(action.user_id, action.id, cutoff)
+        cache.invalidate(action.user_id, action.id)
+        result["actions"] += 1
+        result["logs"] += count
+        if progress is not None:
+            progress(action, count)
+    return result
+
+
+def remove(user_id: int, action_id: int):
+    """Removes the archive of an action."""
+    shutil.rmtree(_path(user_id, action_id), ignore_errors=True)
+
+
+def iter_rows(
+    user_id: int,
+    action_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+):
+    """
+    Yields the archived logs of an action in the range, oldest first, as
+    (timestamp, id, delta, notes, properties) with naive UTC timestamps.
+    """
+    archived = load(user_id, action_id)
+    if archived is None:
+        return
+    rows = archived.rows(start, end)
+    extras = archived.extras(rows)
+    extra = next(extras, None)
+    for row in range(rows.start, rows.stop):
+        notes, properties = "", {}
+        if extra is not None and extra[0] == row:
+            _, notes, properties = extra
+            extra = next(extras, None)
+        yield (
+            archived.timestamps[row].item(),
+            int(archived.ids[row]),
+            int(archived.deltas[row]),
+            notes,
+            properties,
+        )
+
+
+def values(
+    user_id: int,
+    action_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    prop: str | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (timestamps, values) of the archived logs in the range: the
+    deltas, or the numbers stored in property `prop` of the logs having one.
+    """
+    archived = load(user_id, action_id)
+    if archived is None:
+        return np.array([], dtype="datetime64[us]"), np.array([], dtype=float)
+    rows = archived.rows(start, end)
+    if prop is None:
+        return archived.timestamps[rows], archived.deltas[rows]
+
+    found, numbers = [], []
+    for row, _, properties in archived.extras(rows):
+        value = properties.get(prop)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            found.append(row)
+            numbers.append(value)
+    return archived.timestamps[found], np.array(numbers, dtype=float)
+
+
+def bucket_bounds(starts: list[datetime]) -> np.ndarray:
+    """Local bucket starts, aware datetimes, as UTC datetime64 boundaries."""
+    return np.array([to_datetime64(start) for start in starts], dtype="datetime64[us]")
+
+
+def daily_totals(
+    user_id: int, action_id: int, tz: str
+) -> dict[tuple[int, date], tuple[int, int]]:
+    """
+    Archived delta sums and log counts per local day in zone `tz`, in the
+    form update_rollups takes.
+    """
+    archived = load(user_id, action_id)
+    if archived is None or not len(archived):
+        return {}
+    zone = ZoneInfo(tz)
+    first = archived.timestamps[0].item().replace(tzinfo=timezone.utc)
+    last = archived.timestamps[-1].item().replace(tzinfo=timezone.utc)
+    first, last = first.astimezone(zone).date(), last.astimezone(zone).date()
+    days = [first + timedelta(days=i) for i in range((last - first).days + 2)]
+    bounds = bucket_bounds([datetime.combine(day, time(), zone) for day in days])
+
+    cols = bounds.searchsorted(archived.timestamps, side="right") - 1
+    sums = np.zeros(len(days), dtype=np.int64)
+    np.add.at(sums, cols, archived.deltas)
+    counts = np.bincount(cols, minlength=len(days))
+    return {
+        (action_id, days[i]): (int(sums[i]), int(counts[i]))
+        for i in np.flatnonzero(counts)
+    }
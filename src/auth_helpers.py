@@ -1,102 +1,238 @@
-from datetime import datetime, timezone
+import hashlib
+import hmac
+import os
+import secrets
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from flask import session, redirect, url_for, flash, request, jsonify
-from models import User
+from flask import g, session, redirect, url_for, flash, request, jsonify
+from sqlalchemy import delete
+from models import ApiToken, User
 from database import db_session
+from cache import LRUCache, user_tag
+import broadcast
+import timezones
+
+# Validated tokens are kept in process so API calls need no DB lookup
+TOKEN_CACHE_SIZE: int = int(os.getenv("TOKEN_CACHE_SIZE", 4096))
+TOKEN_CACHE_TTL: int = int(os.getenv("TOKEN_CACHE_TTL", 300))
+DEFAULT_TOKEN_SCOPES = "read write"
+TOKEN_SCOPES = ("read", "write")
+MAX_TOKEN_DAYS = 365
+# Form field of the session's CSRF token, sent by forms that change state
+CSRF_FIELD = "csrf_token"
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+# Header the pages' scripts send when calling the API with the session
+# cookie. Cross-site forms cannot set it and cross-site scripts need a CORS
+# preflight the app never grants.
+SESSION_API_HEADER = ("X-Requested-With", "fetch")
+
+_token_cache = LRUCache(maxsize=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+
+@dataclass(frozen=True)
+class TokenUser:
+    """The user behind a validated API token, as handed to API views."""
+
+    id: int
+    token_id: int
+    scopes: frozenset[str]
+    expires_at: datetime
 
 
 def current_user():
-    """Returns the currently logged-in user object, or None."""
-    user_id = session.get("user_id")
-    if user_id:
-        return db_session.query(User).filter_by(id=user_id).first()
-    # Ensure the user actually exists in the DB
-    user = db_session.query(User).filter_by(id=user_id).first()
-    if user is None:
-        # Session refers to a stale or invalid user
-        session.clear()
-        return None
-    return user
+    """
+    Returns the currently logged-in user object, or None.
+    The user is looked up once per request and kept on flask.g
+    """
+    if "user" not in g:
+        user_id = session.get("user_id")
+        g.user = db_session.get(User, user_id) if user_id else None
+        if g.user is not None:
+            timezones.remember(g.user)
+    return g.user
 
 
 def login_required(view_func):
-    """Decorator to ensure the user is logged in before accessing a route."""
+    """
+    Decorator to ensure the user is logged in before accessing a route.
+    The logged-in user is passed to the view as its first argument.
+    """
 
     @wraps(view_func)
     def wrapped_view(*args, **kwargs):
-        user_id = session.get("user_id")
-        if not user_id:
+        if not session.get("user_id"):
             flash("Please log in first", "error")
             return redirect(url_for("auth.login"))
 
         # Ensure the user actually exists in the DB
-        user = db_session.query(User).filter_by(id=user_id).first()
+        user = current_user()
         if user is None:
             # Session refers to a stale or invalid user
             session.clear()
             flash("Your session has expired. Please log in again.", "warning")
             return redirect(url_for("auth.login"))
 
-        return view_func(*args, **kwargs)
+        return view_func(user, *args, **kwargs)
 
     return wrapped_view
 
 
-def user_from_token():
-    """Returns the user of the supplied API token if it's valid, or None."""
-    auth_header = request.headers.get("Authorization")
-    if not auth_header:
-        return None
-    try:
-        token_type, token = auth_header.split()
-        if token_type.lower() != "bearer":
-            return None
+def csrf_token() -> str:
+    """The CSRF token of the session, created on first use."""
+    token = session.get(CSRF_FIELD)
+    if token is None:
+        token = session[CSRF_FIELD] = secrets.token_hex(16)
+    return token
 
-        user = db_session.query(User).filter_by(api_token=token).first()
-        if not user or not user.token_expiry:
-            return None
 
-        # Convert token_expiry to aware UTC datetime if it's naive
-        token_expiry = user.token_expiry
-        if token_expiry.tzinfo is None:
-            token_expiry = token_expiry.replace(tzinfo=timezone.utc)
+def csrf_valid() -> bool:
+    """Whether the submitted form carries the session's CSRF token."""
+    expected = session.get(CSRF_FIELD)
+    given = request.form.get(CSRF_FIELD, "")
+    return expected is not None and hmac.compare_digest(given, expected)
 
-        if token_expiry > datetime.now(timezone.utc):
-            return user
 
-        return None
-    except ValueError:
-        return None
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
-def token_required(view_func):
-    """Decorator to ensure the token is valid before accessing an API endpoint."""
+def issue_token(
+    user_id: int, days: int = 30, scopes: str = DEFAULT_TOKEN_SCOPES, rotate=True
+) -> str:
+    """
+    Creates a new API token for the user and returns it, only its digest is
+    stored. With `rotate` the user's other tokens are revoked. `days` is
+    clamped to 1..MAX_TOKEN_DAYS, unknown scopes raise ValueError.
+    """
+    names = set(scopes.split())
+    if not names or not names <= set(TOKEN_SCOPES):
+        raise ValueError(f"Scopes must be some of: {', '.join(TOKEN_SCOPES)}")
+    scopes = " ".join(scope for scope in TOKEN_SCOPES if scope in names)
+    days = min(max(1, days), MAX_TOKEN_DAYS)
 
-    @wraps(view_func)
-    def wrapped_view(*args, **kwargs):
-        auth_header = request.headers.get("Authorization")
-        if not auth_header:
-            return jsonify({"error": "Authorization header missing"}), 401
+    if rotate:
+        db_session.execute(delete(ApiToken).where(ApiToken.user_id == user_id))
+
+    token = secrets.token_hex(16)
+    db_session.add(
+        ApiToken(
+            user_id=user_id,
+            token_hash=hash_token(token),
+            scopes=scopes,
+            expires_at=datetime.now(timezone.utc) + timedelta(days=days),
+        )
+    )
+    db_session.commit()
+    invalidate_tokens(user_id)
+    return token
+
+
+def revoke_token(user_id: int, token_id: int) -> bool:
+    """Deletes one of the user's tokens, returns False if it does not exist."""
+    deleted = db_session.execute(
+        delete(ApiToken).where(ApiToken.id == token_id, ApiToken.user_id == user_id)
+    ).rowcount
+    db_session.commit()
+    invalidate_tokens(user_id)
+    return bool(deleted)
+
+
+def invalidate_tokens(user_id: int):
+    """Drops the cached tokens of a user, call after changing their tokens."""
+    broadcast.publish("tokens", user_id)
+
+
+def _drop_tokens(user_id: int):
+    _token_cache.invalidate([user_tag(user_id)])
+
+
+broadcast.subscribe("tokens", _drop_tokens)
+
+
+def _lookup_token(token: str) -> TokenUser | None:
+    token_hash = hash_token(token)
+    user = _token_cache.get(token_hash)
+    if user is None:
+        row = db_session.query(ApiToken).filter_by(token_hash=token_hash).first()
+        if row is None:
+            return None
+
+        # Convert expires_at to aware UTC datetime if naive
+        expires_at = row.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+
+        user = TokenUser(row.user_id, row.id, frozenset(row.scopes.split()), expires_at)
+        _token_cache.set(token_hash, user, [user_tag(row.user_id)])
+    return user
+
+
+def _authenticate_token():
+    """
+    Resolves the bearer token of the request once and caches it on flask.g.
+    Returns a (user, error) tuple where exactly one of them is None.
+    """
+    if "api_user" in g:
+        return g.api_user, g.api_error
+
+    user, error = None, None
+    auth_header = request.headers.get("Authorization")
+    if not auth_header:
+        error = "Authorization header missing"
+    else:
         try:
             token_type, token = auth_header.split()
             if token_type.lower() != "bearer":
-                return jsonify({"error": "Invalid token type"}), 401
+                error = "Invalid token type"
+            else:
+                user = _lookup_token(token)
+        except ValueError:
+            error = "Invalid Authorization header"
 
-            user = db_session.query(User).filter_by(api_token=token).first()
-            if not user or not user.token_expiry:
-                return jsonify({"error": "Invalid or expired token"}), 401
+        if error is None:
+            scope = "read" if request.method in READ_METHODS else "write"
+            if user is None or user.expires_at < datetime.now(timezone.utc):
+                user, error = None, "Invalid or expired token"
+            elif scope not in user.scopes:
+                user, error = None, f"Token lacks the '{scope}' scope"
 
-            # Convert token_expiry to aware UTC datetime if naive
-            token_expiry = user.token_expiry
-            if token_expiry.tzinfo is None:
-                token_expiry = token_expiry.replace(tzinfo=timezone.utc)
+    g.api_user, g.api_error = user, error
+    return user, error
 
-            if token_expiry < datetime.now(timezone.utc):
-                return jsonify({"error": "Invalid or expired token"}), 401
 
-        except ValueError:
-            return jsonify({"error": "Invalid Authorization header"}), 401
+def user_from_token():
+    """Returns the user of the supplied API token if it's valid, or None."""
+    user, _ = _authenticate_token()
+    return user
+
+
+def token_required(view_func):
+    """
+    Decorator to ensure the token is valid before accessing an API endpoint.
+    The token's user is passed to the view as its first argument. Requests
+    of a logged-in browser session without an Authorization header, such as
+    the delete buttons of the pages, are let through as that user only when
+    they carry SESSION_API_HEADER and do not come from another site.
+    """
+
+    @wraps(view_func)
+    def wrapped_view(*args, **kwargs):
+        name, value = SESSION_API_HEADER
+        if (
+            "Authorization" not in request.headers
+            and request.headers.get(name) == value
+            and request.headers.get("Sec-Fetch-Site", "same-origin") == "same-origin"
+            and session.get("user_id")
+        ):
+            user = current_user()
+            if user is not None:
+                return view_func(user, *args, **kwargs)
+
+        user, error = _authenticate_token()
+        if user is None:
+            return jsonify({"error": error}), 401
 
-        return view_func(*args, **kwargs)
+        return view_func(user, *args, **kwargs)
 
     return wrapped_view
@@ -0,0 +1,8 @@
+"""
+Synthetic datasets and repeatable benchmarks for ActivTracker.
+
+Point DATABASE_URL at a scratch database before using it, e.g.
+    DATABASE_URL=sqlite:///bench.sqlite3 python -m bench generate --users 10000
+    DATABASE_URL=sqlite:///bench.sqlite3 python -m bench run --output before.json
+    DATABASE_URL=sqlite:///bench.sqlite3 python -m bench load --workers 1 2 4
+"""
@@ -0,0 +1,74 @@
+# bench/__main__.py
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from bench.dataset import generate_dataset
+from bench.load import run_load
+from bench.runner import run_benchmarks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m bench", description="ActivTracker benchmarks"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Create a synthetic dataset")
+    generate.add_argument("--users", type=int, default=100)
+    generate.add_argument("--actions", type=int, default=5, help="actions per user")
+    generate.add_argument("--days", type=int, default=365)
+    generate.add_argument("--logs-per-day", type=float, default=3.0)
+    generate.add_argument("--seed", type=int, default=0)
+
+    run = commands.add_parser("run", help="Run the request benchmarks")
+    run.add_argument("--iterations", type=int, default=200)
+    run.add_argument("--users", type=int, default=20, help="bench users to sample")
+    run.add_argument("--only", nargs="*", help="scenario names to run")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--output", "-o", type=Path, help="write JSON here")
+
+    load = commands.add_parser(
+        "load", help="Measure HTTP throughput of gunicorn per worker count"
+    )
+    load.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    load.add_argument("--clients", type=int, default=8, help="client processes")
+    load.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    load.add_argument("--users", type=int, default=20, help="bench users to sample")
+    load.add_argument("--write-ratio", type=float, default=0.1)
+    load.add_argument("--worker-class", default="gevent")
+    load.add_argument("--seed", type=int, default=0)
+    load.add_argument("--output", "-o", type=Path, help="write JSON here")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        result = generate_dataset(
+            args.users, args.actions, args.days, args.logs_per_day, seed=args.seed
+        )
+    elif args.command == "load":
+        result = run_load(
+            args.workers,
+            args.clients,
+            args.duration,
+            args.users,
+            args.write_ratio,
+            args.worker_class,
+            seed=args.seed,
+        )
+    else:
+        result = run_benchmarks(args.iterations, args.users, args.only, seed=args.seed)
+
+    output = json.dumps(result, indent=2)
+    if getattr(args, "output", None):
+        args.output.write_text(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,132 @@
+# bench/dataset.py
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from sqlalchemy import func, insert, select
+from werkzeug.security import generate_password_hash
+
+from database import db_session, init_db
+from auth_helpers import hash_token
+from models import Action, ActivityLog, ApiToken, User
+from model_helpers import rebuild_rollups
+
+BENCH_PREFIX = "bench"
+BENCH_PASSWORD = "bench"
+
+
+def bench_token(username: str) -> str:
+    """API token of a bench user, derived from the name so runs can rebuild it"""
+    return f"{username}-token"
+
+
+def generate_dataset(
+    users: int = 100,
+    actions_per_user: int = 5,
+    days: int = 365,
+    logs_per_day: float = 3.0,
+    batch_size: int = 50_000,
+    seed: int = 0,
+) -> dict:
+    """
+    Creates `users` users named bench-<n> with their actions and a Poisson
+    distributed number of logs per action and day, using Core executemany
+    inserts. Rollups are rebuilt once at the end. Returns dataset statistics.
+    """
+    init_db()
+    rng = np.random.default_rng(seed)
+    started = time.perf_counter()
+
+    # Continue numbering after any bench users created before
+    offset = db_session.scalar(
+        select(func.count(User.id)).where(User.username.like(f"{BENCH_PREFIX}-%"))
+    )
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    expiry = now + timedelta(days=365)
+    first_day = now - timedelta(days=days)
+
+    user_rows = [
+        {
+            "username": f"{BENCH_PREFIX}-{offset + i}",
+            "password_hash": password_hash,
+            "created_at": now,
+        }
+        for i in range(users)
+    ]
+    db_session.execute(insert(User), user_rows)
+    users_by_name = dict(
+        db_session.execute(
+            select(User.username, User.id).where(
+                User.username.in_([u["username"] for u in user_rows])
+            )
+        ).all()
+    )
+    user_ids = list(users_by_name.values())
+    db_session.execute(
+        insert(ApiToken),
+        [
+            {
+                "user_id": user_id,
+                "token_hash": hash_token(bench_token(username)),
+                "scopes": "read write",
+                "created_at": now,
+                "expires_at": expiry,
+            }
+            for username, user_id in users_by_name.items()
+        ],
+    )
+
+    action_rows = [
+        {
+            "user_id": user_id,
+            "name": f"{BENCH_PREFIX} {user_id} action {j}",
+            "notes": "",
+            "properties": {},
+        }
+        for user_id in user_ids
+        for j in range(actions_per_user)
+    ]
+    db_session.execute(insert(Action), action_rows)
+    action_ids = np.array(
+        db_session.scalars(
+            select(Action.id).where(Action.user_id.in_(user_ids)).order_by(Action.id)
+        ).all()
+    )
+    db_session.commit()
+
+    # Logs are generated per chunk of actions so memory stays bounded
+    log_count = 0
+    per_action = max(1, int(batch_size // max(days * logs_per_day, 1)))
+    for chunk in np.array_split(action_ids, max(1, len(action_ids) // per_action)):
+        counts = rng.poisson(logs_per_day, size=(len(chunk), days))
+        action_col = np.repeat(np.repeat(chunk, days), counts.ravel())
+        day_col = np.repeat(np.tile(np.arange(days), len(chunk)), counts.ravel())
+        seconds = day_col * 86400 + rng.integers(0, 86400, size=len(day_col))
+        deltas = rng.integers(1, 5, size=len(day_col))
+
+        db_session.execute(
+            insert(ActivityLog),
+            [
+                {
+                    "action_id": int(action_id),
+                    "timestamp": first_day + timedelta(seconds=int(second)),
+                    "delta": int(delta),
+                    "notes": "",
+                    "properties": {},
+                }
+                for action_id, second, delta in zip(action_col, seconds, deltas)
+            ],
+        )
+        db_session.commit()
+        log_count += len(action_col)
+
+    rebuild_rollups()
+
+    return {
+        "users": users,
+        "actions": len(action_ids),
+        "logs": log_count,
+        "days": days,
+        "seconds": round(time.perf_counter() - started, 2),
+    }
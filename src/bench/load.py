@@ -0,0 +1,182 @@
+# bench/load.py
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from bench.runner import _bench_users, _git_revision, _summarize
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+
+def _load_scenarios():
+    """(name, method, url builder, JSON body or None), the last one writes"""
+    return [
+        ("api_summary", "GET", lambda a: "/api/summary?period=month", None),
+        (
+            "api_aggregate",
+            "GET",
+            lambda a: f"/api/aggregate?resolution=day&range=30d&action_id={a}",
+            None,
+        ),
+        ("api_list_logs", "GET", lambda a: f"/api/actions/{a}/logs", None),
+        ("api_add_log", "POST", lambda a: f"/api/actions/{a}/logs", {"delta": 1}),
+    ]
+
+
+def _client(
+    port: int,
+    users: list[dict],
+    duration: float,
+    warmup: float,
+    write_ratio: float,
+    seed: int,
+) -> tuple[list[float], int]:
+    """
+    Sends requests over one keep-alive connection until `duration` seconds
+    after the warmup passed, returns the latencies in ms and the error count.
+    """
+    rng = random.Random(seed)
+    *reads, write = _load_scenarios()
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies = []
+    errors = 0
+    measure_from = time.monotonic() + warmup
+    deadline = measure_from + duration
+
+    while (now := time.monotonic()) < deadline:
+        user = rng.choice(users)
+        action_id = rng.choice(user["action_ids"])
+        scenario = write if rng.random() < write_ratio else rng.choice(reads)
+        _, method, url, body = scenario
+        headers = {"Authorization": f"Bearer {user['token']}"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+            body = json.dumps(body)
+
+        started = time.perf_counter()
+        try:
+            connection.request(method, url(action_id), body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            failed = True
+        if now >= measure_from:
+            if failed:
+                errors += 1
+            else:
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    connection.close()
+    return latencies, errors
+
+
+def _start_server(workers: int, port: int, worker_class: str, env: dict):
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            f"--worker-class={worker_class}",
+            f"--workers={workers}",
+            f"--bind=127.0.0.1:{port}",
+            "app:init()",
+        ],
+        cwd=SRC_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            # Give every worker the time to boot, not just the first one
+            time.sleep(1 + workers * 0.5)
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn did not start within 30 seconds")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_load(
+    workers: list[int],
+    clients: int = 8,
+    duration: float = 10.0,
+    users: int = 20,
+    write_ratio: float = 0.1,
+    worker_class: str = "gevent",
+    warmup: float = 1.0,
+    seed: int = 0,
+) -> dict:
+    """
+    Starts gunicorn with each number of `workers` in turn and drives it with
+    `clients` concurrent client processes for `duration` seconds, a share of
+    `write_ratio` of the requests adding logs. Returns throughput and
+    latencies per worker count and the speedup over the first count.
+    """
+    sample = [u for u in _bench_users(users, seed) if u["action_ids"]]
+    results = {}
+
+    for count in workers:
+        env = dict(os.environ)
+        if count > 1:
+            env.setdefault("BROADCAST_BACKEND", "unix")
+        env.setdefault("BROADCAST_PATH", tempfile.mkdtemp(prefix="bench-broadcast-"))
+        port = _free_port()
+        server = _start_server(count, port, worker_class, env)
+        try:
+            with ProcessPoolExecutor(clients) as pool:
+                futures = [
+                    pool.submit(
+                        _client, port, sample, duration, warmup, write_ratio, seed + i
+                    )
+                    for i in range(clients)
+                ]
+                latencies, errors = [], 0
+                for future in futures:
+                    client_latencies, client_errors = future.result()
+                    latencies.extend(client_latencies)
+                    errors += client_errors
+        finally:
+            server.terminate()
+            server.wait()
+
+        if not latencies:
+            raise RuntimeError(f"No successful requests with {count} workers")
+        results[str(count)] = {**_summarize(latencies, duration), "errors": errors}
+
+    base = results[str(workers[0])]["throughput_rps"]
+    return {
+        "revision": _git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "cpus": os.cpu_count(),
+        "clients": clients,
+        "duration": duration,
+        "write_ratio": write_ratio,
+        "worker_class": worker_class,
+        "results": results,
+        "speedup": {
+            count: round(result["throughput_rps"] / base, 2)
+            for count, result in results.items()
+        },
+    }
@@ -0,0 +1,160 @@
+# bench/runner.py
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from database import db_session
+from models import Action, User
+from bench.dataset import BENCH_PASSWORD, BENCH_PREFIX, bench_token
+
+
+def _bench_users(sample: int, seed: int) -> list[dict]:
+    """Picks `sample` bench users with their action ids and API token."""
+    users = db_session.execute(
+        select(User.id, User.username).where(
+            User.username.like(f"{BENCH_PREFIX}-%")
+        )
+    ).all()
+    if not users:
+        raise RuntimeError("No bench users found, run `python -m bench generate` first")
+
+    picked = random.Random(seed).sample(users, min(sample, len(users)))
+    result = []
+    for user_id, username in picked:
+        action_ids = db_session.scalars(
+            select(Action.id).where(Action.user_id == user_id)
+        ).all()
+        result.append(
+            {
+                "username": username,
+                "token": bench_token(username),
+                "action_ids": action_ids,
+            }
+        )
+    db_session.remove()
+    return result
+
+
+def _scenarios():
+    """(name, method, url builder, request kwargs builder) for every benchmark"""
+    return [
+        ("index", "get", lambda u, a: "/", lambda u: {}),
+        (
+            "activity_summary",
+            "get",
+            lambda u, a: f"/dashboard/summary/activity?action_id={a}&days=30",
+            lambda u: {},
+        ),
+        (
+            "view_action_history",
+            "get",
+            lambda u, a: f"/actions/{a}",
+            lambda u: {},
+        ),
+        (
+            "api_summary",
+            "get",
+            lambda u, a: "/api/summary?period=month",
+            lambda u: {"headers": {"Authorization": f"Bearer {u['token']}"}},
+        ),
+        (
+            "log_activity",
+            "post",
+            lambda u, a: f"/actions/{a}/log",
+            lambda u: {"data": {"delta": "1"}},
+        ),
+        (
+            "api_add_log",
+            "post",
+            lambda u, a: f"/api/actions/{a}/logs",
+            lambda u: {
+                "json": {"delta": 1},
+                "headers": {"Authorization": f"Bearer {u['token']}"},
+            },
+        ),
+    ]
+
+
+def _summarize(latencies: list[float], elapsed: float) -> dict:
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    return {
+        "requests": len(latencies),
+        "mean_ms": round(statistics.fmean(latencies), 3),
+        "p50_ms": round(percentile(50), 3),
+        "p95_ms": round(percentile(95), 3),
+        "p99_ms": round(percentile(99), 3),
+        "max_ms": round(latencies[-1], 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+    }
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    iterations: int = 200,
+    users: int = 20,
+    only: list[str] | None = None,
+    warmup: int = 10,
+    seed: int = 0,
+) -> dict:
+    """
+    Replays every scenario `iterations` times through Flask's test client,
+    spread over a sample of bench users, and returns latency statistics.
+    """
+    from app import app
+
+    app.secret_key = app.secret_key or "bench"
+    rng = random.Random(seed)
+    sample = [u for u in _bench_users(users, seed) if u["action_ids"]]
+
+    # One logged in client per user
+    clients = []
+    for user in sample:
+        client = app.test_client()
+        client.post(
+            "/login", data={"username": user["username"], "password": BENCH_PASSWORD}
+        )
+        clients.append((client, user))
+
+    results = {}
+    for name, method, url, kwargs in _scenarios():
+        if only and name not in only:
+            continue
+
+        latencies = []
+        elapsed = 0.0
+        for i in range(warmup + iterations):
+            client, user = rng.choice(clients)
+            action_id = rng.choice(user["action_ids"])
+            started = time.perf_counter()
+            response = getattr(client, method)(url(user, action_id), **kwargs(user))
+            duration = time.perf_counter() - started
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name}: HTTP {response.status_code}")
+            if i >= warmup:
+                latencies.append(duration * 1000)
+                elapsed += duration
+        results[name] = _summarize(latencies, elapsed)
+
+    return {
+        "revision": _git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "iterations": iterations,
+        "users": len(clients),
+        "results": results,
+    }
@@ -0,0 +1,200 @@
+# broadcast.py
+"""
+Messages between the worker processes serving the app.
+
+State kept in process, the response and token caches, the time zone cache
+and the live feed, has to hear about writes handled by any worker. Writes
+publish a message on a topic and every process runs the handlers subscribed
+to it, the publishing one right away. The transport is picked with
+BROADCAST_BACKEND:
+    local   this process only, for a single worker (default)
+    unix    datagrams to a socket per process in the directory BROADCAST_PATH
+    redis   pub/sub on a local Redis compatible server at BROADCAST_URL
+
+Delivery to other processes is best effort: a message a worker cannot take
+is dropped with a warning, cached entries then expire after their TTL.
+"""
+import atexit
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_BACKEND: str = os.getenv("BROADCAST_BACKEND", "local")
+BROADCAST_PATH: str = os.getenv(
+    "BROADCAST_PATH", str(Path(tempfile.gettempdir()) / "activitytracker")
+)
+BROADCAST_URL: str = os.getenv(
+    "BROADCAST_URL", os.getenv("CACHE_URL", "redis://localhost:6379/0")
+)
+# Largest message sent to other processes, in bytes
+BROADCAST_MAX_MESSAGE: int = 64 * 1024
+
+
+class LocalBroadcast:
+    """Runs the handlers of this process only."""
+
+    shared = False
+
+    def __init__(self):
+        self._handlers: dict[str, list] = {}
+        self._pid = None
+
+    def subscribe(self, topic: str, handler):
+        self._handlers.setdefault(topic, []).append(handler)
+
+    def publish(self, topic: str, data):
+        for handler in self._handlers.get(topic, ()):
+            handler(data)
+        if self.shared:
+            payload = json.dumps(
+                {"origin": os.getpid(), "topic": topic, "data": data}
+            ).encode()
+            if len(payload) > BROADCAST_MAX_MESSAGE:
+                logger.error("Not broadcasting %d bytes on '%s'", len(payload), topic)
+            else:
+                self._send(payload)
+
+    def start(self):
+        """Starts receiving messages of other processes, once per process."""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._listen()
+
+    def _listen(self):
+        pass
+
+    def _send(self, payload: bytes):
+        pass
+
+    def _receive(self, payload: bytes):
+        try:
+            message = json.loads(payload)
+            if message["origin"] == os.getpid():
+                return
+            for handler in self._handlers.get(message["topic"], ()):
+                handler(message["data"])
+        except Exception:
+            logger.exception("Failed to handle a broadcast message")
+
+    def _run(self, target, *args):
+        # A greenlet when gevent has patched threading
+        thread = threading.Thread(
+            target=target, args=args, name="broadcast", daemon=True
+        )
+        thread.start()
+
+
+class UnixBroadcast(LocalBroadcast):
+    """
+    Every process binds a datagram socket named after its pid in `path` and a
+    message is sent to all sockets found there. Sockets of processes that are
+    gone are removed by the first sender that finds them refusing.
+    """
+
+    shared = True
+
+    def __init__(self, path: str = BROADCAST_PATH):
+        super().__init__()
+        self.path = Path(path)
+        self._sender = None
+        self._sender_pid = None
+
+    def _listen(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        address = self.path / f"{os.getpid()}.sock"
+        address.unlink(missing_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(str(address))
+        atexit.register(address.unlink, missing_ok=True)
+        self._run(self._recv_loop, sock)
+
+    def _recv_loop(self, sock):
+        while True:
+            self._receive(sock.recv(BROADCAST_MAX_MESSAGE))
+
+    def _send(self, payload):
+        if self._sender_pid != os.getpid():
+            # Never block a request on a worker that does not read its socket
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+            self._sender_pid = os.getpid()
+
+        own = f"{os.getpid()}.sock"
+        for address in self.path.glob("*.sock"):
+            if address.name == own:
+                continue
+            try:
+                self._sender.sendto(payload, str(address))
+            except (ConnectionRefusedError, FileNotFoundError):
+                address.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning("Dropped broadcast to %s: %s", address.name, e)
+
+
+class RedisBroadcast(LocalBroadcast):
+    """Pub/sub on one channel of a Redis compatible server."""
+
+    shared = True
+    channel = "activitytracker:broadcast"
+
+    def __init__(self, url: str = BROADCAST_URL):
+        super().__init__()
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(
+                "BROADCAST_BACKEND=redis requires the redis package"
+            ) from e
+        self.client = redis.Redis.from_url(url)
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        self._run(self._recv_loop, pubsub)
+
+    def _recv_loop(self, pubsub):
+        for message in pubsub.listen():
+            self._receive(message["data"])
+
+    def _send(self, payload):
+        try:
+            self.client.publish(self.channel, payload)
+        except Exception as e:
+            logger.warning("Dropped broadcast: %s", e)
+
+
+def _create_backend() -> LocalBroadcast:
+    if BROADCAST_BACKEND == "unix":
+        return UnixBroadcast()
+    if BROADCAST_BACKEND == "redis":
+        return RedisBroadcast()
+    return LocalBroadcast()
+
+
+backend = _create_backend()
+
+
+def shared() -> bool:
+    """Whether other processes receive the messages."""
+    return backend.shared
+
+
+def subscribe(topic: str, handler):
+    """Calls `handler(data)` for every message published on `topic`."""
+    backend.subscribe(topic, handler)
+
+
+def publish(topic: str, data):
+    """Delivers JSON serializable `data` to the handlers of `topic` everywhere."""
+    backend.publish(topic, data)
+
+
+def start():
+    """Starts receiving messages, call in every worker process."""
+    backend.start()
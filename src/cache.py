@@ -0,0 +1,215 @@
+# cache.py
+"""
+Response cache for computed summaries.
+
+Entries are tagged with the user and/or action they were computed from and
+the write paths drop them with invalidate() as soon as a log of that user or
+action changes. Invalidations are broadcast to the other workers, which also
+bump their data version of every invalidated tag, see version(). The
+backend is picked with CACHE_BACKEND:
+    memory  in-process LRU with a TTL (default)
+    redis   a local Redis compatible server at CACHE_URL, needs `redis`
+    none    caching disabled
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+import broadcast
+
+CACHE_BACKEND: str = os.getenv("CACHE_BACKEND", "memory")
+CACHE_URL: str = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_TTL: int = int(os.getenv("CACHE_TTL", 60))
+CACHE_MAX_ENTRIES: int = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+
+
+@dataclass
+class CacheEntry:
+    value: object
+    etag: str
+    last_modified: datetime
+
+
+class NullCache:
+    # Whether every process sees the same entries
+    shared = False
+
+    def get(self, key: str) -> CacheEntry | None:
+        return None
+
+    def set(self, key: str, entry: CacheEntry, tags: list[str]):
+        pass
+
+    def invalidate(self, tags: list[str]):
+        pass
+
+
+class LRUCache(NullCache):
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int = CACHE_MAX_ENTRIES, ttl: int = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, entry, tags)
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return item[1]
+
+    def set(self, key, entry, tags):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, entry, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._remove(key)
+
+    def _remove(self, key):
+        item = self._entries.pop(key, None)
+        if item is None:
+            return
+        for tag in item[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisCache(NullCache):
+    """Cache stored on a Redis compatible server, shared by every process."""
+
+    shared = True
+
+    def __init__(self, url: str = CACHE_URL, ttl: int = CACHE_TTL):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("CACHE_BACKEND=redis requires the redis package") from e
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        raw = self.client.get(f"cache:{key}")
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return CacheEntry(
+            data["value"], data["etag"], datetime.fromisoformat(data["last_modified"])
+        )
+
+    def set(self, key, entry, tags):
+        data = {
+            "value": entry.value,
+            "etag": entry.etag,
+            "last_modified": entry.last_modified.isoformat(),
+        }
+        pipe = self.client.pipeline()
+        pipe.set(f"cache:{key}", json.dumps(data), ex=self.ttl)
+        for tag in tags:
+            pipe.sadd(f"cache-tag:{tag}", f"cache:{key}")
+            pipe.expire(f"cache-tag:{tag}", self.ttl)
+        pipe.execute()
+
+    def invalidate(self, tags):
+        for tag in tags:
+            keys = self.client.smembers(f"cache-tag:{tag}")
+            self.client.delete(f"cache-tag:{tag}", *keys)
+
+
+def _create_backend() -> NullCache:
+    if CACHE_BACKEND == "redis":
+        return RedisCache()
+    if CACHE_BACKEND == "none":
+        return NullCache()
+    return LRUCache()
+
+
+backend = _create_backend()
+
+# Data version of every invalidated tag in this process, keys built from
+# them are never stale and need no invalidation
+_versions: dict[str, int] = {}
+_versions_lock = threading.Lock()
+
+
+def _invalidated(tags: list[str]):
+    with _versions_lock:
+        for tag in tags:
+            _versions[tag] = _versions.get(tag, 0) + 1
+    if not backend.shared:
+        backend.invalidate(tags)
+
+
+broadcast.subscribe("cache", _invalidated)
+
+
+def user_tag(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+def action_tag(action_id: int) -> str:
+    return f"action:{action_id}"
+
+
+def cached(key: str, tags: list[str], compute) -> CacheEntry:
+    """
+    Returns the entry stored under `key`, or calls `compute()` and stores its
+    JSON serializable result tagged with `tags`.
+    """
+    entry = backend.get(key)
+    if entry is None:
+        value = compute()
+        payload = json.dumps(value, sort_keys=True, default=str).encode()
+        entry = CacheEntry(
+            value=value,
+            etag=hashlib.sha1(payload).hexdigest(),
+            last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+        )
+        backend.set(key, entry, tags)
+    return entry
+
+
+def version(tag: str) -> int:
+    """Number of times `tag` was invalidated since this process started."""
+    return _versions.get(tag, 0)
+
+
+def invalidate_tags(tags: list[str]):
+    """Drops every entry tagged with one of `tags` and bumps their versions."""
+    if backend.shared:
+        backend.invalidate(tags)
+    broadcast.publish("cache", tags)
+
+
+def invalidate(user_id: int, action_id: int | None = None):
+    """Drops every entry computed from data of `user_id` or `action_id`."""
+    tags = [user_tag(user_id)]
+    if action_id is not None:
+        tags.append(action_tag(action_id))
+    invalidate_tags(tags)
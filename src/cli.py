@@ -2,25 +2,117 @@
 import click
 import os
 import shutil
+from datetime import datetime, timezone
 
-from database import db_session
-from models import User
+from sqlalchemy import event
+
+from aggregation import (
+    create_property_index,
+    drop_property_index,
+    parse_range,
+    property_indexes,
+)
+from archive import ARCHIVE_DIR, archive_logs
+from compaction import compact_logs
+from database import db_session, engine
+from export import EXPORT_FORMATS, iter_logs, parse_date_range, stream_export
+from importer import (
+    IMPORT_CHUNK_SIZE,
+    Checkpoint,
+    format_from_path,
+    import_logs,
+    iter_records,
+)
+from migrations import upgrade_db
+from models import Action, User
+from reports import REPORT_CHUNK_SIZE, REPORT_DIR, REPORT_FORMATS, generate_reports
 from utils import generate_fake_data
+from model_helpers import (
+    get_activity_matrix,
+    get_activity_timeseries,
+    get_logs_page,
+    rebuild_rollups,
+    summarize_actions,
+)
 
 
 @click.command("create-test-data")
 @click.argument("username")
 @click.argument("actions", default=3)
 @click.argument("days", default=30)
-def create_test_data(username, actions=3, days=30):
+@click.argument("logs_per_day", default=1)
+def create_test_data(username, actions=3, days=30, logs_per_day=1):
     """Generate fake actions/logs for a user."""
     user = db_session.query(User).filter_by(username=username).first()
     if not user:
         print(f"User {username} not found")
         return
-    generate_fake_data(user.id, actions, days)
+    generate_fake_data(user.id, actions, days, logs_per_day)
     print(f"Fake data generated for {username}")
 
+
+@click.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute the daily rollup table from the activity logs."""
+    rebuild_rollups()
+    click.echo("Daily rollups rebuilt")
+
+
+@click.command("db-upgrade")
+def db_upgrade():
+    """Apply pending schema migrations to the database."""
+    applied = upgrade_db()
+    for version, description in applied:
+        click.echo(f"Applied migration {version}: {description}")
+    if not applied:
+        click.echo("Database is up to date")
+
+
+@click.command("explain-queries")
+@click.argument("username")
+def explain_queries(username):
+    """Print the query plan of every query issued by model_helpers."""
+    user = db_session.query(User).filter_by(username=username).first()
+    if not user:
+        click.echo(f"User {username} not found")
+        return
+    action = db_session.query(Action).filter_by(user_id=user.id).first()
+    if not action:
+        click.echo(f"User {username} has no actions")
+        return
+
+    helpers = [
+        ("summarize_actions", lambda: summarize_actions(user.id, "month")),
+        (
+            "get_activity_timeseries",
+            lambda: get_activity_timeseries(user.id, action.id),
+        ),
+        ("get_activity_matrix", lambda: get_activity_matrix(user.id)),
+        ("get_logs_page", lambda: get_logs_page(action.id)),
+    ]
+    explain = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    conn = db_session.connection()
+
+    for name, run in helpers:
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            run()
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+
+        for statement, parameters in statements:
+            click.echo(f"-- {name}")
+            click.echo(statement.strip())
+            for row in conn.exec_driver_sql(explain + statement, parameters):
+                click.echo(f"   {row[-1]}")
+            click.echo()
+
+
 @click.command("collect-static")
 def collect_static():
     """Copy static files to the STATIC_ROOT directory safely."""
@@ -52,4 +144,166 @@ def collect_static():
             except PermissionError:
                 click.echo(f"Skipped {rel_path} (permission denied)")
 
-    click.echo("Static files collection complete!")
\ No newline at end of file
+    click.echo("Static files collection complete!")
+
+@click.command("export")
+@click.argument("username")
+@click.option("--action", "action_name", help="Only export this action")
+@click.option("--start", help="First day to export, YYYY-MM-DD")
+@click.option("--end", help="Last day to export, YYYY-MM-DD")
+@click.option("--format", "fmt", type=click.Choice(list(EXPORT_FORMATS)), default="csv")
+@click.option("--output", "-o", type=click.File("w"), default="-")
+def export_logs(username, action_name, start, end, fmt, output):
+    """Stream a user's activity logs as CSV or NDJSON."""
+    user = db_session.query(User).filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"User {username} not found")
+
+    action_id = None
+    if action_name:
+        action = (
+            db_session.query(Action)
+            .filter_by(user_id=user.id, name=action_name)
+            .first()
+        )
+        if not action:
+            raise click.ClickException(f"Action {action_name} not found")
+        action_id = action.id
+
+    try:
+        start_dt, end_dt = parse_date_range(start, end)
+    except ValueError:
+        raise click.BadParameter("start and end must be YYYY-MM-DD dates")
+
+    logs = iter_logs(user.id, action_id, start_dt, end_dt)
+    for chunk in stream_export(logs, fmt):
+        output.write(chunk)
+
+
+@click.command("import-logs")
+@click.argument("username")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(list(EXPORT_FORMATS)))
+@click.option("--create-actions", is_flag=True, help="Create unknown actions")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=IMPORT_CHUNK_SIZE)
+@click.option("--checkpoint", help="Progress file, defaults to PATH.checkpoint")
+def import_logs_command(username, path, fmt, create_actions, chunk_size, checkpoint):
+    """Import activity logs from a CSV or NDJSON file, resuming if interrupted."""
+    user = db_session.query(User).filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"User {username} not found")
+
+    checkpoint = Checkpoint(checkpoint or f"{path}.checkpoint")
+    skip = checkpoint.load()
+    if skip:
+        click.echo(f"Resuming after {skip} records")
+
+    with open(path, newline="", encoding="utf-8") as stream:
+        result = import_logs(
+            user.id,
+            iter_records(stream, fmt or format_from_path(path)),
+            create_actions=create_actions,
+            chunk_size=chunk_size,
+            skip=skip,
+            checkpoint=checkpoint,
+        )
+
+    for name in result["created_actions"]:
+        click.echo(f"Created action {name}")
+    for error in result["errors"]:
+        click.echo(f"Line {error['line']}: {error['error']}", err=True)
+    click.echo(f"Imported {result['imported']} logs, {result['failed']} failed")
+
+
+@click.command("property-index")
+@click.argument("names", nargs=-1)
+@click.option("--drop", is_flag=True, help="Drop the indexes instead")
+def property_index(names, drop):
+    """Create or drop expression indexes on numeric log properties."""
+    try:
+        for name in names:
+            if drop:
+                drop_property_index(name)
+                click.echo(f"Dropped index on {name}")
+            else:
+                create_property_index(name)
+                click.echo(f"Indexed {name}")
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    click.echo(f"Indexed properties: {', '.join(property_indexes()) or 'none'}")
+
+
+@click.command("archive-logs")
+@click.option(
+    "--older-than",
+    default="1y",
+    show_default=True,
+    help="Age of the logs to move, like 90d, 6m or 1y",
+)
+def archive_logs_command(older_than):
+    """Move old activity logs from the database to the columnar archive."""
+    try:
+        cutoff = parse_range(older_than, datetime.now(timezone.utc))
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--older-than")
+
+    def progress(action, count):
+        click.echo(f"Archived {count} logs of {action.name} (user {action.user_id})")
+
+    result = archive_logs(cutoff, progress)
+    click.echo(
+        f"Archived {result['logs']} logs of {result['actions']} actions"
+        f" before {cutoff:%Y-%m-%d %H:%M} UTC to {ARCHIVE_DIR}"
+    )
+
+
+@click.command("compact-logs")
+@click.argument("username", required=False)
+def compact_logs_command(username):
+    """Merge the plain logs of actions with a compaction policy."""
+    user_id = None
+    if username:
+        user = db_session.query(User).filter_by(username=username).first()
+        if not user:
+            raise click.ClickException(f"User {username} not found")
+        user_id = user.id
+
+    def progress(action, removed):
+        if removed:
+            click.echo(
+                f"Merged {removed} logs of {action.name} per {action.compaction}"
+            )
+
+    result = compact_logs(user_id, progress)
+    click.echo(f"Removed {result['removed']} logs of {result['actions']} actions")
+
+
+@click.command("generate-reports")
+@click.option("--output", "-o", type=click.Path(file_okay=False), default=REPORT_DIR)
+@click.option("--workers", type=click.IntRange(min=1), help="Defaults to CPU count")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=REPORT_CHUNK_SIZE)
+@click.option(
+    "--format",
+    "formats",
+    type=click.Choice(REPORT_FORMATS),
+    multiple=True,
+    default=REPORT_FORMATS,
+)
+@click.option("--progress/--no-progress", default=True, help="Report every chunk")
+def generate_reports_command(output, workers, chunk_size, formats, progress):
+    """Write the weekly report of every user, in parallel processes."""
+
+    def report_progress(done, total, elapsed):
+        click.echo(f"{done}/{total} users, {done / elapsed:.1f} users/s", err=True)
+
+    result = generate_reports(
+        output, workers, chunk_size, formats, report_progress if progress else None
+    )
+    for user_id, error in result["errors"]:
+        click.echo(f"User {user_id}: {error}", err=True)
+    click.echo(
+        f"Wrote reports of {result['written']} users to {output} in"
+        f" {result['seconds']:.1f}s, {result['users_per_second']} users/s,"
+        f" {len(result['errors'])} failed"
+    )
@@ -0,0 +1,206 @@
+# compaction.py
+"""
+Merging of plain logs into one row per time window.
+
+An action whose Action.compaction is one of WINDOWS keeps a single log
+without notes and properties per minute, hour or local day, its delta
+counting the occurrences. add_logs and the importer pass new logs through
+absorb(), which adds the plain ones to the delta of the row of their window
+instead of inserting them. compact_logs merges the rows written before the
+policy was set or by two writes that both found no row to add to, reading a
+batch of logs at a time. Logs with notes or properties are never merged.
+
+A window's row keeps the timestamp of its first log, so it stays on the
+same local day and daily totals do not change, only the rollup row counts.
+"""
+from datetime import datetime, time, timedelta, timezone
+
+from sqlalchemy import bindparam, delete, select, tuple_, update
+
+import cache
+import timezones
+from database import db_session
+from models import Action, ActivityLog
+
+WINDOWS = ("minute", "hour", "day")
+# Logs read, and at most deleted, per transaction by compact_logs
+COMPACT_BATCH = 1000
+
+
+def window_bounds(timestamp: datetime, window: str, zone) -> tuple[datetime, datetime]:
+    """
+    Start and end, as naive UTC, of the window in `zone` that `timestamp`
+    falls in, naive timestamps are UTC.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    local = timestamp.astimezone(zone)
+    if window == "minute":
+        start = local.replace(second=0, microsecond=0)
+        end = start + timedelta(minutes=1)
+    elif window == "hour":
+        start = local.replace(minute=0, second=0, microsecond=0)
+        end = start + timedelta(hours=1)
+    else:
+        start = datetime.combine(local.date(), time(), zone)
+        end = datetime.combine(local.date() + timedelta(days=1), time(), zone)
+    return (
+        start.astimezone(timezone.utc).replace(tzinfo=None),
+        end.astimezone(timezone.utc).replace(tzinfo=None),
+    )
+
+
+def is_plain(log) -> bool:
+    """Whether a log row dict has neither notes nor properties."""
+    return not log.get("notes") and not log.get("properties")
+
+
+def policies(action_ids) -> dict[int, str]:
+    """Compaction window of every action in `action_ids` that has one."""
+    if not action_ids:
+        return {}
+    return dict(
+        db_session.execute(
+            select(Action.id, Action.compaction).where(
+                Action.id.in_(action_ids), Action.compaction.is_not(None)
+            )
+        ).all()
+    )
+
+
+def _window_log(action_id: int, start: datetime, end: datetime) -> int | None:
+    """Id of the first plain log of an action in a window, if there is one."""
+    logs = db_session.execute(
+        select(ActivityLog.id, ActivityLog.properties)
+        .where(
+            ActivityLog.action_id == action_id,
+            ActivityLog.timestamp >= start,
+            ActivityLog.timestamp < end,
+            ActivityLog.notes == "",
+        )
+        .order_by(ActivityLog.timestamp, ActivityLog.id)
+    )
+    return next((log_id for log_id, properties in logs if not properties), None)
+
+
+def absorb(rows: list[dict]) -> list[dict]:
+    """
+    Adds the plain rows of actions with a policy to the row of their window,
+    in the current transaction. Returns the rows left to insert: the others
+    and one merged row per window that has none yet.
+    """
+    windows = policies({row["action_id"] for row in rows if is_plain(row)})
+    if not windows:
+        return rows
+    zones = timezones.action_timezones(windows)
+
+    inserts, merged = [], {}
+    for row in rows:
+        window = windows.get(row["action_id"])
+        if window is None or not is_plain(row):
+            inserts.append(row)
+            continue
+        bounds = window_bounds(row["timestamp"], window, zones[row["action_id"]])
+        key = (row["action_id"], bounds)
+        if key not in merged:
+            merged[key] = dict(row)
+        else:
+            first = merged[key]
+            first["delta"] += row["delta"]
+            first["timestamp"] = min(first["timestamp"], row["timestamp"])
+
+    for (action_id, (start, end)), row in merged.items():
+        log_id = _window_log(action_id, start, end)
+        if log_id is None:
+            inserts.append(row)
+        else:
+            db_session.execute(
+                update(ActivityLog)
+                .where(ActivityLog.id == log_id)
+                .values(delta=ActivityLog.delta + row["delta"])
+            )
+    return inserts
+
+
+def _compact_action(action_id: int, window: str, zone) -> int:
+    """
+    Merges the plain logs of an action per window, returns the rows removed.
+    Logs are read COMPACT_BATCH at a time, each batch in its own transaction.
+    """
+    from model_helpers import update_rollups
+
+    query = (
+        select(
+            ActivityLog.id,
+            ActivityLog.timestamp,
+            ActivityLog.delta,
+            ActivityLog.properties,
+        )
+        .where(ActivityLog.action_id == action_id, ActivityLog.notes == "")
+        .order_by(ActivityLog.timestamp, ActivityLog.id)
+        .limit(COMPACT_BATCH)
+    )
+    logs_table = ActivityLog.__table__
+    total = 0
+    # The kept log of the current window, it can be in an earlier batch
+    keep = end = day = None
+    after = None
+    while True:
+        batch = query
+        if after is not None:
+            batch = batch.where(tuple_(ActivityLog.timestamp, ActivityLog.id) > after)
+        logs = db_session.execute(batch).all()
+        if not logs:
+            return total
+        after = (logs[-1].timestamp, logs[-1].id)
+
+        # Logs are sorted so the logs of a window follow each other, the
+        # first one is kept. Deltas are added, not set, so a write adding to
+        # it meanwhile is not lost.
+        added, removed, changes = {}, [], {}
+        for log_id, timestamp, delta, properties in logs:
+            if properties:
+                continue
+            if end is None or timestamp >= end:
+                keep, (_, end) = log_id, window_bounds(timestamp, window, zone)
+                day = timezones.local_day(timestamp, zone)
+                continue
+            added[keep] = added.get(keep, 0) + delta
+            removed.append(log_id)
+            _, count = changes.get((action_id, day), (0, 0))
+            changes[(action_id, day)] = (0, count - 1)
+
+        if removed:
+            db_session.execute(
+                update(logs_table)
+                .where(logs_table.c.id == bindparam("log_id"))
+                .values(delta=logs_table.c.delta + bindparam("added")),
+                [{"log_id": log_id, "added": delta} for log_id, delta in added.items()],
+            )
+            db_session.execute(delete(ActivityLog).where(ActivityLog.id.in_(removed)))
+            update_rollups(changes)
+            db_session.commit()
+            total += len(removed)
+
+
+def compact_logs(user_id: int | None = None, progress=None) -> dict:
+    """
+    Merges the plain logs of every action with a policy, or of the user's.
+    Calls `progress(action, removed)` after each action when given.
+    """
+    query = select(Action).where(Action.compaction.is_not(None)).order_by(Action.id)
+    if user_id is not None:
+        query = query.where(Action.user_id == user_id)
+    actions = db_session.scalars(query).all()
+    zones = timezones.action_timezones([action.id for action in actions])
+
+    result = {"actions": 0, "removed": 0}
+    for action in actions:
+        removed = _compact_action(action.id, action.compaction, zones[action.id])
+        if removed:
+            cache.invalidate(action.user_id, action.id)
+        result["actions"] += 1
+        result["removed"] += removed
+        if progress is not None:
+            progress(action, removed)
+    return result
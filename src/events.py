@@ -0,0 +1,179 @@
+# events.py
+"""
+In-process publish/subscribe of activity changes for the live feed.
+
+The write paths publish an event per change after committing it and every
+open /dashboard/events stream of that user receives it. Each subscriber has
+a bounded queue: a client that does not keep up loses its backlog and gets a
+single "resync" event telling it to reload instead of growing the queue.
+
+Waiting uses queue.Queue, which gevent monkey patches, so an idle stream
+costs a greenlet and no thread on the gevent worker. Events are broadcast so
+streams served by another worker receive them too.
+"""
+import json
+import os
+import queue
+import threading
+
+import broadcast
+import timezones
+
+EVENTS_QUEUE_SIZE: int = int(os.getenv("EVENTS_QUEUE_SIZE", 100))
+EVENTS_HEARTBEAT: float = float(os.getenv("EVENTS_HEARTBEAT", 15))
+EVENTS_MAX_STREAMS: int = int(os.getenv("EVENTS_MAX_STREAMS", 10))
+# Larger changes are sent as a "resync" to keep broadcast messages small
+EVENTS_MAX_CHANGES: int = int(os.getenv("EVENTS_MAX_CHANGES", 500))
+
+
+class Subscription:
+    """The events of one user waiting to be sent to one stream."""
+
+    def __init__(self, user_id: int, maxsize: int):
+        self.user_id = user_id
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+
+    def put(self, event: dict):
+        with self._lock:
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                # Too slow, replace the backlog by one request to reload
+                self.dropped += 1
+                while True:
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                self._queue.put_nowait({"type": "resync"})
+
+    def get(self, timeout: float) -> dict | None:
+        """Returns the next event, or None if none came within `timeout`."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker:
+    def __init__(self, queue_size: int, max_streams: int):
+        self.queue_size = queue_size
+        self.max_streams = max_streams
+        self._subscriptions: dict[int, set[Subscription]] = {}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def subscribe(self, user_id: int) -> Subscription | None:
+        """Returns a new subscription, None if the user has too many streams."""
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(user_id, set())
+            if len(subscriptions) >= self.max_streams:
+                return None
+            subscription = Subscription(user_id, self.queue_size)
+            subscriptions.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def has_subscribers(self, user_id: int) -> bool:
+        return user_id in self._subscriptions
+
+    def publish(self, user_id: int, event: dict):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+            self.published += 1
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "event_streams": sum(map(len, self._subscriptions.values())),
+                "events_published_total": self.published,
+            }
+
+
+broker = Broker(EVENTS_QUEUE_SIZE, EVENTS_MAX_STREAMS)
+
+
+def _deliver(message: dict):
+    broker.publish(message["user_id"], message["event"])
+
+
+broadcast.subscribe("events", _deliver)
+
+
+# Users whose events are consumed in this process besides by streams, such
+# as the dashboard snapshots
+_watched: set[int] = set()
+
+
+def watch(user_id: int):
+    _watched.add(user_id)
+
+
+def unwatch(user_id: int):
+    _watched.discard(user_id)
+
+
+def has_listeners(user_id: int) -> bool:
+    """Whether an event of the user may be consumed, here or in any worker."""
+    return (
+        broadcast.shared()
+        or user_id in _watched
+        or broker.has_subscribers(user_id)
+    )
+
+
+def publish_changes(user_id: int, kind: str, changes, **extra):
+    """
+    Publishes a change of the daily totals of a user's actions.
+    changes: [(action_id, timestamp, delta), ...], the timestamps are turned
+    into the user's local days so clients can patch their charts directly
+    """
+    if not has_listeners(user_id):
+        return
+    zone = timezones.user_timezone(user_id)
+    totals = {}
+    for action_id, timestamp, delta in changes:
+        key = (action_id, timezones.local_day(timestamp, zone).isoformat())
+        totals[key] = totals.get(key, 0) + delta
+    if len(totals) > EVENTS_MAX_CHANGES:
+        publish(user_id, "resync")
+        return
+    publish(
+        user_id,
+        kind,
+        changes=[
+            {"action_id": action_id, "day": day, "delta": delta}
+            for (action_id, day), delta in totals.items()
+        ],
+        **extra,
+    )
+
+
+def publish(user_id: int, kind: str, **extra):
+    """Publishes an event without day totals, e.g. a new or deleted action."""
+    if has_listeners(user_id):
+        broadcast.publish(
+            "events", {"user_id": user_id, "event": {"type": kind, **extra}}
+        )
+
+
+def stream(subscription: Subscription, heartbeat: float = EVENTS_HEARTBEAT):
+    """Yields the subscription's events as Server-Sent Events text."""
+    yield f"retry: {int(heartbeat * 1000)}\n\n"
+    while True:
+        event = subscription.get(heartbeat)
+        if event is None:
+            # Comment line, keeps proxies from closing an idle connection
+            yield ": heartbeat\n\n"
+            continue
+        yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
@@ -0,0 +1,135 @@
+# export.py
+"""
+Streaming export of activity logs as CSV or NDJSON.
+
+Rows are read in batches of EXPORT_BATCH_SIZE with `yield_per` and
+formatted one at a time, so memory use does not depend on the export size.
+Archived logs are read from the archive of each action and merged in by
+timestamp.
+"""
+import csv
+import heapq
+import io
+import json
+from datetime import date, datetime, time, timedelta, timezone
+
+from sqlalchemy import select
+
+import archive
+import write_behind
+from database import db_session
+from models import Action, ActivityLog
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FIELDS = [
+    "id",
+    "action_id",
+    "action",
+    "timestamp",
+    "delta",
+    "notes",
+    "properties",
+]
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def parse_date_range(start: str | None, end: str | None):
+    """
+    Turns optional 'YYYY-MM-DD' bounds into datetimes, the end day included.
+    Raises ValueError on malformed dates.
+    """
+    start_dt = end_dt = None
+    if start:
+        start_dt = datetime.combine(date.fromisoformat(start), time(), timezone.utc)
+    if end:
+        end_dt = datetime.combine(
+            date.fromisoformat(end) + timedelta(days=1), time(), timezone.utc
+        )
+    return start_dt, end_dt
+
+
+def iter_logs(
+    user_id: int,
+    action_id: int | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+):
+    """Yields a user's logs as dicts, oldest first, fetched in batches."""
+    if write_behind.enabled():
+        write_behind.queue.flush()
+
+    query = (
+        select(
+            ActivityLog.timestamp,
+            ActivityLog.id,
+            ActivityLog.delta,
+            ActivityLog.notes,
+            ActivityLog.properties,
+            ActivityLog.action_id,
+        )
+        .join(Action, Action.id == ActivityLog.action_id)
+        .where(Action.user_id == user_id)
+        .order_by(ActivityLog.timestamp, ActivityLog.id)
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
+    )
+    if action_id is not None:
+        query = query.where(ActivityLog.action_id == action_id)
+    if start is not None:
+        query = query.where(ActivityLog.timestamp >= start)
+    if end is not None:
+        query = query.where(ActivityLog.timestamp < end)
+
+    actions = db_session.query(Action.id, Action.name).filter_by(user_id=user_id)
+    if action_id is not None:
+        actions = actions.filter_by(id=action_id)
+    names = dict(actions.all())
+    # Rows of the table and of every archive, each sorted by (timestamp, id)
+    sources = [db_session.execute(query)]
+    for archived_id in names:
+        sources.append(_archived_rows(user_id, archived_id, start, end))
+
+    for row in heapq.merge(*sources, key=lambda row: row[:2]):
+        timestamp, log_id, delta, notes, properties, log_action_id = row
+        yield {
+            "id": log_id,
+            "action_id": log_action_id,
+            "action": names[log_action_id],
+            "timestamp": timestamp.isoformat(),
+            "delta": delta,
+            "notes": notes,
+            "properties": properties or {},
+        }
+
+
+def _archived_rows(user_id, action_id, start, end):
+    for row in archive.iter_rows(user_id, action_id, start, end):
+        yield (*row, action_id)
+
+
+def format_csv(logs):
+    """Yields CSV text chunks, a header line and then one line per log."""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for log in logs:
+        writer.writerow({**log, "properties": json.dumps(log["properties"])})
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def format_ndjson(logs):
+    """Yields one JSON document per log, each on its own line."""
+    for log in logs:
+        yield json.dumps(log) + "\n"
+
+
+def stream_export(logs, fmt: str):
+    """Yields `logs` in format `fmt`, one of EXPORT_FORMATS."""
+    if fmt == "csv":
+        return format_csv(logs)
+    if fmt == "ndjson":
+        return format_ndjson(logs)
+    raise ValueError(f"Unknown export format '{fmt}'")
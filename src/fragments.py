@@ -0,0 +1,100 @@
+# fragments.py
+"""
+Caching of rendered template fragments.
+
+Templates wrap a block whose output only depends on a version of the data
+it shows:
+
+    {% cache "log-entries", action.id, cursor, version %}
+        ...
+    {% endcache %}
+
+The first argument names the fragment, the others make up its key together
+with it. data_version() changes whenever cache.invalidate() is called for a
+user or action in this process, or the rollup watermark moves, so a fragment
+keyed on it is rendered again after a write by any worker or CLI command and
+served from the in-process cache until then. Views read the version before
+they load the data, a write in between then only costs a miss.
+"""
+import os
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+import cache
+from instrumentation import metrics
+from model_helpers import rollup_watermark
+
+FRAGMENT_CACHE_SIZE: int = int(os.getenv("FRAGMENT_CACHE_SIZE", 4096))
+FRAGMENT_CACHE_TTL: int = int(os.getenv("FRAGMENT_CACHE_TTL", 3600))
+
+_fragments = cache.LRUCache(maxsize=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL)
+_counts = {"hits": 0, "misses": 0}
+
+metrics.describe(
+    "fragment_cache_requests_total", "counter", "Template fragment cache lookups"
+)
+
+
+def data_version(user_id: int | None = None, action_id: int | None = None) -> str:
+    """
+    Version of the data of a user and/or an action, changed by every write.
+    The process counters cover changes outside the rollup, e.g. renaming an
+    action, the watermark the writes of other processes.
+    """
+    parts = []
+    if user_id is not None:
+        parts.append(cache.version(cache.user_tag(user_id)))
+    if action_id is not None:
+        parts.append(cache.version(cache.action_tag(action_id)))
+    watermark = rollup_watermark(user_id, action_id)
+    parts.append(watermark.isoformat() if watermark else "0")
+    return ".".join(map(str, parts))
+
+
+class FragmentCacheExtension(Extension):
+    """Adds the {% cache name, key... %}...{% endcache %} tag."""
+
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if("comma"):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(("name:endcache",), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_render", [nodes.List(args)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, key_parts, caller):
+        name = key_parts[0]
+        key = ":".join(map(str, key_parts))
+        html = _fragments.get(key)
+        hit = html is not None
+        metrics.inc(
+            "fragment_cache_requests_total",
+            fragment=name,
+            result="hit" if hit else "miss",
+        )
+        _counts["hits" if hit else "misses"] += 1
+        if not hit:
+            html = str(caller())
+            _fragments.set(key, html, [])
+        return Markup(html)
+
+
+def stats() -> dict:
+    lookups = _counts["hits"] + _counts["misses"]
+    ratio = _counts["hits"] / lookups if lookups else 0
+    return {
+        "fragment_cache_entries": len(_fragments),
+        "fragment_cache_hit_ratio": round(ratio, 4),
+    }
+
+
+def init_app(app):
+    """Enables the cache tag in the app's templates."""
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    metrics.add_gauge_source(stats)
@@ -0,0 +1,222 @@
+# importer.py
+"""
+Bulk import of activity logs from CSV or NDJSON.
+
+Records are parsed one at a time from the input stream and inserted in
+chunks of `chunk_size` rows, each chunk in its own transaction. After every
+chunk the number of consumed records can be saved to a checkpoint file so an
+interrupted import resumes where it stopped. The daily rollup of the
+touched actions is rebuilt once at the end instead of per row.
+
+Each record needs an `action` name (or an `action_id` owned by the user) and
+may have `timestamp` (ISO 8601, UTC when naive), `delta`, `notes` and
+`properties` (an object, or a JSON string in CSV). Files written by the
+export are accepted as is.
+"""
+import csv
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+import cache
+import compaction
+import events
+from database import db_session
+from models import Action, ActivityLog
+from model_helpers import rebuild_rollups
+
+IMPORT_CHUNK_SIZE = 1000
+# Errors reported back in the import result, the rest are only counted
+MAX_REPORTED_ERRORS = 50
+
+
+def iter_records(stream, fmt: str):
+    """Yields (line number, record) pairs from a text stream, None if invalid."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "ndjson":
+        for line_num, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield line_num, json.loads(line)
+            except ValueError:
+                yield line_num, None
+    else:
+        raise ValueError(f"Unknown import format '{fmt}'")
+
+
+def format_from_path(path: str) -> str:
+    return "ndjson" if Path(path).suffix.lower() in (".ndjson", ".jsonl") else "csv"
+
+
+def _parse_delta(value) -> int:
+    """
+    The delta of a record, 1 when it has none. Raises ValueError when it is
+    not a whole number, 0 is kept.
+    """
+    if value is None or value == "":
+        return 1
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f"delta must be a whole number, got {value!r}")
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"delta must be a whole number, got {value!r}") from None
+
+
+def _parse_record(record, action_id: int) -> dict:
+    timestamp = record.get("timestamp")
+    if timestamp:
+        timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        timestamp = timestamp.astimezone(timezone.utc)
+    else:
+        timestamp = datetime.now(timezone.utc)
+
+    properties = record.get("properties") or {}
+    if isinstance(properties, str):
+        properties = json.loads(properties)
+    if not isinstance(properties, dict):
+        raise ValueError("properties must be an object")
+
+    return {
+        "action_id": action_id,
+        "timestamp": timestamp,
+        "delta": _parse_delta(record.get("delta")),
+        "notes": record.get("notes") or record.get("note") or "",
+        "properties": properties,
+    }
+
+
+def _create_action(user_id: int, name: str) -> int:
+    """
+    Creates an action of the user in the current transaction. Raises
+    ValueError when the name is taken, names are unique across all users.
+    """
+    if db_session.scalar(select(Action.id).where(Action.name == name)) is not None:
+        raise ValueError(f"Action name '{name}' is already taken")
+    action = Action(name=name, user_id=user_id, notes="", properties={})
+    try:
+        # A savepoint keeps the chunk's other new actions if this one fails
+        with db_session.begin_nested():
+            db_session.add(action)
+    except IntegrityError:
+        raise ValueError(f"Action name '{name}' is already taken") from None
+    return action.id
+
+
+class Checkpoint:
+    """Number of records of a source already imported, kept in a JSON file."""
+
+    def __init__(self, path: str | None):
+        self.path = Path(path) if path else None
+
+    def load(self) -> int:
+        if self.path is None or not self.path.exists():
+            return 0
+        return json.loads(self.path.read_text())["records"]
+
+    def save(self, records: int):
+        if self.path is not None:
+            self.path.write_text(json.dumps({"records": records}))
+
+    def clear(self):
+        if self.path is not None:
+            self.path.unlink(missing_ok=True)
+
+
+def import_logs(
+    user_id: int,
+    records,
+    create_actions: bool = False,
+    chunk_size: int = IMPORT_CHUNK_SIZE,
+    skip: int = 0,
+    checkpoint: Checkpoint | None = None,
+) -> dict:
+    """
+    Imports (line number, record) pairs from iter_records for a user.
+    The first `skip` records are ignored, use it to resume an import.
+    Returns counts of the imported and failed records.
+    """
+    checkpoint = checkpoint or Checkpoint(None)
+    actions = {
+        name: action_id
+        for action_id, name in db_session.query(Action.id, Action.name).filter_by(
+            user_id=user_id
+        )
+    }
+    owned_ids = set(actions.values())
+    touched = set()
+    result = {"imported": 0, "failed": 0, "created_actions": [], "errors": []}
+    rows = []
+    consumed = 0
+
+    def flush():
+        if rows:
+            # Actions with a compaction policy add to their windows' rows
+            inserts = compaction.absorb(rows)
+            if inserts:
+                db_session.execute(insert(ActivityLog), inserts)
+            touched.update(row["action_id"] for row in rows)
+            result["imported"] += len(rows)
+            rows.clear()
+        db_session.commit()
+        checkpoint.save(consumed)
+
+    try:
+        for line_num, record in records:
+            consumed += 1
+            if consumed <= skip:
+                continue
+
+            try:
+                if not isinstance(record, dict):
+                    raise ValueError("Invalid record")
+
+                name = record.get("action")
+                if name:
+                    action_id = actions.get(name)
+                    if action_id is None:
+                        if not create_actions:
+                            raise ValueError(f"Unknown action '{name}'")
+                        action_id = actions[name] = _create_action(user_id, name)
+                        owned_ids.add(action_id)
+                        result["created_actions"].append(name)
+                elif record.get("action_id") and int(record["action_id"]) in owned_ids:
+                    action_id = int(record["action_id"])
+                else:
+                    raise ValueError("Record has no known action")
+
+                rows.append(_parse_record(record, action_id))
+            except (TypeError, ValueError) as e:
+                result["failed"] += 1
+                if len(result["errors"]) < MAX_REPORTED_ERRORS:
+                    result["errors"].append({"line": line_num, "error": str(e)})
+
+            if len(rows) >= chunk_size:
+                flush()
+
+        flush()
+    finally:
+        # Derived aggregates are rebuilt once for all committed chunks, also
+        # when the import stops early so they stay consistent with the logs
+        db_session.rollback()
+        if touched:
+            rebuild_rollups(touched)
+        cache.invalidate(user_id)
+        for action_id in touched:
+            cache.invalidate(user_id, action_id)
+        events.publish(user_id, "resync")
+
+    result["records"] = consumed
+    checkpoint.clear()
+
+    return result
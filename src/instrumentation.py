@@ -0,0 +1,276 @@
+# instrumentation.py
+"""
+Per request timing and Prometheus style metrics.
+
+For a sampled request (INSTRUMENTATION_SAMPLE_RATE, 0 to 1) this records the
+number of SQL queries, the total DB time, the slowest statements, template
+render time and time spent in NumPy code wrapped in `timed("numpy")`. The
+numbers are sent back as a Server-Timing header and logged as one JSON line.
+Request counts and durations are always recorded and served on /metrics.
+
+/metrics needs `Authorization: Bearer <METRICS_TOKEN>` when METRICS_TOKEN is
+set and is only served to loopback clients otherwise, nginx proxies it for
+local scrapers. Metrics are kept per process: with several gunicorn workers
+a scrape gets the counters of the worker that answered it, so scrape each
+worker on its own port or run one worker where exact totals matter.
+"""
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import Response, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTATION_SAMPLE_RATE: float = float(
+    os.getenv("INSTRUMENTATION_SAMPLE_RATE", 1.0)
+)
+# Bearer token required on /metrics, unset for loopback clients only
+METRICS_TOKEN: str | None = os.getenv("METRICS_TOKEN") or None
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1")
+# Number of slowest statements kept per request
+SLOW_QUERY_COUNT: int = 3
+# Upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Metrics:
+    """Minimal thread-safe registry rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self._help = {}
+        self._gauge_sources = []
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                key, [[0] * len(DURATION_BUCKETS), 0.0, 0]
+            )
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_gauge_source(self, source):
+        """Registers a callable returning {metric name: value} read on scrape."""
+        self._gauge_sources.append(source)
+
+    def render(self) -> str:
+        lines = []
+        described = set()
+
+        def header(name):
+            if name in self._help and name not in described:
+                kind, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        def fmt(labels, extra=()):
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(h[0]), h[1], h[2])) for key, h in self._histograms.items()
+            )
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name)
+            for bound, bucket in zip(DURATION_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {bucket}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+
+        for source in self._gauge_sources:
+            for name, value in source().items():
+                header(name)
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("http_requests_total", "counter", "HTTP requests served")
+metrics.describe(
+    "http_request_duration_seconds", "histogram", "HTTP request duration"
+)
+metrics.describe("db_queries_total", "counter", "SQL statements of sampled requests")
+metrics.describe("db_seconds_total", "counter", "SQL time of sampled requests")
+metrics.describe("template_seconds_total", "counter", "Template render time")
+metrics.describe("numpy_seconds_total", "counter", "NumPy compute time")
+
+
+def _timings():
+    """Returns the timing record of the current request if it is sampled."""
+    if has_request_context():
+        return g.get("_timings")
+    return None
+
+
+@contextmanager
+def timed(section: str):
+    """Adds the time spent in the block to `section` of the request timings."""
+    timings = _timings()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings["sections"][section] += time.perf_counter() - started
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _timings() is not None:
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timings = _timings()
+    if timings is None or not conn.info.get("query_started"):
+        return
+    duration = time.perf_counter() - conn.info["query_started"].pop()
+    timings["queries"] += 1
+    timings["sections"]["db"] += duration
+
+    slowest = timings["slowest"]
+    slowest.append((duration, " ".join(statement.split())[:200]))
+    slowest.sort(reverse=True)
+    del slowest[SLOW_QUERY_COUNT:]
+
+
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+
+def _before_render(app, template, context, **extra):
+    timings = _timings()
+    if timings is not None:
+        timings["render_started"] = time.perf_counter()
+
+
+def _after_render(app, template, context, **extra):
+    timings = _timings()
+    if timings is not None and "render_started" in timings:
+        started = timings.pop("render_started")
+        timings["sections"]["template"] += time.perf_counter() - started
+
+
+def _start_request():
+    g._request_started = time.perf_counter()
+    if random.random() < INSTRUMENTATION_SAMPLE_RATE:
+        g._timings = {"queries": 0, "sections": defaultdict(float), "slowest": []}
+
+
+def _finish_request(response):
+    started = g.get("_request_started")
+    if started is None:
+        return response
+    total = time.perf_counter() - started
+    endpoint = request.endpoint or "unknown"
+
+    metrics.inc(
+        "http_requests_total",
+        endpoint=endpoint,
+        method=request.method,
+        status=response.status_code,
+    )
+    metrics.observe("http_request_duration_seconds", total, endpoint=endpoint)
+
+    timings = g.get("_timings")
+    if timings is None:
+        return response
+
+    sections = timings["sections"]
+    metrics.inc("db_queries_total", timings["queries"], endpoint=endpoint)
+    metrics.inc("db_seconds_total", sections["db"], endpoint=endpoint)
+    metrics.inc("template_seconds_total", sections["template"], endpoint=endpoint)
+    metrics.inc("numpy_seconds_total", sections["numpy"], endpoint=endpoint)
+
+    server_timing = [
+        f'db;dur={sections["db"] * 1000:.2f};desc="{timings["queries"]} queries"'
+    ]
+    for name in ("template", "numpy"):
+        if sections[name]:
+            server_timing.append(f"{name};dur={sections[name] * 1000:.2f}")
+    server_timing.append(f"total;dur={total * 1000:.2f}")
+    response.headers.add("Server-Timing", ", ".join(server_timing))
+
+    logger.info(
+        json.dumps(
+            {
+                "endpoint": endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "total_ms": round(total * 1000, 2),
+                "queries": timings["queries"],
+                "db_ms": round(sections["db"] * 1000, 2),
+                "template_ms": round(sections["template"] * 1000, 2),
+                "numpy_ms": round(sections["numpy"] * 1000, 2),
+                "slowest": [
+                    {"ms": round(duration * 1000, 2), "sql": sql}
+                    for duration, sql in timings["slowest"]
+                ],
+            }
+        )
+    )
+    return response
+
+
+def _metrics_allowed() -> bool:
+    if METRICS_TOKEN is None:
+        return request.remote_addr in LOOPBACK_ADDRESSES
+    expected = f"Bearer {METRICS_TOKEN}"
+    given = request.headers.get("Authorization", "")
+    return hmac.compare_digest(given.encode(), expected.encode())
+
+
+def _metrics_view():
+    if not _metrics_allowed():
+        return Response("Forbidden\n", status=403, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app, engine):
+    """Registers the request hooks, the SQL listeners and the /metrics route."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule("/metrics", "metrics", _metrics_view)
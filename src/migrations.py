@@ -0,0 +1,154 @@
+# migrations.py
+"""
+Minimal schema migrations for existing databases.
+
+`create_all` only creates missing tables, it never touches tables that
+already exist. Each migration below brings an older database up to date and
+must be safe to run on a database created from the current models.
+"""
+from datetime import datetime, timezone
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import inspect, select
+
+from database import engine
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def _fill_daily_rollup(conn):
+    """Fills an empty daily rollup from ActivityLog, by the owners' zones."""
+    from models import Action, DailyRollup, User
+    from model_helpers import log_span, rollup_fill_statement
+
+    if conn.scalar(select(DailyRollup.action_id).limit(1)) is not None:
+        return
+    columns = inspect(conn).get_columns(User.__tablename__)
+    if "timezone" not in {column["name"] for column in columns}:
+        span = conn.execute(log_span()).one()
+        conn.execute(rollup_fill_statement(span=span))
+        return
+
+    zones = {}
+    query = select(User.timezone, Action.id).join(User, User.id == Action.user_id)
+    for name, action_id in conn.execute(query):
+        zones.setdefault(name or "UTC", []).append(action_id)
+    for name, ids in zones.items():
+        span = conn.execute(log_span(ids)).one()
+        conn.execute(rollup_fill_statement(ids, name, span))
+
+
+def _add_daily_rollup(conn):
+    from models import DailyRollup
+
+    if not inspect(conn).has_table(DailyRollup.__tablename__):
+        DailyRollup.__table__.create(conn)
+    # create_all may have made the table already, empty
+    _fill_daily_rollup(conn)
+
+
+def _add_hot_path_indexes(conn):
+    from models import Action, ActivityLog
+
+    for table in (Action.__table__, ActivityLog.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def _add_api_tokens(conn):
+    from models import ApiToken, User
+    from auth_helpers import hash_token
+
+    ApiToken.__table__.create(conn, checkfirst=True)
+
+    # Replace the plaintext tokens stored on users by their digest
+    users = conn.execute(
+        select(User.id, User.api_token, User.token_expiry).where(
+            User.api_token.is_not(None), User.token_expiry.is_not(None)
+        )
+    ).all()
+    for user_id, token, expiry in users:
+        conn.execute(
+            ApiToken.__table__.insert().values(
+                user_id=user_id,
+                token_hash=hash_token(token),
+                scopes="read write",
+                created_at=datetime.now(timezone.utc),
+                expires_at=expiry,
+            )
+        )
+    conn.execute(User.__table__.update().values(api_token=None, token_expiry=None))
+
+
+def _add_user_timezone(conn):
+    from models import User
+
+    columns = {column["name"] for column in inspect(conn).get_columns(User.__tablename__)}
+    if "timezone" not in columns:
+        # Existing rollups were bucketed in UTC, the default, so they stay valid
+        conn.exec_driver_sql(
+            "ALTER TABLE users ADD COLUMN timezone VARCHAR(64) NOT NULL DEFAULT 'UTC'"
+        )
+
+
+def _add_action_compaction(conn):
+    from models import Action
+
+    columns = {
+        column["name"] for column in inspect(conn).get_columns(Action.__tablename__)
+    }
+    if "compaction" not in columns:
+        conn.exec_driver_sql("ALTER TABLE actions ADD COLUMN compaction VARCHAR(16)")
+
+
+def _add_rollup_updated_at(conn):
+    from models import DailyRollup
+
+    columns = {
+        column["name"]
+        for column in inspect(conn).get_columns(DailyRollup.__tablename__)
+    }
+    if "updated_at" not in columns:
+        conn.exec_driver_sql("ALTER TABLE daily_rollup ADD COLUMN updated_at TIMESTAMP")
+
+
+# (version, description, function) in the order they must be applied
+MIGRATIONS = [
+    (1, "daily rollup table", _add_daily_rollup),
+    (2, "hot path indexes", _add_hot_path_indexes),
+    (3, "hashed api tokens", _add_api_tokens),
+    (4, "user time zones", _add_user_timezone),
+    (5, "action compaction policy", _add_action_compaction),
+    (6, "fill empty daily rollup", _fill_daily_rollup),
+    (7, "rollup watermark", _add_rollup_updated_at),
+]
+
+
+def upgrade_db(bind=engine):
+    """Applies every migration that has not been recorded yet, returns them."""
+    applied = []
+    with bind.begin() as conn:
+        schema_migrations.create(conn, checkfirst=True)
+        done = set(conn.scalars(select(schema_migrations.c.version)))
+
+        for version, description, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            migrate(conn)
+            conn.execute(
+                schema_migrations.insert().values(
+                    version=version,
+                    description=description,
+                    applied_at=datetime.now(timezone.utc),
+                )
+            )
+            applied.append((version, description))
+
+    return applied
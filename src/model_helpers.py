@@ -1,71 +1,424 @@
-from datetime import datetime, timezone, timedelta
-from sqlalchemy import func
-from collections import defaultdict
-
-from database import db_session
-from models import Action, ActivityLog
-
-
-def summarize_actions(user_id: int, period: str = "week"):
-    """
-    Returns summary of actions for a given period.
-    period: "day", "week", "month"
-    """
-    now = datetime.now(timezone.utc)
-
-    if period == "day":
-        start = now - timedelta(days=1)
-    elif period == "week":
-        start = now - timedelta(days=7)
-    elif period == "month":
-        start = now - timedelta(days=30)
-    else:
-        raise ValueError("Invalid period")
-
-    # Aggregate total delta per action
-    results = (
-        db_session.query(
-            Action.name, func.coalesce(func.sum(ActivityLog.delta), 0).label("total")
-        )
-        .outerjoin(ActivityLog, ActivityLog.action_id == Action.id)
-        .filter(Action.user_id == user_id)
-        .filter((ActivityLog.timestamp >= start) | (ActivityLog.timestamp == None))
-        .group_by(Action.id)
-        .all()
-    )
-
-    summary = {name: total or 0 for name, total in results}
-    return summary
-
-
-def get_activity_timeseries(user_id: int, action_id: int, days: int = 30):
-    """
-    Returns a time series for a single action over the last `days` days.
-    Output: list of dicts [{'date': 'YYYY-MM-DD', 'delta': int}, ...]
-    """
-    now = datetime.now(timezone.utc)
-    start = now - timedelta(days=days)
-
-    logs = (
-        db_session.query(ActivityLog.timestamp, ActivityLog.delta)
-        .join(Action, Action.id == ActivityLog.action_id)
-        .filter(Action.user_id == user_id)
-        .filter(ActivityLog.action_id == action_id)
-        .filter(ActivityLog.timestamp >= start)
-        .order_by(ActivityLog.timestamp.asc())
-        .all()
-    )
-
-    # Aggregate deltas per day
-    daily_totals = defaultdict(int)
-    for ts, delta in logs:
-        day = ts.date().isoformat()
-        daily_totals[day] += delta
-
-    # Fill missing days with 0
-    timeseries = []
-    for i in range(days + 1):
-        day = (start + timedelta(days=i)).date().isoformat()
-        timeseries.append({"date": day, "delta": daily_totals.get(day, 0)})
-
-    return timeseries
+import base64
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import delete, func, insert, select, tuple_, update
+import numpy as np
+
+import archive
+import compaction
+import timezones
+import write_behind
+from database import db_session
+from models import Action, ActivityLog, DailyRollup, User
+
+
+def _pending_totals(action_ids, start: date) -> dict[tuple[int, date], int]:
+    """Returns per action, per day deltas still queued by write-behind."""
+    if not write_behind.enabled():
+        return {}
+    return {
+        key: delta
+        for key, (delta, _) in write_behind.pending_changes(action_ids).items()
+        if key[1] >= start
+    }
+
+
+def summarize_actions(user_id: int, period: str = "week"):
+    """
+    Returns summary of actions for a given period.
+    period: "day", "week", "month"
+    """
+    now = datetime.now(timezones.user_timezone(user_id))
+
+    if period == "day":
+        start = now - timedelta(days=1)
+    elif period == "week":
+        start = now - timedelta(days=7)
+    elif period == "month":
+        start = now - timedelta(days=30)
+    else:
+        raise ValueError("Invalid period")
+
+    # Aggregate total delta per action from the daily rollup
+    results = (
+        db_session.query(
+            Action.id,
+            Action.name,
+            func.coalesce(func.sum(DailyRollup.sum_delta), 0).label("total"),
+        )
+        .outerjoin(
+            DailyRollup,
+            (DailyRollup.action_id == Action.id) & (DailyRollup.day >= start.date()),
+        )
+        .filter(Action.user_id == user_id)
+        .group_by(Action.id)
+        .all()
+    )
+
+    summary = {name: total or 0 for _, name, total in results}
+
+    names = {action_id: name for action_id, name, _ in results}
+    for (action_id, _), delta in _pending_totals(names.keys(), start.date()).items():
+        summary[names[action_id]] += delta
+
+    return summary
+
+
+def get_activity_timeseries(user_id: int, action_id: int, days: int = 30):
+    """
+    Returns a time series for a single action over the last `days` days.
+    Output: list of dicts [{'date': 'YYYY-MM-DD', 'delta': int}, ...]
+    """
+    now = datetime.now(timezones.user_timezone(user_id))
+    start = now - timedelta(days=days)
+
+    rows = (
+        db_session.query(DailyRollup.day, DailyRollup.sum_delta)
+        .join(Action, Action.id == DailyRollup.action_id)
+        .filter(Action.user_id == user_id)
+        .filter(DailyRollup.action_id == action_id)
+        .filter(DailyRollup.day >= start.date())
+        .all()
+    )
+    daily_totals = {day.isoformat(): total for day, total in rows}
+    for (_, day), delta in _pending_totals({action_id}, start.date()).items():
+        day = day.isoformat()
+        daily_totals[day] = daily_totals.get(day, 0) + delta
+
+    # Fill missing days with 0
+    timeseries = []
+    for i in range(days + 1):
+        day = (start + timedelta(days=i)).date().isoformat()
+        timeseries.append({"date": day, "delta": daily_totals.get(day, 0)})
+
+    return timeseries
+
+
+def get_activity_matrix(user_id: int, days: int = 30):
+    """
+    Returns daily totals for every action of a user over the last `days` days,
+    fetched with a single grouped query instead of one query per action.
+    Output: (actions, labels, matrix) where `matrix` is an int array of shape
+    (len(actions), days + 1) and row i belongs to actions[i]
+    """
+    now = datetime.now(timezones.user_timezone(user_id))
+    start = now - timedelta(days=days)
+
+    actions = (
+        db_session.query(Action).filter_by(user_id=user_id).order_by(Action.id).all()
+    )
+    labels = [(start + timedelta(days=i)).date().isoformat() for i in range(days + 1)]
+    matrix = np.zeros((len(actions), days + 1), dtype=np.int64)
+    if not actions:
+        return actions, labels, matrix
+
+    rows = (
+        db_session.query(
+            DailyRollup.action_id, DailyRollup.day, DailyRollup.sum_delta
+        )
+        .join(Action, Action.id == DailyRollup.action_id)
+        .filter(Action.user_id == user_id)
+        .filter(DailyRollup.day >= start.date())
+        .all()
+    )
+
+    row_index = {action.id: i for i, action in enumerate(actions)}
+    col_index = {label: i for i, label in enumerate(labels)}
+    for action_id, day, total in rows:
+        col = col_index.get(day.isoformat())
+        if col is not None:
+            matrix[row_index[action_id], col] = total
+    pending = _pending_totals(row_index.keys(), start.date())
+    for (action_id, day), delta in pending.items():
+        col = col_index.get(day.isoformat())
+        if col is not None:
+            matrix[row_index[action_id], col] += delta
+
+    return actions, labels, matrix
+
+
+def _rollup_insert():
+    """Returns a dialect specific INSERT for DailyRollup that supports upserts"""
+    if db_session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(DailyRollup)
+
+
+def update_rollups(changes: dict[tuple[int, date], tuple[int, int]]):
+    """
+    Applies a batch of changes to the daily rollup in the current transaction.
+    changes: {(action_id, day): (delta, count), ...}, values are added to the
+    existing totals so negative numbers undo previous writes
+    """
+    if not changes:
+        return
+
+    stmt = _rollup_insert()
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DailyRollup.action_id, DailyRollup.day],
+        set_={
+            "sum_delta": DailyRollup.sum_delta + stmt.excluded.sum_delta,
+            "count": DailyRollup.count + stmt.excluded.count,
+            "updated_at": stmt.excluded.updated_at,
+        },
+    )
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    db_session.execute(
+        stmt,
+        [
+            {
+                "action_id": action_id,
+                "day": day,
+                "sum_delta": delta,
+                "count": count,
+                "updated_at": now,
+            }
+            for (action_id, day), (delta, count) in changes.items()
+        ],
+    )
+
+
+def touch_rollups(action_ids):
+    """
+    Moves the rollup watermark of actions whose logs changed without their
+    totals, e.g. once they were archived.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    db_session.execute(
+        update(DailyRollup)
+        .where(DailyRollup.action_id.in_(action_ids))
+        .values(updated_at=now)
+    )
+
+
+def rollup_watermark(user_id: int | None = None, action_id: int | None = None):
+    """
+    Time of the last write to the rollup of an action or of all the actions
+    of a user, None before the first. Every write path goes through the
+    rollup, so it changes with the data even when another process wrote.
+    """
+    query = select(func.max(DailyRollup.updated_at))
+    if action_id is not None:
+        query = query.where(DailyRollup.action_id == action_id)
+    if user_id is not None:
+        query = query.join(Action, Action.id == DailyRollup.action_id).where(
+            Action.user_id == user_id
+        )
+    return db_session.scalar(query)
+
+
+def rollup_changes(user_id: int, since: datetime | None):
+    """
+    (action_id, day, updated_at) of the rollup rows of a user's actions
+    written after `since`, of every written one when it is None.
+    """
+    query = (
+        select(DailyRollup.action_id, DailyRollup.day, DailyRollup.updated_at)
+        .join(Action, Action.id == DailyRollup.action_id)
+        .where(Action.user_id == user_id)
+    )
+    if since is None:
+        query = query.where(DailyRollup.updated_at.is_not(None))
+    else:
+        query = query.where(DailyRollup.updated_at > since)
+    return db_session.execute(query).all()
+
+
+def update_rollup(action_id: int, timestamp: datetime, delta: int, count: int = 1):
+    """Adds `delta` and `count` to the rollup of the local day of `timestamp`."""
+    zone = timezones.action_timezones([action_id])[action_id]
+    update_rollups({(action_id, timezones.local_day(timestamp, zone)): (delta, count)})
+
+
+def delete_rollups(action_id: int):
+    """Removes every rollup row of an action."""
+    db_session.execute(delete(DailyRollup).where(DailyRollup.action_id == action_id))
+
+
+def log_span(action_ids=None):
+    """
+    Query for the first and last timestamp of ActivityLog, limited to
+    `action_ids` when given
+    """
+    query = select(func.min(ActivityLog.timestamp), func.max(ActivityLog.timestamp))
+    if action_ids is not None:
+        query = query.where(ActivityLog.action_id.in_(action_ids))
+    return query
+
+
+def rollup_fill_statement(
+    action_ids=None, tz: str = timezones.DEFAULT_TIMEZONE, span=(None, None)
+):
+    """
+    Returns an INSERT .. SELECT that aggregates ActivityLog into DailyRollup
+    by local day in zone `tz`, limited to `action_ids` when given. `span` is
+    the range of the timestamps, as returned by log_span, SQLite needs it to
+    follow the zone's daylight saving changes
+    """
+    dialect = db_session.get_bind().dialect.name
+    day = timezones.day_column(ActivityLog.timestamp, tz, dialect, *span)
+    query = select(
+        ActivityLog.action_id,
+        day,
+        func.sum(ActivityLog.delta),
+        func.count(ActivityLog.id),
+    ).group_by(ActivityLog.action_id, day)
+    if action_ids is not None:
+        query = query.where(ActivityLog.action_id.in_(action_ids))
+    return insert(DailyRollup).from_select(
+        ["action_id", "day", "sum_delta", "count"], query
+    )
+
+
+def rebuild_rollups(action_ids=None):
+    """
+    Recomputes the daily rollup from ActivityLog, for all or some actions,
+    with one INSERT .. SELECT per time zone of their owners. Totals of
+    archived logs are added from the archive.
+    """
+    DailyRollup.__table__.create(bind=db_session.get_bind(), checkfirst=True)
+    query = select(User.timezone, Action.user_id, Action.id).join(
+        User, User.id == Action.user_id
+    )
+    stmt = delete(DailyRollup)
+    if action_ids is not None:
+        action_ids = list(action_ids)
+        query = query.where(Action.id.in_(action_ids))
+        stmt = stmt.where(DailyRollup.action_id.in_(action_ids))
+
+    zones, archived = {}, {}
+    for name, user_id, action_id in db_session.execute(query):
+        name = name or timezones.DEFAULT_TIMEZONE
+        zones.setdefault(name, []).append(action_id)
+        archived.update(archive.daily_totals(user_id, action_id, name))
+
+    db_session.execute(stmt)
+    for name, ids in zones.items():
+        span = db_session.execute(log_span(ids)).one()
+        db_session.execute(rollup_fill_statement(ids, name, span))
+    update_rollups(archived)
+    for ids in zones.values():
+        touch_rollups(ids)
+    db_session.commit()
+
+
+def set_user_timezone(user: User, name: str):
+    """
+    Changes the user's time zone and moves their rollup to the new local days.
+    Raises ValueError for unknown zone names.
+    """
+    if name not in timezones.timezone_names():
+        raise ValueError(f"Unknown time zone '{name}'")
+    if name == user.timezone:
+        return
+
+    user.timezone = name
+    db_session.commit()
+    timezones.forget(user.id)
+    action_ids = db_session.scalars(select(Action.id).filter_by(user_id=user.id))
+    rebuild_rollups(action_ids)
+
+
+def add_logs(rows: list[dict]):
+    """
+    Inserts many ActivityLog rows with a single executemany and updates the
+    rollup accordingly, both in the current transaction. Rows of actions
+    with a compaction policy can be added to an existing row instead.
+    rows: [{'action_id', 'timestamp', 'delta', 'notes', 'properties'}, ...]
+    """
+    if not rows:
+        return
+
+    inserted = compaction.absorb(rows)
+    if inserted:
+        db_session.execute(insert(ActivityLog), inserted)
+
+    zones = timezones.action_timezones({row["action_id"] for row in rows})
+
+    def day_key(row):
+        zone = zones[row["action_id"]]
+        return row["action_id"], timezones.local_day(row["timestamp"], zone)
+
+    changes = {}
+    for row in rows:
+        delta, count = changes.get(day_key(row), (0, 0))
+        changes[day_key(row)] = (delta + row["delta"], count)
+    # Rows added to an existing one leave the count as it was
+    for row in inserted:
+        delta, count = changes.get(day_key(row), (0, 0))
+        changes[day_key(row)] = (delta, count + 1)
+    update_rollups(changes)
+
+
+def encode_cursor(log: ActivityLog) -> str:
+    """Returns an opaque cursor pointing right after `log` in history order."""
+    raw = f"{log.timestamp.isoformat()}|{log.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Parses a cursor made by encode_cursor, raises ValueError if invalid."""
+    try:
+        timestamp, log_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(log_id)
+    except ValueError as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def get_logs_page(action_id: int, cursor: str | None = None, limit: int = 50):
+    """
+    Returns one page of an action's logs, newest first, using keyset
+    pagination on (timestamp, id) so every page costs the same.
+    Output: (logs, next_cursor) where next_cursor is None on the last page
+    """
+    if not cursor and write_behind.enabled():
+        # Queued rows have no id yet, write them so the first page shows them
+        write_behind.queue.flush()
+
+    query = db_session.query(ActivityLog).filter(ActivityLog.action_id == action_id)
+    if cursor:
+        timestamp, log_id = decode_cursor(cursor)
+        query = query.filter(
+            tuple_(ActivityLog.timestamp, ActivityLog.id) < tuple_(timestamp, log_id)
+        )
+
+    logs = (
+        query.order_by(ActivityLog.timestamp.desc(), ActivityLog.id.desc())
+        .limit(limit + 1)
+        .all()
+    )
+    if len(logs) > limit:
+        logs = logs[:limit]
+        return logs, encode_cursor(logs[-1])
+    return logs, None
+
+
+def add_log(row: dict) -> bool:
+    """
+    Stores one new ActivityLog row, see add_logs for its keys, and commits.
+    With write-behind enabled the row is only queued and False is returned.
+    """
+    if write_behind.enabled():
+        write_behind.queue.put(row)
+        return False
+
+    add_logs([row])
+    db_session.commit()
+    return True
+
+
+def linear_trend(values: np.ndarray) -> np.ndarray:
+    """
+    Fits a least-squares line to every row of `values` in one solve.
+    Output: float array with the same shape as `values`
+    """
+    values = np.atleast_2d(values)
+    n = values.shape[1]
+    if n < 2:
+        return values.astype(float)
+
+    x = np.arange(n)
+    design = np.column_stack([x, np.ones(n)])
+    coeffs, *_ = np.linalg.lstsq(design, values.T.astype(float), rcond=None)
+    return (design @ coeffs).T
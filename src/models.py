@@ -1,6 +1,6 @@
 # models.py
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, JSON, Index
 from sqlalchemy.orm import relationship, Mapped, mapped_column
 from database import Base
 
@@ -11,26 +11,55 @@ class User(Base):
     username: Mapped[str] = mapped_column(String(80), unique=True, nullable=False)
     password_hash: Mapped[str] = mapped_column(String(256), nullable=False)
     created_at = Column(DateTime, default=datetime.now(timezone.utc))
+    # IANA zone name, activity is grouped into days of this zone
+    timezone: Mapped[str] = mapped_column(
+        String(64), default="UTC", server_default="UTC", nullable=False
+    )
 
-    # API token fields
+    # Legacy plaintext API token fields, superseded by ApiToken
     api_token = mapped_column(String, unique=True, nullable=True)
     token_expiry = mapped_column(DateTime, nullable=True)
 
     actions: Mapped[list["Action"]] = relationship(
         back_populates="user", cascade="all, delete-orphan"
     )
+    tokens: Mapped[list["ApiToken"]] = relationship(
+        back_populates="user", cascade="all, delete-orphan"
+    )
+
+
+class ApiToken(Base):
+    __tablename__ = "api_tokens"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    # SHA-256 hex digest, the token itself is never stored
+    token_hash: Mapped[str] = mapped_column(
+        String(64), unique=True, index=True, nullable=False
+    )
+    # space separated, "read" for GET requests and "write" for the others
+    scopes: Mapped[str] = mapped_column(
+        String(64), default="read write", nullable=False
+    )
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    expires_at = Column(DateTime, nullable=False)
+
+    user: Mapped["User"] = relationship(back_populates="tokens")
 
 
 class Action(Base):
     __tablename__ = "actions"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     name: Mapped[str] = mapped_column(String(120), unique=True, nullable=False)
 
     # general notes and metadata
     notes: Mapped[str] = mapped_column(default="", nullable=False)
     properties: Mapped[dict] = mapped_column(JSON, default={})
+    # Window of compaction.WINDOWS within which logs without notes and
+    # properties are merged into one row, None keeps every log
+    compaction: Mapped[str | None] = mapped_column(String(16), nullable=True)
 
     user: Mapped["User"] = relationship(back_populates="actions")
     logs: Mapped[list["ActivityLog"]] = relationship(
@@ -40,6 +69,10 @@ class Action(Base):
 
 class ActivityLog(Base):
     __tablename__ = "activity_log"
+    __table_args__ = (
+        # Serves per action filters with timestamp ranges and history ordering
+        Index("ix_activity_log_action_id_timestamp", "action_id", "timestamp"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     action_id = Column(Integer, ForeignKey("actions.id"), nullable=False)
@@ -54,3 +87,16 @@ class ActivityLog(Base):
     properties: Mapped[dict] = mapped_column(JSON, default={})
 
     action = relationship("Action", back_populates="logs")
+
+
+class DailyRollup(Base):
+    """Per action, per day totals of ActivityLog, kept up to date by the write paths"""
+
+    __tablename__ = "daily_rollup"
+
+    action_id = Column(Integer, ForeignKey("actions.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    sum_delta = mapped_column(Integer, default=0, nullable=False)
+    count = mapped_column(Integer, default=0, nullable=False)
+    # Last write to the row, naive UTC, rollup_watermark() of the action
+    updated_at = Column(DateTime)
@@ -0,0 +1,145 @@
+# reports.py
+"""
+Weekly summary reports of every user, generated in parallel.
+
+Users are split into chunks of `chunk_size` ids that a process pool works
+through. Each worker process opens its own engine with create_db_engine and
+binds db_session to it, no connection is shared with the parent. Per user it
+reads the daily matrix once, computes the statistics of analytics.py for the
+last REPORT_DAYS days over all actions at once and writes
+<output>/user-<id>.json and/or <output>/user-<id>.html.
+"""
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+
+import jinja2
+import numpy as np
+from sqlalchemy import select
+
+import database
+import timezones
+from analytics import user_analytics
+from database import db_session
+from models import User
+
+REPORT_DIR: str = os.getenv("REPORT_DIR", "reports")
+REPORT_DAYS = 7
+REPORT_CHUNK_SIZE = 50
+REPORT_FORMATS = ("json", "html")
+
+_templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(Path(__file__).parent / "templates"),
+    autoescape=True,
+)
+
+
+def build_report(user: User) -> dict:
+    """The weekly report of a user as a JSON serializable dict."""
+    actions, labels, matrix, stats = user_analytics(user.id, days=REPORT_DAYS - 1)
+    totals = matrix.sum(axis=1)
+    change = np.where(np.isnan(stats.week_change), None, stats.week_change.round(1))
+    return {
+        "user_id": user.id,
+        "username": user.username,
+        "timezone": timezones.user_timezone(user.id).key,
+        "labels": labels,
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "total": int(totals.sum()),
+        "actions": [
+            {
+                "id": action.id,
+                "name": action.name,
+                "total": int(totals[i]),
+                "days": matrix[i].tolist(),
+                "last_week": int(stats.last_week[i]),
+                "week_change": change[i],
+                "current_streak": int(stats.current_streak[i]),
+                "longest_streak": int(stats.longest_streak[i]),
+                "anomalies": [
+                    labels[day] for day in np.flatnonzero(stats.anomalies[i])
+                ],
+            }
+            for i, action in enumerate(actions)
+        ],
+    }
+
+
+def write_report(report: dict, output: Path, formats=REPORT_FORMATS):
+    name = f"user-{report['user_id']}"
+    if "json" in formats:
+        (output / f"{name}.json").write_text(json.dumps(report))
+    if "html" in formats:
+        html = _templates.get_template("report.j2").render(report=report)
+        (output / f"{name}.html").write_text(html, encoding="utf-8")
+
+
+def _init_worker(url: str):
+    # The engine inherited from the parent keeps its connections to the
+    # parent, this process connects on its own
+    database.engine.dispose(close=False)
+    db_session.remove()
+    db_session.configure(bind=database.create_db_engine(url))
+
+
+def _generate_chunk(user_ids: list[int], output: str, formats) -> dict:
+    """Writes the reports of a chunk of users, in a worker process."""
+    result = {"written": 0, "errors": []}
+    try:
+        users = db_session.scalars(select(User).where(User.id.in_(user_ids))).all()
+        for user in users:
+            try:
+                write_report(build_report(user), Path(output), formats)
+                result["written"] += 1
+            except Exception as e:
+                db_session.rollback()
+                result["errors"].append((user.id, str(e)))
+    finally:
+        db_session.remove()
+    return result
+
+
+def generate_reports(
+    output: str = REPORT_DIR,
+    workers: int | None = None,
+    chunk_size: int = REPORT_CHUNK_SIZE,
+    formats=REPORT_FORMATS,
+    progress=None,
+) -> dict:
+    """
+    Writes the reports of all users to `output` with `workers` processes,
+    os.cpu_count() by default. Calls `progress(done, total, elapsed)` after
+    every chunk when given. Returns counts, failures and the throughput.
+    """
+    Path(output).mkdir(parents=True, exist_ok=True)
+    user_ids = db_session.scalars(select(User.id).order_by(User.id)).all()
+    db_session.remove()
+    chunks = [
+        user_ids[i : i + chunk_size] for i in range(0, len(user_ids), chunk_size)
+    ]
+
+    started = time.perf_counter()
+    result = {"users": 0, "written": 0, "errors": []}
+    url = database.engine.url.render_as_string(hide_password=False)
+    with ProcessPoolExecutor(
+        workers, initializer=_init_worker, initargs=(url,)
+    ) as pool:
+        futures = {
+            pool.submit(_generate_chunk, chunk, output, formats): len(chunk)
+            for chunk in chunks
+        }
+        for future in as_completed(futures):
+            chunk_result = future.result()
+            result["users"] += futures[future]
+            result["written"] += chunk_result["written"]
+            result["errors"].extend(chunk_result["errors"])
+            if progress is not None:
+                progress(result["users"], len(user_ids), time.perf_counter() - started)
+
+    elapsed = time.perf_counter() - started
+    result["seconds"] = round(elapsed, 3)
+    result["users_per_second"] = round(result["written"] / elapsed, 1) if elapsed else 0
+    return result
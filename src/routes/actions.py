@@ -1,31 +1,44 @@
 import json
+import cache
+import events
 from datetime import datetime, timezone
-from flask import Blueprint, render_template, request, redirect, url_for, flash
+from flask import (
+    Blueprint,
+    abort,
+    flash,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
 from models import Action, ActivityLog
-from database import db_session
-from auth_helpers import login_required, current_user
+from database import db_session, retry_on_busy
+from auth_helpers import login_required
+from compaction import WINDOWS
+from fragments import data_version
+from model_helpers import add_log, get_logs_page, update_rollup
 
 action_bp = Blueprint("action", __name__, url_prefix="/actions")
 
+# Number of logs rendered per history page
+HISTORY_PAGE_SIZE = 50
+
 
 # List all actions
 @action_bp.route("/")
 @login_required
-def list_actions():
-    user = current_user()
-    assert user is not None  # For type checking safety
-
+def list_actions(user):
+    version = data_version(user_id=user.id)
     actions = db_session.query(Action).filter_by(user_id=user.id).all()
-    return render_template("actions.j2", actions=actions, current_user=current_user)
+    return render_template("actions.j2", user=user, actions=actions, version=version)
 
 
 # Create a new action
 @action_bp.route("/new", methods=["GET", "POST"])
 @login_required
-def new_action():
-    user = current_user()
-    assert user is not None
-
+@retry_on_busy
+def new_action(user):
     if request.method == "POST":
         name = request.form["name"].strip()
         notes = request.form.get("notes", "")
@@ -40,6 +53,8 @@ def new_action():
         action = Action(name=name, user_id=user.id, notes=notes, properties=properties)
         db_session.add(action)
         db_session.commit()
+        cache.invalidate(user.id)
+        events.publish(user.id, "action.created", action_id=action.id)
 
         flash(f"Action '{name}' created successfully!", "info")
         return redirect(url_for("action.list_actions"))
@@ -50,10 +65,8 @@ def new_action():
 # Edit action
 @action_bp.route("/edit/action/<int:action_id>", methods=["GET", "POST"])
 @login_required
-def edit_action(action_id):
-    user = current_user()
-    assert user is not None
-
+@retry_on_busy
+def edit_action(user, action_id):
     action = db_session.query(Action).filter_by(id=action_id, user_id=user.id).first()
     if not action:
         flash("Action not found.", "error")
@@ -71,20 +84,26 @@ def edit_action(action_id):
             flash("Invalid JSON in properties", "error")
             return redirect(url_for("action.list_actions"))
 
+        window = request.form.get("compaction") or None
+        if window is not None and window not in WINDOWS:
+            flash("Unknown compaction window", "error")
+            return redirect(url_for("action.edit_action", action_id=action.id))
+        action.compaction = window
+
         db_session.commit()
+        cache.invalidate(user.id, action.id)
+        events.publish(user.id, "action.updated", action_id=action.id)
         flash("Action updated successfully!", "info")
         return redirect(url_for("action.list_actions"))
 
-    return render_template("edit_action.j2", action=action)
+    return render_template("edit_action.j2", action=action, windows=WINDOWS)
 
 
 # Edit activity
 @action_bp.route("/edit/log/<int:log_id>", methods=["GET", "POST"])
 @login_required
-def edit_activity(log_id):
-    user = current_user()
-    assert user is not None
-
+@retry_on_busy
+def edit_activity(user, log_id):
     log = (
         db_session.query(ActivityLog)
         .join(Action)
@@ -96,7 +115,16 @@ def edit_activity(log_id):
         return redirect(url_for("action.list_actions"))
 
     if request.method == "POST":
-        log.delta = request.form["delta"]
+        try:
+            delta = int(request.form["delta"])
+        except ValueError:
+            flash("Delta must be a whole number", "error")
+            return redirect(
+                url_for("action.view_action_history", action_id=log.action_id)
+            )
+
+        old_delta = log.delta
+        log.delta = delta
         log.notes = request.form.get("notes", "")
         properties_raw = request.form.get("properties", "{}")
 
@@ -109,7 +137,15 @@ def edit_activity(log_id):
                 url_for("action.view_action_history", action_id=log.action_id)
             )
 
+        update_rollup(log.action_id, log.timestamp, log.delta - old_delta, count=0)
         db_session.commit()
+        cache.invalidate(user.id, log.action_id)
+        events.publish_changes(
+            user.id,
+            "log.updated",
+            [(log.action_id, log.timestamp, log.delta - old_delta)],
+            log_id=log.id,
+        )
         flash("Activity updated successfully!", "info")
         return redirect(url_for("action.view_action_history", action_id=log.action_id))
 
@@ -119,19 +155,21 @@ def edit_activity(log_id):
 # Increment action (add log)
 @action_bp.route("/<int:action_id>/log", methods=["GET", "POST"])
 @login_required
-def log_activity(action_id):
-    user = current_user()
-    assert user is not None
-
+@retry_on_busy
+def log_activity(user, action_id):
     action = db_session.query(Action).filter_by(id=action_id, user_id=user.id).first()
     if not action:
         flash("Action not found", "error")
         return redirect(url_for("action.list_actions"))
 
     if request.method == "POST":
-        note = request.form.get("note", "")
+        note = request.form.get("notes", "")
         properties_raw = request.form.get("properties", "{}")
-        delta = int(request.form.get("delta", 1))
+        try:
+            delta = int(request.form.get("delta", 1))
+        except ValueError:
+            flash("Delta must be a whole number", "error")
+            return redirect(url_for("action.log_activity", action_id=action.id))
 
         try:
             properties = json.loads(properties_raw) if properties_raw else {}
@@ -139,15 +177,20 @@ def log_activity(action_id):
             flash("Invalid JSON in properties", "error")
             return redirect(url_for("action.log_activity", action_id=action.id))
 
-        log = ActivityLog(
-            action_id=action.id,
-            timestamp=datetime.now(timezone.utc),
-            delta=delta,
-            note=note,
-            properties=properties,
+        timestamp = datetime.now(timezone.utc)
+        add_log(
+            {
+                "action_id": action.id,
+                "timestamp": timestamp,
+                "delta": delta,
+                "notes": note,
+                "properties": properties,
+            }
+        )
+        cache.invalidate(user.id, action.id)
+        events.publish_changes(
+            user.id, "log.created", [(action.id, timestamp, delta)]
         )
-        db_session.add(log)
-        db_session.commit()
 
         flash(f"Logged new instance for '{action.name}'", "success")
         return redirect(url_for("action.view_action_history", action_id=action.id))
@@ -158,22 +201,39 @@ def log_activity(action_id):
 # View action history
 @action_bp.route("/<int:action_id>")
 @login_required
-def view_action_history(action_id):
-    user = current_user()
-    assert user is not None
-
+def view_action_history(user, action_id):
     action = db_session.query(Action).filter_by(id=action_id, user_id=user.id).first()
     if not action:
         flash("Action not found", "error")
         return redirect(url_for("action.list_actions"))
 
-    logs = (
-        db_session.query(ActivityLog)
-        .filter_by(action_id=action.id)
-        .order_by(ActivityLog.timestamp.desc())
-        .all()
-    )
+    # Read before the logs so a page is never cached under a newer version
+    version = data_version(action_id=action.id)
+    cursor = request.args.get("cursor")
+    try:
+        logs, next_cursor = get_logs_page(action.id, cursor, HISTORY_PAGE_SIZE)
+    except ValueError:
+        abort(400)
+
+    # Infinite scroll asks for the next page of entries only
+    if request.args.get("fragment"):
+        response = make_response(
+            render_template(
+                "log_entries.j2",
+                action=action,
+                logs=logs,
+                cursor=cursor,
+                version=version,
+            )
+        )
+        response.headers["X-Next-Cursor"] = next_cursor or ""
+        return response
 
     return render_template(
-        "view_action_history.j2", action=action, logs=logs, current_user=current_user
+        "view_action_history.j2",
+        action=action,
+        logs=logs,
+        cursor=cursor,
+        next_cursor=next_cursor,
+        version=version,
     )
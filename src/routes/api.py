@@ -1,33 +1,177 @@
-from flask import Blueprint, request, jsonify
-from database import db_session
+import csv
+import io
+import json
+import cache
+import events
+import write_behind
+from flask import Blueprint, Response, request, jsonify, stream_with_context
+from database import db_session, retry_on_busy
 from models import Action, ActivityLog
-from datetime import datetime, timezone
+from datetime import date, datetime, time, timezone
 
-from auth_helpers import user_from_token, token_required
-from model_helpers import summarize_actions
+import aggregation
+import archive
+import timezones
+from analytics import MAX_ANALYTICS_DAYS, user_analytics
+from auth_helpers import token_required
+from export import EXPORT_FORMATS, iter_logs, parse_date_range, stream_export
+from importer import IMPORT_CHUNK_SIZE, import_logs, iter_records
+from model_helpers import (
+    add_log,
+    add_logs,
+    delete_rollups,
+    get_logs_page,
+    summarize_actions,
+    update_rollup,
+)
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 
+# Number of bulk items validated and inserted per executemany
+BULK_CHUNK_SIZE = 500
+NDJSON_MIMETYPES = ("application/x-ndjson", "application/jsonl")
+SUMMARY_PERIODS = ("day", "week", "month")
+# Upper bound of the max_points parameter of /aggregate
+MAX_CHART_POINTS = 10_000
+# Page size bounds for log listings
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _cached_response(entry: cache.CacheEntry):
+    """JSON response for a cache entry that answers 304 to conditional requests."""
+    response = jsonify(entry.value)
+    response.set_etag(entry.etag)
+    response.last_modified = entry.last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 
 @api_bp.route("/summary", methods=["GET"])
 @token_required
 def api_summary(user):
     period = request.args.get("period", "week")
-    summary = summarize_actions(user.id, period)
-    return jsonify(summary)
+    if period not in SUMMARY_PERIODS:
+        return jsonify({"error": "Invalid period"}), 400
+
+    entry = cache.cached(
+        f"summary:{user.id}:{period}",
+        [cache.user_tag(user.id)],
+        lambda: summarize_actions(user.id, period),
+    )
+    return _cached_response(entry)
+
+
+# Rolling means, streaks and anomaly flags of every action
+@api_bp.route("/analytics", methods=["GET"])
+@token_required
+def api_analytics(user):
+    days = request.args.get("days", 30, type=int)
+    if not 1 <= days <= MAX_ANALYTICS_DAYS:
+        return jsonify({"error": f"days must be 1 to {MAX_ANALYTICS_DAYS}"}), 400
+
+    def compute():
+        actions, labels, matrix, stats = user_analytics(user.id, days)
+        return {
+            "labels": labels,
+            "actions": [
+                {
+                    "id": action.id,
+                    "name": action.name,
+                    "values": matrix[i].tolist(),
+                    **stats.row(i),
+                }
+                for i, action in enumerate(actions)
+            ],
+        }
+
+    entry = cache.cached(
+        f"analytics:{user.id}:{days}", [cache.user_tag(user.id)], compute
+    )
+    return _cached_response(entry)
+
+
+# Totals or property aggregates per hour, day, week or month, downsampled
+@api_bp.route("/aggregate", methods=["GET"])
+@token_required
+def api_aggregate(user):
+    resolution = request.args.get("resolution", "day")
+    method = request.args.get("downsample", "lttb")
+    max_points = request.args.get(
+        "max_points", aggregation.DEFAULT_MAX_POINTS, type=int
+    )
+    action_ids = request.args.getlist("action_id", type=int) or None
+    prop = request.args.get("property") or None
+    agg = request.args.get("agg", "sum")
+    if resolution not in aggregation.RESOLUTIONS:
+        return jsonify({"error": "resolution must be hour, day, week or month"}), 400
+    if method not in aggregation.DOWNSAMPLE_METHODS:
+        return jsonify({"error": "downsample must be lttb or max"}), 400
+    if not 3 <= max_points <= MAX_CHART_POINTS:
+        return jsonify({"error": f"max_points must be 3 to {MAX_CHART_POINTS}"}), 400
+
+    # Either a range back from now or start and end days in the user's zone
+    zone = timezones.user_timezone(user.id)
+    try:
+        end = datetime.now(zone)
+        if request.args.get("end"):
+            end = datetime.combine(
+                date.fromisoformat(request.args["end"]), time.max, zone
+            )
+        if request.args.get("start"):
+            start = datetime.combine(
+                date.fromisoformat(request.args["start"]), time(), zone
+            )
+        else:
+            start = aggregation.parse_range(request.args.get("range", "30d"), end)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def compute():
+        actions, labels, matrix = aggregation.aggregate(
+            user.id, resolution, start, end, action_ids, prop, agg
+        )
+        return {
+            "resolution": resolution,
+            "property": prop,
+            "agg": agg,
+            "start": labels[0],
+            "end": labels[-1],
+            "buckets": len(labels),
+            "series": aggregation.series(actions, labels, matrix, max_points, method),
+        }
+
+    key = ":".join(
+        [
+            f"aggregate:{user.id}:{resolution}:{method}:{max_points}",
+            f"{prop or ''}:{agg}",
+            start.strftime("%Y%m%d%H"),
+            end.strftime("%Y%m%d%H"),
+            ",".join(map(str, sorted(action_ids or []))),
+        ]
+    )
+    try:
+        entry = cache.cached(key, [cache.user_tag(user.id)], compute)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return _cached_response(entry)
 
 
 # List actions
 @api_bp.route("/actions", methods=["GET"])
 @token_required
-def api_list_actions():
-    user = user_from_token()
-    assert user is not None
-
+def api_list_actions(user):
     actions = db_session.query(Action).filter_by(user_id=user.id).all()
     return jsonify(
         [
-            {"id": a.id, "name": a.name, "notes": a.notes, "properties": a.properties}
+            {
+                "id": a.id,
+                "name": a.name,
+                "notes": a.notes,
+                "properties": a.properties,
+                "compaction": a.compaction,
+            }
             for a in actions
         ]
     )
@@ -36,44 +180,82 @@ def api_list_actions():
 # Delete an ation
 @api_bp.route("/delete/action/<int:action_id>", methods=["DELETE"])
 @token_required
-def delete_action(action_id):
-    user = user_from_token()
-    assert user is not None
-
+@retry_on_busy
+def delete_action(user, action_id):
     action = db_session.query(Action).filter_by(id=action_id, user_id=user.id).first()
     if not action:
         return jsonify({"error": "Action not found"}), 404
 
-    # Delete all logs
+    # Delete all logs, including any still queued by write-behind
+    if write_behind.enabled():
+        write_behind.queue.flush()
     db_session.query(ActivityLog).filter_by(action_id=action_id).delete()
+    delete_rollups(action_id)
     db_session.delete(action)
     db_session.commit()
+    archive.remove(user.id, action_id)
+    cache.invalidate(user.id, action_id)
+    events.publish(user.id, "action.deleted", action_id=action_id)
     return jsonify({"message": f"Action '{action.name}' and its logs deleted"}), 200
 
 
 # Delete an instance of an action, an ActivityLog
 @api_bp.route("/delete/log/<int:log_id>", methods=["DELETE"])
 @token_required
-def delete_log(log_id):
-    user = user_from_token()
-    assert user is not None
-
+@retry_on_busy
+def delete_log(user, log_id):
     log = db_session.query(ActivityLog).filter_by(id=log_id).first()
     if not log or log.action.user_id != user.id:
         return jsonify({"error": "Log not found or unauthorized"}), 404
 
+    action_id, timestamp, delta = log.action_id, log.timestamp, log.delta
+    update_rollup(action_id, timestamp, -delta, count=-1)
     db_session.delete(log)
     db_session.commit()
+    cache.invalidate(user.id, action_id)
+    events.publish_changes(
+        user.id, "log.deleted", [(action_id, timestamp, -delta)], log_id=log_id
+    )
     return jsonify({"message": "Activity log deleted"}), 200
 
 
+# List an action's logs, newest first, one page at a time
+@api_bp.route("/actions/<int:action_id>/logs", methods=["GET"])
+@token_required
+def api_list_logs(user, action_id):
+    action = db_session.query(Action).filter_by(id=action_id, user_id=user.id).first()
+    if not action:
+        return jsonify({"error": "Action not found"}), 404
+
+    limit = request.args.get("limit", default=DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    try:
+        logs, next_cursor = get_logs_page(action.id, request.args.get("cursor"), limit)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(
+        {
+            "logs": [
+                {
+                    "id": log.id,
+                    "timestamp": log.timestamp.isoformat(),
+                    "delta": log.delta,
+                    "notes": log.notes,
+                    "properties": log.properties,
+                }
+                for log in logs
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
+
+
 # Log a new activity
 @api_bp.route("/actions/<int:action_id>/logs", methods=["POST"])
 @token_required
-def api_add_log(action_id):
-    user = user_from_token()
-    assert user is not None
-
+@retry_on_busy
+def api_add_log(user, action_id):
     action = db_session.query(Action).filter_by(id=action_id, user_id=user.id).first()
     if not action:
         return jsonify({"error": "Action not found"}), 404
@@ -83,14 +265,202 @@ def api_add_log(action_id):
     delta = int(data.get("delta", 1))
     properties = data.get("properties", {})
 
-    log = ActivityLog(
-        action_id=action.id,
-        timestamp=datetime.now(timezone.utc),
-        delta=delta,
-        note=note,
-        properties=properties,
+    timestamp = datetime.now(timezone.utc)
+    written = add_log(
+        {
+            "action_id": action.id,
+            "timestamp": timestamp,
+            "delta": delta,
+            "notes": note,
+            "properties": properties,
+        }
     )
-    db_session.add(log)
-    db_session.commit()
+    cache.invalidate(user.id, action.id)
+    events.publish_changes(user.id, "log.created", [(action.id, timestamp, delta)])
 
+    if not written:
+        return jsonify({"status": "queued", "message": f"Logged '{action.name}'"}), 202
     return jsonify({"status": "ok", "message": f"Logged '{action.name}'"}), 201
+
+
+def _iter_bulk_items():
+    """
+    Yields the items of a bulk upload, either from a JSON array body or from a
+    NDJSON body read line by line so it is never fully buffered.
+    Lines that are not valid JSON are yielded as None.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+    else:
+        data = request.get_json(silent=True)
+        if not isinstance(data, list):
+            raise ValueError("Expected a JSON array or NDJSON body")
+        yield from data
+
+
+def _parse_bulk_item(item) -> dict:
+    """Validates one bulk item and returns the ActivityLog row for it."""
+    if not isinstance(item, dict):
+        raise ValueError("Invalid item")
+    if "action_id" not in item:
+        raise ValueError("action_id is required")
+
+    timestamp = item.get("timestamp")
+    if timestamp:
+        timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        timestamp = timestamp.astimezone(timezone.utc)
+    else:
+        timestamp = datetime.now(timezone.utc)
+
+    properties = item.get("properties") or {}
+    if not isinstance(properties, dict):
+        raise ValueError("properties must be an object")
+
+    # Whole numbers only, like the forms, never truncated
+    delta = item.get("delta", 1)
+    if isinstance(delta, bool) or (isinstance(delta, float) and not delta.is_integer()):
+        raise ValueError("delta must be a whole number")
+    try:
+        delta = int(delta)
+    except (TypeError, ValueError):
+        raise ValueError("delta must be a whole number") from None
+
+    return {
+        "action_id": int(item["action_id"]),
+        "timestamp": timestamp,
+        "delta": delta,
+        "notes": item.get("note", ""),
+        "properties": properties,
+    }
+
+
+# Log many activities at once
+@api_bp.route("/logs/bulk", methods=["POST"])
+@token_required
+def api_bulk_add_logs(user):
+    owned = {}  # action_id -> belongs to user, checked once per distinct id
+    written = set()
+    results = []
+    rows = []
+    # (action_id, timestamp, delta) for the live feed, only kept if it is open
+    changes = [] if events.has_listeners(user.id) else None
+
+    def flush():
+        unknown = {row["action_id"] for _, row in rows} - owned.keys()
+        if unknown:
+            found = {
+                action_id
+                for (action_id,) in db_session.query(Action.id).filter(
+                    Action.id.in_(unknown), Action.user_id == user.id
+                )
+            }
+            owned.update({action_id: action_id in found for action_id in unknown})
+
+        valid = []
+        for index, row in rows:
+            if owned[row["action_id"]]:
+                valid.append(row)
+                results.append({"index": index, "status": "ok"})
+            else:
+                results.append({"index": index, "error": "Action not found"})
+        add_logs(valid)
+        written.update(row["action_id"] for row in valid)
+        if changes is not None:
+            changes.extend((r["action_id"], r["timestamp"], r["delta"]) for r in valid)
+        rows.clear()
+
+    try:
+        for index, item in enumerate(_iter_bulk_items()):
+            try:
+                rows.append((index, _parse_bulk_item(item)))
+            except (TypeError, ValueError) as e:
+                results.append({"index": index, "error": str(e)})
+            if len(rows) >= BULK_CHUNK_SIZE:
+                flush()
+        flush()
+    except ValueError as e:
+        db_session.rollback()
+        return jsonify({"error": str(e)}), 400
+
+    db_session.commit()
+    for action_id in written:
+        cache.invalidate(user.id, action_id)
+    if changes:
+        events.publish_changes(user.id, "log.created", changes)
+
+    results.sort(key=lambda r: r["index"])
+    created = sum(1 for r in results if "error" not in r)
+    status = 201 if created == len(results) else 207
+    return jsonify({"created": created, "results": results}), status
+
+
+# Export logs as CSV or NDJSON, streamed in chunks
+@api_bp.route("/export", methods=["GET"])
+@token_required
+def api_export(user):
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    action_id = request.args.get("action_id", type=int)
+    if action_id is not None:
+        action = db_session.query(Action).filter_by(id=action_id, user_id=user.id)
+        if not action.first():
+            return jsonify({"error": "Action not found"}), 404
+
+    try:
+        start, end = parse_date_range(
+            request.args.get("start"), request.args.get("end")
+        )
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD dates"}), 400
+
+    logs = iter_logs(user.id, action_id, start, end)
+    response = Response(
+        stream_with_context(stream_export(logs, fmt)), mimetype=EXPORT_FORMATS[fmt]
+    )
+    response.headers["Content-Disposition"] = f"attachment; filename=activity.{fmt}"
+    return response
+
+
+# Import logs from a CSV or NDJSON upload, committed in chunks
+@api_bp.route("/import", methods=["POST"])
+@token_required
+def api_import(user):
+    fmt = request.args.get("format")
+    if fmt is None:
+        fmt = "ndjson" if request.mimetype in NDJSON_MIMETYPES else "csv"
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "format must be csv or ndjson"}), 400
+
+    # An interrupted upload is resumed by sending it again with
+    # skip set to the `records` count of the last successful chunk
+    skip = request.args.get("skip", 0, type=int)
+    chunk_size = request.args.get("chunk_size", IMPORT_CHUNK_SIZE, type=int)
+    if skip < 0 or chunk_size < 1:
+        return jsonify({"error": "skip and chunk_size must be positive"}), 400
+
+    stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    try:
+        result = import_logs(
+            user.id,
+            iter_records(stream, fmt),
+            create_actions=request.args.get("create_actions") == "1",
+            chunk_size=chunk_size,
+            skip=skip,
+        )
+    except (UnicodeDecodeError, csv.Error) as e:
+        db_session.rollback()
+        return jsonify({"error": f"Unreadable upload: {e}"}), 400
+
+    status = 201 if not result["failed"] else 207
+    return jsonify(result), status
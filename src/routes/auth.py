@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, session, flash
 from werkzeug.security import generate_password_hash, check_password_hash
 from models import User
-from database import db_session
+from database import db_session, retry_on_busy
 
 auth_bp = Blueprint("auth", __name__)
 
@@ -16,6 +16,7 @@ def current_user():
 
 # Register route
 @auth_bp.route("/register", methods=["GET", "POST"])
+@retry_on_busy
 def register():
     if request.method == "POST":
         username = request.form["username"]
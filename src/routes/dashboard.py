@@ -1,25 +1,41 @@
-import secrets
-from datetime import datetime, timedelta, timezone
-from flask import Blueprint, render_template, redirect, url_for, flash, request
+from flask import Blueprint, Response, render_template, redirect, url_for, flash
+from flask import request
 import numpy as np
 
-from database import db_session
-from models import Action
-from auth_helpers import login_required, current_user
-from model_helpers import summarize_actions, get_activity_timeseries
+import cache
+import events
+from database import db_session, retry_on_busy
+from models import Action, ApiToken
+from auth_helpers import (
+    DEFAULT_TOKEN_SCOPES,
+    csrf_valid,
+    issue_token,
+    login_required,
+    revoke_token,
+)
+from aggregation import lttb_indices
+from analytics import HISTORY_DAYS, MAX_ANALYTICS_DAYS, analyze
+from instrumentation import timed
+from model_helpers import (
+    get_activity_timeseries,
+    set_user_timezone,
+    summarize_actions,
+)
+from timezones import timezone_names
 
 dashboard_bp = Blueprint("dashboard", __name__, url_prefix="/dashboard")
 
+# Longer series are downsampled before they are sent to the chart
+SUMMARY_MAX_POINTS = 500
+
 
 @dashboard_bp.route("/summary/activity")
 @login_required
-def activity_summary():
-    user = current_user()
-    assert user is not None
-
+def activity_summary(user):
     # Use GET parameters
     action_id = request.args.get("action_id", type=int)
     days = request.args.get("days", default=30, type=int)
+    days = min(max(1, days), MAX_ANALYTICS_DAYS)
 
     actions = db_session.query(Action).filter_by(user_id=user.id).all()
     if not actions:
@@ -34,14 +50,34 @@ def activity_summary():
         flash("Action not found", "error")
         return redirect(url_for("action.list_actions"))
 
-    timeseries = get_activity_timeseries(user.id, action_id, days=days)
+    # Fetched with extra history so the rolling means are complete
+    full_series = cache.cached(
+        f"timeseries:{user.id}:{action_id}:{days + HISTORY_DAYS}",
+        [cache.action_tag(action_id)],
+        lambda: get_activity_timeseries(user.id, action_id, days=days + HISTORY_DAYS),
+    ).value
+    timeseries = full_series[-(days + 1) :]
     labels = [entry["date"] for entry in timeseries]
     values = [entry["delta"] for entry in timeseries]
 
-    x = np.arange(len(values))
-    y = np.array(values)
-    slope, intercept = np.polyfit(x, y, 1)
-    trend_line = (intercept + slope * x).tolist()
+    with timed("numpy"):
+        x = np.arange(len(values))
+        y = np.array(values)
+        slope, intercept = np.polyfit(x, y, 1)
+        trend_line = (intercept + slope * x).tolist()
+        history = np.array([entry["delta"] for entry in full_series])
+        stats = analyze(history, len(values)).row(0)
+
+        if len(values) > SUMMARY_MAX_POINTS:
+            # Keep the shape of the line and every anomaly, drop the rest
+            anomalies = np.array(stats["anomalies"], dtype=np.int64)
+            keep = np.union1d(lttb_indices(y, SUMMARY_MAX_POINTS), anomalies)
+            labels = [labels[i] for i in keep]
+            values = y[keep].tolist()
+            trend_line = np.array(trend_line)[keep].tolist()
+            for name in ("rolling_7", "rolling_30", "ewma", "zscores"):
+                stats[name] = np.array(stats[name])[keep].tolist()
+            stats["anomalies"] = np.searchsorted(keep, anomalies).tolist()
 
     data = {
         "action": action,
@@ -50,36 +86,111 @@ def activity_summary():
         "_values": values,
         "days": days,
         "trend_line": trend_line,
+        "stats": stats,
     }
 
     return render_template("activity_summary.j2", data=data)
 
 
+def _render_tokens(user, token=None):
+    """Token page listing the user's tokens, `token` is a just issued one."""
+    tokens = (
+        db_session.query(ApiToken)
+        .filter_by(user_id=user.id)
+        .order_by(ApiToken.created_at.desc())
+        .all()
+    )
+    return render_template("token.j2", token=token, tokens=tokens)
+
+
 # Show token page
 @dashboard_bp.route("/token")
 @login_required
-def show_token():
-    user = current_user()
-    assert user is not None
+def show_token(user):
+    return _render_tokens(user)
+
+
+# Generate a new token, replacing the existing ones unless keep=1 is passed
+@dashboard_bp.route("/token/generate", methods=["POST"])
+@login_required
+@retry_on_busy
+def generate_token(user):
+    if not csrf_valid():
+        flash("Invalid form, please try again", "error")
+        return redirect(url_for("dashboard.show_token"))
+
+    days = request.form.get("days", default=30, type=int)
+    scopes = request.form.get("scopes", default=DEFAULT_TOKEN_SCOPES)
+    rotate = not request.form.get("keep", default=0, type=int)
+
+    try:
+        token = issue_token(user.id, days=days, scopes=scopes, rotate=rotate)
+    except ValueError as e:
+        flash(str(e), "error")
+        return redirect(url_for("dashboard.show_token"))
+
+    # The token is only shown this once, just its digest is stored
+    flash("New API token generated!", "success")
+    return _render_tokens(user, token=token)
 
-    token = user.api_token
-    expiry = user.token_expiry
-    return render_template("token.j2", token=token, expiry=expiry)
 
+# Revoke a token
+@dashboard_bp.route("/token/<int:token_id>/revoke", methods=["POST"])
+@login_required
+@retry_on_busy
+def revoke_api_token(user, token_id):
+    if not csrf_valid():
+        flash("Invalid form, please try again", "error")
+    elif revoke_token(user.id, token_id):
+        flash("API token revoked", "info")
+    else:
+        flash("Token not found", "error")
+    return redirect(url_for("dashboard.show_token"))
 
-# Generate a new token
-@dashboard_bp.route("/token/generate")
+
+# Show and change the user's settings
+@dashboard_bp.route("/settings", methods=["GET", "POST"])
 @login_required
-def generate_token():
-    user = current_user()
-    assert user is not None
+@retry_on_busy
+def settings(user):
+    if request.method == "POST":
+        try:
+            set_user_timezone(user, request.form.get("timezone", "").strip())
+        except ValueError as e:
+            flash(str(e), "error")
+            return redirect(url_for("dashboard.settings"))
 
-    token = secrets.token_hex(16)
-    expiry = datetime.now(timezone.utc) + timedelta(days=30)
+        # Every cached series of the user was bucketed in the old zone
+        cache.invalidate(user.id)
+        for action in user.actions:
+            cache.invalidate(user.id, action.id)
+        events.publish(user.id, "resync")
 
-    user.api_token = token
-    user.token_expiry = expiry
-    db_session.commit()
+        flash(f"Time zone set to {user.timezone}", "info")
+        return redirect(url_for("dashboard.settings"))
 
-    flash("New API token generated!", "success")
-    return redirect(url_for("dashboard.show_token"))
+    return render_template("settings.j2", user=user, timezones=timezone_names())
+
+
+# Live feed of the user's log changes as Server-Sent Events
+@dashboard_bp.route("/events")
+@login_required
+def activity_events(user):
+    subscription = events.broker.subscribe(user.id)
+    if subscription is None:
+        return "Too many open event streams", 429
+
+    # The stream stays open for a long time, it needs no DB connection
+    db_session.remove()
+
+    def generate():
+        try:
+            yield from events.stream(subscription)
+        finally:
+            events.broker.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Tells nginx not to buffer the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
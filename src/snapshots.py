@@ -0,0 +1,433 @@
+# snapshots.py
+"""
+Materialized dashboard data of each user.
+
+A snapshot holds the daily totals of the user's actions over the dashboard
+window and the days before it that the rolling averages need, as one array
+with the oldest day first. It is built from the rollup once and then kept up
+to date from the change events of events.py: a log write adds its delta to
+one cell and to the running totals, and the window rolls forward lazily when
+the user's day changes. The dashboard statistics are derived from the array
+on the next visit after a change, without a query. Every change gives the
+touched rows and the snapshot new version numbers, which key the cached
+dashboard fragments.
+
+Snapshots are written to SNAPSHOT_DIR on shutdown and loaded on the next
+start. Each one keeps the rollup watermark it was built at and the days its
+events touched since. Before a snapshot is served, rollup rows written after
+the watermark must all be such days, else a write was made outside the app,
+e.g. by the CLI or while the server was down, and it is built again.
+"""
+import atexit
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+import broadcast
+import events
+import timezones
+from analytics import HISTORY_DAYS, analyze
+from instrumentation import timed
+from model_helpers import (
+    get_activity_matrix,
+    linear_trend,
+    rollup_changes,
+    rollup_watermark,
+)
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR: str = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_MAX_AGE: int = int(os.getenv("SNAPSHOT_MAX_AGE", 3600))
+SNAPSHOT_MAX_USERS: int = int(os.getenv("SNAPSHOT_MAX_USERS", 10_000))
+DASHBOARD_DAYS = 30
+# Days shown on the dashboard, today included
+SHOWN_DAYS = DASHBOARD_DAYS + 1
+CHANGE_EVENTS = ("log.created", "log.updated", "log.deleted")
+
+# Version numbers, never reused within a process so no fragment cached for
+# an earlier snapshot of the user matches a later one
+_versions = itertools.count(1)
+
+
+@dataclass
+class Snapshot:
+    action_ids: list[int]
+    names: list[str]
+    timezone: str
+    # Local day of the last column
+    end: date
+    # Daily totals, shape (actions, HISTORY_DAYS + SHOWN_DAYS)
+    values: np.ndarray
+    built_at: float
+    # Rollup watermark the values include, naive UTC
+    watermark: datetime | None
+    # (action_id, day) changed by events after the watermark
+    touched: set[tuple[int, date]] = field(default_factory=set, repr=False)
+    rows: dict[int, int] = field(init=False, repr=False)
+    row_totals: np.ndarray = field(init=False, repr=False)
+    total: int = field(init=False)
+    versions: list[int] = field(init=False, repr=False)
+    version: int = field(init=False)
+    # Template context, derived again after every change
+    context: dict | None = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.rows = {action_id: i for i, action_id in enumerate(self.action_ids)}
+        self._sum_totals()
+        self._new_versions()
+
+    def _new_versions(self):
+        self.versions = [next(_versions) for _ in self.action_ids]
+        self.version = next(_versions)
+
+    def _sum_totals(self):
+        self.row_totals = self.values[:, -SHOWN_DAYS:].sum(axis=1)
+        self.total = int(self.row_totals.sum())
+
+    def expired(self) -> bool:
+        return time.time() - self.built_at > SNAPSHOT_MAX_AGE
+
+    def roll(self, day: date):
+        """Moves the window forward so that it ends on `day`."""
+        shift = (day - self.end).days
+        if shift <= 0:
+            return
+        if shift < self.values.shape[1]:
+            self.values[:, :-shift] = self.values[:, shift:]
+        self.values[:, -shift:] = 0
+        self.end = day
+        self._sum_totals()
+        self._new_versions()
+        self.context = None
+
+    def add(self, action_id: int, day: date, delta: int) -> bool:
+        """Adds `delta` to a day's total, False if the action is unknown."""
+        row = self.rows.get(action_id)
+        if row is None:
+            return False
+        self.roll(day)
+        self.touched.add((action_id, day))
+        col = self.values.shape[1] - 1 - (self.end - day).days
+        if col >= 0:
+            self.values[row, col] += delta
+            if col >= self.values.shape[1] - SHOWN_DAYS:
+                self.row_totals[row] += delta
+                self.total += delta
+            self.versions[row] = next(_versions)
+            self.version = next(_versions)
+            self.context = None
+        return True
+
+
+_snapshots: OrderedDict[int, Snapshot] = OrderedDict()
+# Users with a snapshot file from an earlier run that is not loaded yet
+_on_disk: set[int] = set()
+# Builds running per user and the changes seen meanwhile, a build is only
+# kept if none came in. Both only have entries while a build runs.
+_building: dict[int, int] = {}
+_generations: dict[int, int] = {}
+_lock = threading.Lock()
+_counts = {"hits": 0, "builds": 0, "loads": 0}
+
+
+def _path(user_id: int) -> Path:
+    return Path(SNAPSHOT_DIR) / f"{user_id}.npz"
+
+
+def _build(user_id: int) -> Snapshot:
+    # Read first, a write committed during the build only costs another one
+    watermark = rollup_watermark(user_id)
+    actions, labels, matrix = get_activity_matrix(
+        user_id, days=DASHBOARD_DAYS + HISTORY_DAYS
+    )
+    return Snapshot(
+        action_ids=[action.id for action in actions],
+        names=[action.name for action in actions],
+        timezone=timezones.user_timezone(user_id).key,
+        end=date.fromisoformat(labels[-1]),
+        values=matrix,
+        built_at=time.time(),
+        watermark=watermark,
+    )
+
+
+def _save(user_id: int, snapshot: Snapshot):
+    path = _path(user_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with tmp.open("wb") as f:
+        np.savez(
+            f,
+            action_ids=np.array(snapshot.action_ids, dtype=np.int64),
+            names=np.array(snapshot.names, dtype=str),
+            timezone=np.array(snapshot.timezone),
+            end=np.array(snapshot.end.toordinal()),
+            values=snapshot.values,
+            built_at=np.array(snapshot.built_at),
+            watermark=np.array(
+                snapshot.watermark.isoformat() if snapshot.watermark else ""
+            ),
+            touched=np.array(
+                [(action_id, day.toordinal()) for action_id, day in snapshot.touched],
+                dtype=np.int64,
+            ).reshape(-1, 2),
+        )
+    os.replace(tmp, path)
+
+
+def _load(user_id: int) -> Snapshot | None:
+    """
+    Reads the user's snapshot file and removes it, from now on the snapshot
+    in memory is the current one.
+    """
+    path = _path(user_id)
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            snapshot = Snapshot(
+                action_ids=data["action_ids"].tolist(),
+                names=data["names"].tolist(),
+                timezone=str(data["timezone"]),
+                end=date.fromordinal(int(data["end"])),
+                values=data["values"],
+                built_at=float(data["built_at"]),
+                watermark=(
+                    datetime.fromisoformat(str(data["watermark"]))
+                    if str(data["watermark"])
+                    else None
+                ),
+                touched={
+                    (action_id, date.fromordinal(day))
+                    for action_id, day in data["touched"].tolist()
+                },
+            )
+    except FileNotFoundError:
+        return None
+    except (OSError, KeyError, ValueError):
+        logger.warning("Ignoring unreadable snapshot %s", path)
+        snapshot = None
+    finally:
+        path.unlink(missing_ok=True)
+
+    zone = timezones.user_timezone(user_id).key
+    if snapshot is None or snapshot.expired() or snapshot.timezone != zone:
+        return None
+    if not _is_current(user_id, snapshot):
+        return None
+    return snapshot
+
+
+def _is_current(user_id: int, snapshot: Snapshot) -> bool:
+    """
+    Whether every rollup row written after the snapshot's watermark is one
+    of the days its events touched. Those rows move the watermark forward.
+    """
+    changes = rollup_changes(user_id, snapshot.watermark)
+    days = {(action_id, day) for action_id, day, _ in changes}
+    with _lock:
+        if not days <= snapshot.touched:
+            return False
+        if changes:
+            snapshot.watermark = max(updated_at for _, _, updated_at in changes)
+            snapshot.touched -= days
+    return True
+
+
+def _forget(user_id: int):
+    _snapshots.pop(user_id, None)
+    if user_id in _on_disk:
+        _on_disk.discard(user_id)
+        _path(user_id).unlink(missing_ok=True)
+    events.unwatch(user_id)
+
+
+def _snapshot(user_id: int) -> Snapshot:
+    """The user's current snapshot, loaded or built when needed."""
+    with _lock:
+        snapshot = _snapshots.get(user_id)
+        if snapshot is not None and snapshot.expired():
+            _forget(user_id)
+            snapshot = None
+    # Checked outside the lock, it queries the database
+    if snapshot is not None and not _is_current(user_id, snapshot):
+        with _lock:
+            if _snapshots.get(user_id) is snapshot:
+                _forget(user_id)
+        snapshot = None
+
+    with _lock:
+        if snapshot is not None:
+            _snapshots.move_to_end(user_id)
+            _counts["hits"] += 1
+            return snapshot
+        _building[user_id] = _building.get(user_id, 0) + 1
+        generation = _generations.get(user_id, 0)
+        # Watch before reading so no change committed after the read is missed
+        events.watch(user_id)
+        loaded = user_id in _on_disk
+        _on_disk.discard(user_id)
+
+    try:
+        snapshot = _load(user_id) if loaded else None
+        built = snapshot is None
+        if built:
+            snapshot = _build(user_id)
+    finally:
+        with _lock:
+            changed = _generations.get(user_id, 0) != generation
+            _building[user_id] -= 1
+            if not _building[user_id]:
+                del _building[user_id]
+                _generations.pop(user_id, None)
+
+    with _lock:
+        _counts["builds" if built else "loads"] += 1
+        if changed:
+            # Changed while it was read, the next visit builds it again
+            return snapshot
+        _snapshots[user_id] = snapshot
+        while len(_snapshots) > SNAPSHOT_MAX_USERS:
+            evicted, _ = _snapshots.popitem(last=False)
+            events.unwatch(evicted)
+    return snapshot
+
+
+def _context(snapshot: Snapshot) -> dict:
+    """Template context of dashboard.j2."""
+    labels = [
+        (snapshot.end - timedelta(days=SHOWN_DAYS - 1 - i)).isoformat()
+        for i in range(SHOWN_DAYS)
+    ]
+    shown = snapshot.values[:, -SHOWN_DAYS:]
+    with timed("numpy"):
+        stats = analyze(snapshot.values, SHOWN_DAYS)
+        trend_lines = linear_trend(shown)
+
+    activity_data = []
+    for i, (action_id, name) in enumerate(zip(snapshot.action_ids, snapshot.names)):
+        activity_data.append(
+            {
+                "id": action_id,
+                "version": snapshot.versions[i],
+                "name": name,
+                "values": shown[i].tolist(),
+                "trend_line": trend_lines[i].tolist(),
+                "labels": labels,
+                "stats": stats.row(i),
+            }
+        )
+
+    # Summary chart of the totals per action
+    summary_counts = {
+        name: int(total) for name, total in zip(snapshot.names, snapshot.row_totals)
+    }
+
+    # Change of the last 7 days against the week before, over all actions
+    last_week = int(stats.last_week.sum())
+    trend_change = (
+        round((int(stats.this_week.sum()) - last_week) / abs(last_week) * 100, 1)
+        if last_week
+        else 0
+    )
+
+    return {
+        "activity_data": activity_data,
+        "version": snapshot.version,
+        "total_actions": snapshot.total,
+        "period": f"last {DASHBOARD_DAYS} days",
+        "trend_change": trend_change,
+        "labels": list(summary_counts.keys()),
+        "values": list(summary_counts.values()),
+    }
+
+
+def dashboard(user_id: int) -> dict:
+    """Returns the dashboard template context of a user."""
+    today = datetime.now(timezones.user_timezone(user_id)).date()
+    snapshot = _snapshot(user_id)
+    with _lock:
+        snapshot.roll(today)
+        if snapshot.context is None:
+            snapshot.context = _context(snapshot)
+        return snapshot.context
+
+
+def _changed(user_id: int):
+    if user_id in _building:
+        _generations[user_id] = _generations.get(user_id, 0) + 1
+
+
+def apply_changes(user_id: int, changes: list[dict]):
+    """
+    Adds changes of daily totals to the user's snapshot, as published by
+    events.publish_changes: [{"action_id": ..., "day": ..., "delta": ...}]
+    """
+    with _lock:
+        _changed(user_id)
+        snapshot = _snapshots.get(user_id)
+        if snapshot is None:
+            # Only a file would be left behind without this change
+            _forget(user_id)
+            return
+        for change in changes:
+            day = date.fromisoformat(change["day"])
+            if not snapshot.add(change["action_id"], day, change["delta"]):
+                _forget(user_id)
+                return
+
+
+def drop(user_id: int):
+    """Discards the user's snapshot, it is built again on the next visit."""
+    with _lock:
+        _changed(user_id)
+        _forget(user_id)
+
+
+def _on_event(message: dict):
+    event = message["event"]
+    if event["type"] in CHANGE_EVENTS:
+        apply_changes(message["user_id"], event["changes"])
+    else:
+        # New, renamed or deleted actions and resyncs rebuild the snapshot
+        drop(message["user_id"])
+
+
+def save_all():
+    """Writes every snapshot in memory to SNAPSHOT_DIR."""
+    with _lock:
+        for user_id, snapshot in _snapshots.items():
+            try:
+                _save(user_id, snapshot)
+            except OSError:
+                logger.exception("Failed to save the snapshot of user %d", user_id)
+
+
+def stats() -> dict:
+    with _lock:
+        return {
+            "snapshots": len(_snapshots),
+            **{f"snapshot_{name}_total": count for name, count in _counts.items()},
+        }
+
+
+def _scan():
+    """Watches the users with a snapshot file so their changes drop it."""
+    path = Path(SNAPSHOT_DIR)
+    if path.is_dir():
+        for file in path.glob("*.npz"):
+            if file.stem.isdigit():
+                _on_disk.add(int(file.stem))
+                events.watch(int(file.stem))
+
+
+_scan()
+broadcast.subscribe("events", _on_event)
+atexit.register(save_all)
@@ -0,0 +1,86 @@
+# conftest.py
+"""
+Fixtures of the test suite: the app on a fresh SQLite database per session,
+written to a temporary directory together with snapshots and archives.
+"""
+import os
+import tempfile
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import select
+
+# Read by the modules at import, set before any of them is imported
+_tmp = tempfile.mkdtemp(prefix="activtracker-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmp, 'tracker.sqlite3')}"
+os.environ["SNAPSHOT_DIR"] = os.path.join(_tmp, "snapshots")
+os.environ["ARCHIVE_DIR"] = os.path.join(_tmp, "archive")
+os.environ["REPORT_DIR"] = os.path.join(_tmp, "reports")
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from database import db_session, init_db  # noqa: E402
+from model_helpers import add_logs  # noqa: E402
+from models import Action, ActivityLog, User  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    init_db()
+    from app import app
+
+    app.config["TESTING"] = True
+    app.secret_key = "test"
+    return app
+
+
+@pytest.fixture
+def account(app) -> dict:
+    """Ids of a new user, their action and its log."""
+    user = User(
+        username=f"user{db_session.query(User).count()}",
+        password_hash=generate_password_hash("password"),
+    )
+    db_session.add(user)
+    db_session.flush()
+    action = Action(name=f"action of {user.username}", user_id=user.id)
+    db_session.add(action)
+    db_session.flush()
+    # Through add_logs so the rollup counts it too
+    add_logs(
+        [
+            {
+                "action_id": action.id,
+                "timestamp": datetime.now(timezone.utc),
+                "delta": 1,
+                "notes": "",
+                "properties": {},
+            }
+        ]
+    )
+    log_id = db_session.scalar(
+        select(ActivityLog.id).where(ActivityLog.action_id == action.id)
+    )
+    ids = {"user_id": user.id, "action_id": action.id, "log_id": log_id}
+    db_session.commit()
+    db_session.remove()
+    return ids
+
+
+@pytest.fixture
+def client(app, account):
+    """Test client logged in as the user of `account`."""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = account["user_id"]
+    return client
+
+
+@pytest.fixture
+def api_headers(account) -> dict:
+    """Authorization header with a read and write token of `account`."""
+    from auth_helpers import issue_token
+
+    token = issue_token(account["user_id"])
+    db_session.remove()
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,21 @@
+# test_actions.py
+"""Form handling of the action pages."""
+from database import db_session
+from models import ActivityLog
+
+
+def test_edit_log_rejects_bad_delta(client, account):
+    response = client.post(
+        f"/actions/edit/log/{account['log_id']}", data={"delta": "abc"}
+    )
+    assert response.status_code == 302
+    assert db_session.get(ActivityLog, account["log_id"]).delta == 1
+
+
+def test_add_log_rejects_bad_delta(client, account):
+    url = f"/actions/{account['action_id']}/log"
+    response = client.post(url, data={"delta": "1.5"})
+    assert response.status_code == 302
+    assert response.location.endswith(url)
+    logs = db_session.query(ActivityLog).filter_by(action_id=account["action_id"])
+    assert logs.count() == 1
@@ -0,0 +1,28 @@
+# test_api.py
+"""Validation of the JSON API."""
+from sqlalchemy import select
+
+from database import db_session
+from models import ActivityLog
+
+
+def test_bulk_rejects_deltas_that_are_not_whole_numbers(client, account, api_headers):
+    action_id = account["action_id"]
+    items = [
+        {"action_id": action_id, "delta": 2},
+        {"action_id": action_id, "delta": 1.5},
+        {"action_id": action_id, "delta": True},
+        {"action_id": action_id, "delta": 3.0},
+    ]
+
+    response = client.post("/api/logs/bulk", json=items, headers=api_headers)
+
+    assert response.status_code == 207
+    results = sorted(response.get_json()["results"], key=lambda r: r["index"])
+    assert [result.get("status") for result in results] == ["ok", None, None, "ok"]
+    deltas = db_session.scalars(
+        select(ActivityLog.delta)
+        .where(ActivityLog.action_id == action_id)
+        .order_by(ActivityLog.id)
+    ).all()
+    assert deltas == [1, 2, 3]
@@ -0,0 +1,68 @@
+# test_compaction.py
+"""Merging of plain logs per window."""
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, select
+
+import compaction
+from database import db_session
+from importer import import_logs
+from model_helpers import rebuild_rollups
+from models import Action, ActivityLog, DailyRollup
+
+
+def totals(action_id: int):
+    """(delta sum, log count) of an action's logs and of its rollup."""
+    logs = db_session.execute(
+        select(func.sum(ActivityLog.delta), func.count(ActivityLog.id)).where(
+            ActivityLog.action_id == action_id
+        )
+    ).one()
+    rollup = db_session.execute(
+        select(func.sum(DailyRollup.sum_delta), func.sum(DailyRollup.count)).where(
+            DailyRollup.action_id == action_id
+        )
+    ).one()
+    return tuple(logs), tuple(rollup)
+
+
+def test_compact_logs_merges_across_batches(account, monkeypatch):
+    action_id = account["action_id"]
+    start = datetime(2026, 3, 1, 10, tzinfo=timezone.utc)
+    db_session.execute(
+        ActivityLog.__table__.insert(),
+        [
+            {
+                "action_id": action_id,
+                "timestamp": start + timedelta(minutes=7 * i),
+                "delta": 1,
+                "notes": "kept" if i == 4 else "",
+                "properties": {},
+            }
+            for i in range(20)
+        ],
+    )
+    rebuild_rollups([action_id])
+    db_session.get(Action, action_id).compaction = "hour"
+    db_session.commit()
+
+    monkeypatch.setattr(compaction, "COMPACT_BATCH", 3)
+    result = compaction.compact_logs(account["user_id"])
+
+    # 9, 9 and 2 logs in three hours, one with notes, and the fixture's
+    assert result == {"actions": 1, "removed": 16}
+    assert totals(action_id) == ((21, 5), (21, 5))
+
+
+def test_import_adds_to_windows(account):
+    action_id = account["action_id"]
+    db_session.get(Action, action_id).compaction = "day"
+    db_session.commit()
+    name = db_session.get(Action, action_id).name
+    timestamp = datetime.now(timezone.utc).isoformat()
+    records = [(i, {"action": name, "timestamp": timestamp}) for i in range(1, 4)]
+
+    result = import_logs(account["user_id"], records)
+
+    assert result["imported"] == 3
+    assert totals(action_id) == ((4, 1), (4, 1))
@@ -0,0 +1,19 @@
+# test_dashboard.py
+"""Parameter handling of the dashboard pages."""
+from analytics import HISTORY_DAYS, MAX_ANALYTICS_DAYS
+import routes.dashboard
+
+
+def test_activity_summary_clamps_days(client, account, monkeypatch):
+    fetched = []
+    timeseries = routes.dashboard.get_activity_timeseries
+
+    def spy(user_id, action_id, days):
+        fetched.append(days)
+        return timeseries(user_id, action_id, days=days)
+
+    monkeypatch.setattr(routes.dashboard, "get_activity_timeseries", spy)
+    for days in (10_000_000, -5):
+        response = client.get(f"/dashboard/summary/activity?days={days}")
+        assert response.status_code == 200
+    assert fetched == [MAX_ANALYTICS_DAYS + HISTORY_DAYS, 1 + HISTORY_DAYS]
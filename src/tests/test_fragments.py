@@ -0,0 +1,28 @@
+# test_fragments.py
+"""Cached template fragments and writes made outside the app."""
+from datetime import datetime, timezone
+
+from database import db_session
+from model_helpers import add_logs
+
+
+def test_history_shows_logs_written_by_another_process(client, account):
+    url = f"/actions/{account['action_id']}"
+    assert b"imported" not in client.get(url).data
+
+    # What import-logs does, with no invalidation reaching this process
+    add_logs(
+        [
+            {
+                "action_id": account["action_id"],
+                "timestamp": datetime.now(timezone.utc),
+                "delta": 1,
+                "notes": "imported",
+                "properties": {},
+            }
+        ]
+    )
+    db_session.commit()
+    db_session.remove()
+
+    assert b"imported" in client.get(url).data
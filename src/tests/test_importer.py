@@ -0,0 +1,60 @@
+# test_importer.py
+"""Bulk import of activity logs."""
+from sqlalchemy import func, select
+
+from database import db_session
+from importer import import_logs
+from models import Action, ActivityLog, DailyRollup, User
+
+
+def test_create_actions_rejects_names_of_other_users(account):
+    taken = db_session.get(Action, account["action_id"]).name
+    other = User(username=f"importer of {taken}", password_hash="")
+    db_session.add(other)
+    db_session.commit()
+    other = other.id
+    db_session.remove()
+    records = [
+        (1, {"action": "fresh name", "delta": "2"}),
+        (2, {"action": taken, "delta": "1"}),
+        (3, {"action": "fresh name", "delta": "3"}),
+    ]
+
+    result = import_logs(other, records, create_actions=True)
+
+    assert result["imported"] == 2
+    assert result["created_actions"] == ["fresh name"]
+    assert result["errors"] == [
+        {"line": 2, "error": f"Action name '{taken}' is already taken"}
+    ]
+    assert db_session.get(Action, account["action_id"]).user_id == account["user_id"]
+
+
+def test_import_keeps_zero_deltas_and_rejects_fractions(account):
+    name = db_session.get(Action, account["action_id"]).name
+    db_session.remove()
+    records = [
+        (1, {"action": name, "delta": 0}),
+        (2, {"action": name, "delta": "0"}),
+        (3, {"action": name, "delta": ""}),
+        (4, {"action": name, "delta": 1.5}),
+        (5, {"action": name, "delta": True}),
+    ]
+
+    result = import_logs(account["user_id"], records)
+
+    assert result["imported"] == 3
+    assert [error["line"] for error in result["errors"]] == [4, 5]
+    deltas = db_session.scalars(
+        select(ActivityLog.delta)
+        .where(ActivityLog.action_id == account["action_id"])
+        .order_by(ActivityLog.id)
+    ).all()
+    # The fixture's log, then the imported ones
+    assert deltas == [1, 0, 0, 1]
+    rollup = db_session.scalar(
+        select(func.sum(DailyRollup.sum_delta)).where(
+            DailyRollup.action_id == account["action_id"]
+        )
+    )
+    assert rollup == 2
@@ -0,0 +1,22 @@
+# test_instrumentation.py
+"""Access to the /metrics endpoint."""
+import instrumentation
+
+
+def test_metrics_only_for_loopback_clients(app):
+    client = app.test_client()
+    assert client.get("/metrics").status_code == 200
+    remote = {"REMOTE_ADDR": "203.0.113.7"}
+    assert client.get("/metrics", environ_base=remote).status_code == 403
+
+
+def test_metrics_token(app, monkeypatch):
+    monkeypatch.setattr(instrumentation, "METRICS_TOKEN", "secret")
+    client = app.test_client()
+    assert client.get("/metrics").status_code == 403
+    wrong = {"Authorization": "Bearer nope"}
+    assert client.get("/metrics", headers=wrong).status_code == 403
+    right = {"Authorization": "Bearer secret"}
+    response = client.get("/metrics", headers=right)
+    assert response.status_code == 200
+    assert b"http_requests_total" in response.data
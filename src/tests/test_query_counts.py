@@ -0,0 +1,107 @@
+# test_query_counts.py
+"""
+Statements issued per request, counted with a before_cursor_execute hook on
+a cold process: every per-process cache is emptied first. Session routes
+must read the users table once. API routes must look their token up once
+and read the users table at most once, for the user's time zone.
+"""
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import event
+
+import timezones
+from database import engine
+
+NOW = datetime.now(timezone.utc).isoformat()
+
+# (method, url, request arguments), {action_id} and {log_id} are filled in
+SESSION_ROUTES = [
+    ("GET", "/", {}),
+    ("GET", "/actions/", {}),
+    ("GET", "/actions/{action_id}", {}),
+    ("POST", "/actions/{action_id}/log", {"data": {"delta": "2"}}),
+    ("POST", "/actions/edit/log/{log_id}", {"data": {"delta": "3"}}),
+    ("GET", "/dashboard/summary/activity", {}),
+]
+API_ROUTES = [
+    ("GET", "/api/summary", {}),
+    ("GET", "/api/analytics", {}),
+    ("GET", "/api/aggregate", {}),
+    ("GET", "/api/actions", {}),
+    ("GET", "/api/actions/{action_id}/logs", {}),
+    ("POST", "/api/actions/{action_id}/logs", {"json": {"delta": 2}}),
+    (
+        "POST",
+        "/api/logs/bulk",
+        {"json": [{"action_id": "{action_id}", "delta": 1, "timestamp": NOW}]},
+    ),
+    ("GET", "/api/export", {}),
+]
+
+
+@pytest.fixture
+def statements():
+    """Collects the SQL of the statements run while the test is running."""
+    seen = []
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        seen.append(" ".join(statement.split()))
+
+    timezones._user_zones.clear()
+    timezones._action_zones.clear()
+    event.listen(engine, "before_cursor_execute", collect)
+    yield seen
+    event.remove(engine, "before_cursor_execute", collect)
+
+
+def user_lookups(statements: list[str]) -> int:
+    """Statements reading the users table."""
+    return sum(
+        " FROM users" in statement or " JOIN users" in statement
+        for statement in statements
+    )
+
+
+def token_lookups(statements: list[str]) -> int:
+    return sum(" FROM api_tokens" in statement for statement in statements)
+
+
+def fill(value, account: dict):
+    """`value` with the ids of `account` filled into its strings."""
+    if isinstance(value, str):
+        filled = value.format(**account)
+        return int(filled) if value == "{action_id}" else filled
+    if isinstance(value, dict):
+        return {key: fill(item, account) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, account) for item in value]
+    return value
+
+
+def request(client, account, method, url, kwargs, **extra):
+    response = client.open(
+        fill(url, account), method=method, **fill(kwargs, account), **extra
+    )
+    # Exhausts streamed responses so their statements are counted
+    response.get_data()
+    return response
+
+
+@pytest.mark.parametrize("method, url, kwargs", SESSION_ROUTES)
+def test_session_routes_look_user_up_once(
+    client, account, method, url, kwargs, statements
+):
+    response = request(client, account, method, url, kwargs)
+    assert response.status_code in (200, 302)
+    assert user_lookups(statements) == 1
+
+
+@pytest.mark.parametrize("method, url, kwargs", API_ROUTES)
+def test_api_routes_look_user_up_once(
+    client, account, api_headers, method, url, kwargs, statements
+):
+    response = request(client, account, method, url, kwargs, headers=api_headers)
+    assert response.status_code in (200, 201, 207)
+    assert token_lookups(statements) == 1
+    assert user_lookups(statements) <= 1
@@ -0,0 +1,64 @@
+# test_snapshots.py
+"""Dashboard snapshots and writes made outside the app."""
+from datetime import datetime, timezone
+
+import events
+import snapshots
+from database import db_session
+from model_helpers import add_logs
+
+
+def write_log(account: dict, delta: int, publish: bool):
+    timestamp = datetime.now(timezone.utc)
+    add_logs(
+        [
+            {
+                "action_id": account["action_id"],
+                "timestamp": timestamp,
+                "delta": delta,
+                "notes": "",
+                "properties": {},
+            }
+        ]
+    )
+    db_session.commit()
+    if publish:
+        changes = [(account["action_id"], timestamp, delta)]
+        events.publish_changes(account["user_id"], "log.created", changes)
+    db_session.remove()
+
+
+def total(user_id: int) -> int:
+    total = snapshots.dashboard(user_id)["total_actions"]
+    db_session.remove()
+    return total
+
+
+def test_writes_of_the_app_update_the_snapshot(app, account):
+    user_id = account["user_id"]
+    assert total(user_id) == 1
+    builds = snapshots.stats()["snapshot_builds_total"]
+
+    write_log(account, 2, publish=True)
+    assert total(user_id) == 3
+    assert snapshots.stats()["snapshot_builds_total"] == builds
+
+
+def test_writes_outside_the_app_rebuild_the_snapshot(app, account):
+    user_id = account["user_id"]
+    assert total(user_id) == 1
+
+    write_log(account, 4, publish=False)
+    assert total(user_id) == 5
+
+
+def test_saved_snapshot_is_rebuilt_after_writes_outside_the_app(app, account):
+    user_id = account["user_id"]
+    assert total(user_id) == 1
+    snapshots.save_all()
+    snapshots.drop(user_id)
+    snapshots._on_disk.add(user_id)
+
+    write_log(account, 5, publish=False)
+    assert total(user_id) == 6
+    assert not snapshots._generations
@@ -0,0 +1,48 @@
+# test_tokens.py
+"""Issuing and revoking API tokens from the token page."""
+from datetime import datetime, timedelta, timezone
+
+from auth_helpers import MAX_TOKEN_DAYS
+from database import db_session
+from models import ApiToken
+
+
+def tokens(user_id: int) -> list[ApiToken]:
+    db_session.remove()
+    return db_session.query(ApiToken).filter_by(user_id=user_id).all()
+
+
+def csrf(client) -> str:
+    with client.session_transaction() as session:
+        session["csrf_token"] = "form-token"
+    return "form-token"
+
+
+def test_generate_needs_post_and_csrf_token(client, account):
+    assert client.get("/dashboard/token/generate").status_code == 405
+    client.post("/dashboard/token/generate", data={"csrf_token": "forged"})
+    assert tokens(account["user_id"]) == []
+
+
+def test_generate_clamps_days_and_checks_scopes(client, account):
+    data = {"csrf_token": csrf(client), "days": str(10**12)}
+    assert client.post("/dashboard/token/generate", data=data).status_code == 200
+    (token,) = tokens(account["user_id"])
+    latest = datetime.now(timezone.utc) + timedelta(days=MAX_TOKEN_DAYS)
+    assert token.expires_at <= latest.replace(tzinfo=None)
+
+    data.update(scopes="read admin", keep="1")
+    client.post("/dashboard/token/generate", data=data)
+    assert len(tokens(account["user_id"])) == 1
+
+
+def test_revoke_needs_csrf_token(client, account):
+    data = {"csrf_token": csrf(client), "scopes": "read"}
+    client.post("/dashboard/token/generate", data=data)
+    (token,) = tokens(account["user_id"])
+    url = f"/dashboard/token/{token.id}/revoke"
+
+    client.post(url)
+    assert len(tokens(account["user_id"])) == 1
+    client.post(url, data=data)
+    assert tokens(account["user_id"]) == []
@@ -0,0 +1,181 @@
+# timezones.py
+"""
+Per user time zones, used to bucket activity into the user's local days.
+
+Timestamps are stored as naive UTC. The daily rollup is keyed by the local
+day of the action's owner: in Python through `local_day` and in SQL through
+`day_column`, which pushes the bucketing into the database. PostgreSQL
+converts with AT TIME ZONE, SQLite has no time zone support and gets a CASE
+over the zone's UTC offsets in the queried range instead, so both follow
+daylight saving changes like the Python side does.
+"""
+from datetime import date, datetime, timedelta, timezone
+from functools import cache
+from zoneinfo import ZoneInfo, available_timezones
+
+from sqlalchemy import Date, case, cast, func, select
+
+import broadcast
+from database import db_session
+from models import Action, User
+
+DEFAULT_TIMEZONE = "UTC"
+
+# Zones looked up once per process, dropped by forget() when a user changes
+# theirs. Actions never move between users so their zone only changes then.
+_user_zones: dict[int, ZoneInfo] = {}
+_action_zones: dict[int, ZoneInfo] = {}
+
+
+@cache
+def timezone_names() -> list[str]:
+    return sorted(available_timezones())
+
+
+def user_timezone(user_id: int) -> ZoneInfo:
+    zone = _user_zones.get(user_id)
+    if zone is None:
+        name = db_session.scalar(select(User.timezone).where(User.id == user_id))
+        zone = _user_zones[user_id] = ZoneInfo(name or DEFAULT_TIMEZONE)
+    return zone
+
+
+def remember(user: User):
+    """Keeps the zone of a user that was loaded anyway, e.g. the logged-in one."""
+    _user_zones[user.id] = ZoneInfo(user.timezone or DEFAULT_TIMEZONE)
+
+
+def action_timezones(action_ids) -> dict[int, ZoneInfo]:
+    """
+    Returns the zone of the owner of every action. Misses cost a query for
+    their owners and one more for the owners whose zone is not known yet.
+    """
+    missing = {action_id for action_id in action_ids if action_id not in _action_zones}
+    if missing:
+        owners = dict(
+            db_session.execute(
+                select(Action.id, Action.user_id).where(Action.id.in_(missing))
+            ).all()
+        )
+        unknown = set(owners.values()) - _user_zones.keys()
+        if unknown:
+            rows = db_session.execute(
+                select(User.id, User.timezone).where(User.id.in_(unknown))
+            )
+            for user_id, name in rows:
+                _user_zones[user_id] = ZoneInfo(name or DEFAULT_TIMEZONE)
+        for action_id, user_id in owners.items():
+            if user_id in _user_zones:
+                _action_zones[action_id] = _user_zones[user_id]
+    utc = ZoneInfo(DEFAULT_TIMEZONE)
+    return {action_id: _action_zones.get(action_id, utc) for action_id in action_ids}
+
+
+def forget(user_id: int):
+    """Drops the cached zones after the user's time zone was changed."""
+    broadcast.publish("timezone", user_id)
+
+
+def _forget(user_id: int):
+    _user_zones.pop(user_id, None)
+    _action_zones.clear()
+
+
+broadcast.subscribe("timezone", _forget)
+
+
+def local_day(timestamp: datetime, zone: ZoneInfo) -> date:
+    """The day `timestamp` falls on in `zone`, naive timestamps are UTC."""
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return timestamp.astimezone(zone).date()
+
+
+@cache
+def _offset_periods(name: str, first_year: int, last_year: int):
+    """
+    (naive UTC start, offset in minutes) of each period of constant UTC
+    offset of zone `name` from the start of `first_year` to the end of
+    `last_year`, the first period starting at that start.
+    """
+    zone = ZoneInfo(name)
+
+    def offset(at: datetime) -> int:
+        return int(at.astimezone(zone).utcoffset().total_seconds() // 60)
+
+    at = datetime(first_year, 1, 1, tzinfo=timezone.utc)
+    end = datetime(last_year + 1, 1, 1, tzinfo=timezone.utc)
+    periods = [(at.replace(tzinfo=None), offset(at))]
+    day = timedelta(days=1)
+    while at < end:
+        if offset(at + day) != periods[-1][1]:
+            # Find the minute of the change within the day
+            lo, hi = at, at + day
+            while hi - lo > timedelta(minutes=1):
+                mid = lo + (hi - lo) / 2
+                if offset(mid) == periods[-1][1]:
+                    lo = mid
+                else:
+                    hi = mid
+            periods.append((hi.replace(tzinfo=None), offset(hi)))
+        at += day
+    return periods
+
+
+def local_timestamp(
+    column,
+    name: str,
+    dialect: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+):
+    """
+    SQL expression converting the UTC timestamp `column` to zone `name`.
+    On SQLite it is exact for timestamps from `start` to `end`, both
+    defaulting to now, and uses the nearest offset outside them.
+    """
+    if dialect == "postgresql":
+        return func.timezone(name, func.timezone("UTC", column))
+
+    now = datetime.now(timezone.utc)
+    start, end = _naive_utc(start or now), _naive_utc(end or now)
+    periods = _offset_periods(name, start.year, max(start.year, end.year))
+    # Only the periods overlapping the range are kept
+    periods = [
+        (since, minutes)
+        for i, (since, minutes) in enumerate(periods)
+        if since <= end and (i + 1 == len(periods) or periods[i + 1][0] > start)
+    ]
+
+    def shifted(minutes: int):
+        return func.datetime(column, f"{minutes:+d} minutes") if minutes else column
+
+    if len(periods) == 1:
+        return shifted(periods[0][1])
+    whens = [
+        (column >= since, shifted(minutes)) for since, minutes in reversed(periods[1:])
+    ]
+    return case(*whens, else_=shifted(periods[0][1]))
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def day_column(
+    column,
+    name: str,
+    dialect: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+):
+    """
+    SQL expression for the local day of the UTC timestamp `column`, see
+    local_timestamp for `start` and `end`.
+    """
+    local = local_timestamp(column, name, dialect, start, end)
+    if dialect == "postgresql":
+        return cast(func.date_trunc("day", local), Date)
+    return func.date(local)
@@ -1,10 +1,13 @@
 from datetime import datetime, timedelta, timezone
 from database import db_session
-from models import Action, ActivityLog, User
+from models import Action
+from model_helpers import add_logs
 import random
 
 
-def generate_fake_data(user_id: int, num_actions: int = 3, days: int = 30):
+def generate_fake_data(
+    user_id: int, num_actions: int = 3, days: int = 30, logs_per_day: int = 1
+):
     """
     Generates fake actions and activity logs for testing
     """
@@ -39,19 +42,23 @@ def generate_fake_data(user_id: int, num_actions: int = 3, days: int = 30):
 
     db_session.commit()
 
-    # Step 2: Create random logs for each action
+    # Step 2: Create random logs for each action, inserted in one batch
+    now = datetime.now(timezone.utc)
+    logs = []
     for action in actions:
         for day in range(days):
-            ts = datetime.now(timezone.utc) - timedelta(days=day)
-            delta = random.randint(-15, 25)  # -5|+5 increments per day
-            log = ActivityLog(
-                action_id=action.id,
-                timestamp=ts,
-                delta=delta,
-                notes=f"Fake log for {action.name} on {ts.date()}",
-                properties={},
-            )
-            db_session.add(log)
+            for _ in range(logs_per_day):
+                ts = now - timedelta(days=day, seconds=random.randint(0, 3600))
+                logs.append(
+                    {
+                        "action_id": action.id,
+                        "timestamp": ts,
+                        "delta": random.randint(-15, 25),  # -5|+5 increments per day
+                        "notes": f"Fake log for {action.name} on {ts.date()}",
+                        "properties": {},
+                    }
+                )
 
+    add_logs(logs)
     db_session.commit()
     print(f"Generated {num_actions} actions with logs for user {user_id}")
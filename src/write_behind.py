@@ -0,0 +1,187 @@
+# write_behind.py
+"""
+Optional write-behind queue for new activity logs.
+
+When WRITE_BEHIND is enabled, the log endpoints only append the new row to an
+in-process queue and return. A background worker writes queued rows to the
+database in batches of WRITE_BEHIND_BATCH_SIZE rows, or every
+WRITE_BEHIND_FLUSH_MS milliseconds, whichever comes first. The queue is
+drained on shutdown.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import cache
+import timezones
+from database import db_session
+
+logger = logging.getLogger(__name__)
+
+WRITE_BEHIND: bool = os.getenv("WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+WRITE_BEHIND_BATCH_SIZE: int = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 200))
+WRITE_BEHIND_FLUSH_MS: int = int(os.getenv("WRITE_BEHIND_FLUSH_MS", 250))
+
+
+class WriteBehindQueue:
+    def __init__(self, batch_size: int, flush_ms: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self._rows = deque()
+        self._in_flight = []
+        self._cond = threading.Condition()
+        self._worker = None
+        self._stopping = False
+        self._flush_requested = False
+
+        # metrics
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+
+    def put(self, row: dict):
+        """Queues an ActivityLog row, see model_helpers.add_logs for its keys."""
+        with self._cond:
+            if self._worker is None:
+                self._start()
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+
+    def pending(self) -> list[dict]:
+        """Returns the rows that are queued or being written right now."""
+        with self._cond:
+            return self._in_flight + list(self._rows)
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Waits until every queued row has been written, False on timeout."""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: not self._rows and not self._in_flight, timeout
+            )
+
+    def stop(self):
+        """Drains the queue and stops the worker."""
+        with self._cond:
+            if self._worker is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        self._worker.join()
+        self._worker = None
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._rows) + len(self._in_flight)
+        return {
+            "queue_depth": depth,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+    def _start(self):
+        self._stopping = False
+        self._worker = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while (
+                    len(self._rows) < self.batch_size
+                    and not self._stopping
+                    and not self._flush_requested
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                self._flush_requested = False
+                if not self._rows:
+                    if self._stopping:
+                        return
+                    continue
+
+                count = min(self.batch_size, len(self._rows))
+                self._in_flight = [self._rows.popleft() for _ in range(count)]
+
+            batch = self._in_flight
+            written = self._write(batch)
+
+            with self._cond:
+                if not written:
+                    if self._stopping:
+                        logger.error("Dropping %d queued rows on shutdown", len(batch))
+                    else:
+                        # Put the rows back so they are retried on the next flush
+                        self._rows.extendleft(reversed(batch))
+                self._in_flight = []
+                self._cond.notify_all()
+
+            if not written:
+                time.sleep(self.flush_interval)
+
+    def _write(self, batch: list[dict]) -> bool:
+        from model_helpers import add_logs
+
+        started = time.perf_counter()
+        try:
+            add_logs(batch)
+            db_session.commit()
+        except Exception:
+            db_session.rollback()
+            logger.exception("Write-behind flush of %d rows failed", len(batch))
+            return False
+        finally:
+            db_session.remove()
+
+        # Pages listing logs only show them once they are written
+        action_ids = {row["action_id"] for row in batch}
+        cache.invalidate_tags([cache.action_tag(action_id) for action_id in action_ids])
+
+        self.flushes += 1
+        self.rows_written += len(batch)
+        self.last_batch_size = len(batch)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        logger.debug("Wrote %d queued rows in %.1f ms", len(batch), self.last_flush_ms)
+        return True
+
+
+queue = WriteBehindQueue(WRITE_BEHIND_BATCH_SIZE, WRITE_BEHIND_FLUSH_MS)
+atexit.register(queue.stop)
+
+
+def enabled() -> bool:
+    return WRITE_BEHIND
+
+
+def pending_changes(action_ids=None) -> dict:
+    """
+    Returns the rollup changes of the rows that are not written yet, so read
+    paths can include them: {(action_id, day): (delta, count), ...}
+    """
+    rows = [
+        row
+        for row in queue.pending()
+        if action_ids is None or row["action_id"] in action_ids
+    ]
+    zones = timezones.action_timezones({row["action_id"] for row in rows})
+    changes = {}
+    for row in rows:
+        day = timezones.local_day(row["timestamp"], zones[row["action_id"]])
+        key = (row["action_id"], day)
+        delta, count = changes.get(key, (0, 0))
+        changes[key] = (delta + row["delta"], count + 1)
+    return changes